@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Offline conversion of a directory of PDF files, or of a CSV manifest, with the
+same pipeline as the API (extraction, md_to_wikitext, annotation and optional
+Mediawiki page), on a pool of worker processes.
+Documents already converted are skipped by the SHA-256 of their content, so an
+interrupted batch is resumed by running it again. A JSON report is written in
+OUTPUT_FOLDER at the end.
+
+Usage:
+    python batch.py <directory or manifest.csv> [--footer TEXT]
+        [--ignore-pages 0,1] [--extractor markdown] [--profile accurate]
+        [--publish] [--wiki staging]
+        [--workers 4] [--force] [--report report.json]
+
+Manifest columns: path, page_name, footer, ignore_pages (only path required,
+relative paths are read from the manifest folder)
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from dotenv import load_dotenv
+from libs import wiki_registry
+from libs.extraction import EXTRACTION_PROFILES
+from pathlib import Path
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+EXTRACTORS = ("markdown", "direct")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    """
+    SHA-256 of a file, read by chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_jobs(source: Path, footer: str, ignore_pages: str) -> list[dict]:
+    """
+    List the documents of a directory (recursive) or of a CSV manifest
+
+    Returns:
+        List of jobs {path, page_name, footer, ignore_pages}
+    """
+    if source.is_dir():
+        return [
+            {
+                "path": str(path),
+                "page_name": path.stem,
+                "footer": footer,
+                "ignore_pages": ignore_pages,
+            }
+            for path in sorted(source.rglob("*.pdf"))
+        ]
+    jobs = []
+    with open(source, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            path = Path(row["path"])
+            if not path.is_absolute():
+                path = source.parent / path
+            jobs.append(
+                {
+                    "path": str(path),
+                    "page_name": row.get("page_name") or path.stem,
+                    "footer": row.get("footer") or footer,
+                    "ignore_pages": row.get("ignore_pages") or ignore_pages,
+                }
+            )
+    return jobs
+
+
+def convert_job(
+    job: dict, extractor: str, profile: str, publish: bool, wiki: str
+) -> dict:
+    """
+    Convert a document in a worker process
+    The wiki client of the worker is logged in once for all its documents.
+
+    Returns:
+        Result {status, seconds, error, log_file}
+    """
+    # Imported in the worker, the parent process only hashes and schedules
+    from libs import pipeline
+    from libs.memory import MemoryGuard
+
+    start = time.perf_counter()
+    page_name_final = job["page_name"].lower().replace(" ", "_")
+    store, run_id, log_file = pipeline.start_run(page_name_final, "pdf_to_wikitext")
+    memory = MemoryGuard()
+    try:
+        wikitext = pipeline.pdf_to_wikitext(
+            job["path"],
+            job["footer"],
+            job["ignore_pages"],
+            page_name_final,
+            publish,
+            extractor,
+            store,
+            run_id,
+            memory,
+            # Documents already run in parallel, one process each
+            parallel=False,
+            profile=profile,
+            wiki=wiki,
+        )
+    except Exception:
+        wikitext = None
+        error = traceback.format_exc(limit=1).strip()
+    else:
+        error = None if wikitext is not None else f"Conversion failed, see {log_file}"
+    finally:
+        memory.log_peak()
+        pipeline.finish_run(store, run_id, log_file)
+
+    if wikitext is not None:
+        store.add_source(
+            job["sha256"],
+            page_name_final,
+            pipeline.source_wiki(wiki, publish),
+            publish,
+            run_id,
+        )
+    return {
+        "status": "failed" if wikitext is None else "ok",
+        "seconds": round(time.perf_counter() - start, 3),
+        "error": error,
+        "log_file": str(log_file),
+    }
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return (
+        f"{hours}h{minutes:02d}m{seconds:02d}s"
+        if hours
+        else f"{minutes}m{seconds:02d}s"
+    )
+
+
+def run_batch(
+    jobs: list[dict],
+    extractor: str,
+    profile: str,
+    publish: bool,
+    workers: int,
+    force: bool,
+    wiki: str = "",
+) -> list[dict]:
+    """
+    Skip converted documents and convert the others on a process pool
+
+    Returns:
+        Jobs with their result
+    """
+    from libs.artifact_store import ArtifactStore
+
+    store = ArtifactStore()
+    # Documents are skipped only if converted for the same page and target
+    target = wiki_registry.get_target(wiki).name if publish else ""
+    pending = []
+    seen: dict[str, str] = {}
+    page_names: dict[str, str] = {}
+    for job in jobs:
+        job["sha256"] = file_sha256(Path(job["path"]))
+        page_name_final = job["page_name"].lower().replace(" ", "_")
+        converted = (
+            None
+            if force
+            else store.get_source(job["sha256"], page_name_final, target, publish)
+        )
+        if converted is not None:
+            job.update(
+                status="skipped",
+                error=f"Already converted as {page_name_final} on {converted}",
+            )
+        elif job["sha256"] in seen:
+            job.update(status="skipped", error=f"Same content as {seen[job["sha256"]]}")
+        elif page_name_final in page_names:
+            job.update(
+                status="failed",
+                error=f"Page name already used by {page_names[page_name_final]}",
+            )
+        else:
+            pending.append(job)
+        seen.setdefault(job["sha256"], job["path"])
+        page_names.setdefault(page_name_final, job["path"])
+
+    print(f"{len(jobs)} documents, {len(pending)} to convert with {workers} workers")
+    if not pending:
+        return jobs
+
+    start = time.perf_counter()
+    done = 0
+    # spawn: worker processes don't inherit PyMuPDF state of the parent
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(convert_job, job, extractor, profile, publish, wiki): job
+            for job in pending
+        }
+        try:
+            remaining = set(futures)
+            while remaining:
+                finished, remaining = wait(remaining, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = futures[future]
+                    try:
+                        job.update(future.result())
+                    except Exception as e:
+                        job.update(status="failed", error=str(e))
+                    done += 1
+                    elapsed = time.perf_counter() - start
+                    eta = elapsed / done * (len(pending) - done)
+                    print(
+                        f"[{done}/{len(pending)}] {job["path"]} {job["status"]}"
+                        f" in {job.get("seconds", 0):.1f}s, ETA {_duration(eta)}",
+                        flush=True,
+                    )
+        except KeyboardInterrupt:
+            print("Interrupted, run the batch again to resume")
+            executor.shutdown(wait=True, cancel_futures=True)
+            for job in pending:
+                job.setdefault("status", "interrupted")
+    return jobs
+
+
+def write_report(jobs: list[dict], seconds: float, report: Path | None) -> Path:
+    """
+    Write the JSON summary of the batch
+
+    Returns:
+        Report path
+    """
+    totals = {}
+    for job in jobs:
+        totals[job["status"]] = totals.get(job["status"], 0) + 1
+    if report is None:
+        output_folder = Path(os.getenv("OUTPUT_FOLDER") or "./output")
+        report = output_folder / f"batch_{datetime.now():%Y%m%d_%H%M%S}.json"
+    report.parent.mkdir(parents=True, exist_ok=True)
+    report.write_text(
+        json.dumps(
+            {
+                "documents": len(jobs),
+                "seconds": round(seconds, 3),
+                "totals": totals,
+                "results": [
+                    {
+                        "path": job["path"],
+                        "page_name": job["page_name"],
+                        "sha256": job["sha256"],
+                        "status": job["status"],
+                        "seconds": job.get("seconds"),
+                        "error": job.get("error"),
+                        "log_file": job.get("log_file"),
+                    }
+                    for job in jobs
+                ],
+            },
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+    return report
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Convert PDF files to wikitext")
+    parser.add_argument("source", type=Path, help="Directory or CSV manifest")
+    parser.add_argument("--footer", default="", help="Reference footer")
+    parser.add_argument("--ignore-pages", default="", help="Pages separate by ,")
+    parser.add_argument("--extractor", choices=EXTRACTORS, default="markdown")
+    parser.add_argument("--profile", choices=EXTRACTION_PROFILES, default="accurate")
+    parser.add_argument("--publish", action="store_true", help="Create the pages")
+    parser.add_argument("--wiki", default="", help="Target wiki of the pages")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="Convert all again")
+    parser.add_argument("--report", type=Path, help="JSON report path")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    if not args.source.exists():
+        parser.error(f"{args.source} not found")
+    try:
+        wiki_registry.get_target(args.wiki)
+    except wiki_registry.UnknownWikiError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    jobs = read_jobs(args.source, args.footer, args.ignore_pages)
+    jobs = run_batch(
+        jobs,
+        args.extractor,
+        args.profile,
+        args.publish,
+        args.workers,
+        args.force,
+        args.wiki,
+    )
+    seconds = time.perf_counter() - start
+    report = write_report(jobs, seconds, args.report)
+
+    failed = [job for job in jobs if job["status"] not in ("ok", "skipped")]
+    print(
+        f"{sum(job["status"] == "ok" for job in jobs)} converted,"
+        f" {sum(job["status"] == "skipped" for job in jobs)} skipped,"
+        f" {len(failed)} failed in {_duration(seconds)}, report {report}"
+    )
+    for job in failed:
+        print(f"  {job["path"]}: {job.get("error")}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Extractors benchmark
+Compare the time to transform PDF files to wikitext with the markdown path
+(pymupdf4llm then md_to_wikitext) and the direct path (PyMuPDF spans)
+Images are extracted but not uploaded, Mediawiki is not reachable
+
+Usage:
+    python benchmarks/extractors.py [PDF or folder ...] [--runs 3] [--footer F]
+"""
+
+from pathlib import Path
+import argparse
+import fitz
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from libs import direct_extractor, extraction  # noqa: E402
+from libs.logger import init_logger, close_logger  # noqa: E402
+from libs.md_to_wikitext import md_to_wikitext  # noqa: E402
+
+
+def markdown_path(pdf_path: Path, footer: str, image_path: str) -> str:
+    md_text = extraction.pdf_to_markdown(pdf_path, image_path)
+    return md_to_wikitext(md_text, footer, "", "benchmark", image_path)
+
+
+def direct_path(pdf_path: Path, footer: str, image_path: str) -> str:
+    return direct_extractor.pdf_to_wikitext(
+        pdf_path, footer, "", "benchmark", image_path
+    )
+
+
+EXTRACTORS = {"markdown": markdown_path, "direct": direct_path}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare PDF extractors")
+    parser.add_argument("paths", nargs="*", default=[str(ROOT / "tests")])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--footer", default="Test document")
+    args = parser.parse_args()
+
+    pdf_files = []
+    for path in map(Path, args.paths):
+        pdf_files += sorted(path.glob("*.pdf")) if path.is_dir() else [path]
+
+    # Nothing listens there, images are not uploaded
+    os.environ["MEDIAWIKI_URL"] = "http://127.0.0.1:9"
+    extraction.preload()
+
+    work_dir = Path(tempfile.mkdtemp())
+    init_logger("benchmark", str(work_dir))
+    try:
+        print(
+            f"{'file':40} {'pages':>5} {'extractor':>9} {'median':>8}"
+            f" {'min':>8} {'chars':>7}"
+        )
+        for pdf_file in pdf_files:
+            with fitz.open(pdf_file) as doc:
+                page_count = doc.page_count
+            for name, extractor in EXTRACTORS.items():
+                times = []
+                for run in range(args.runs):
+                    image_path = f"{work_dir}/{name}_{run}/"
+                    start = time.perf_counter()
+                    wikitext = extractor(pdf_file, args.footer, image_path)
+                    times.append(time.perf_counter() - start)
+                    shutil.rmtree(image_path, ignore_errors=True)
+                print(
+                    f"{pdf_file.name[:40]:40} {page_count:>5} {name:>9}"
+                    f" {statistics.median(times):>7.3f}s {min(times):>7.3f}s"
+                    f" {len(wikitext):>7}"
+                )
+    finally:
+        close_logger()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Load test of the API endpoints
+Drive /pdf-to-wikitext/, /create-mediawiki-page/, /get-wikitext-file/ and
+/get-last-log/ with concurrent clients and a mix of PDF sizes, then report
+throughput, p50/p95/p99 latency and error rate per endpoint.
+By default the API is started with uvicorn on a local port, against the fake
+Mediawiki server of the tests. A probe request runs during the test, its
+latency shows how long the event loop is blocked. Open files and memory of
+the server process are reported to show leaks between levels.
+
+Usage:
+    python benchmarks/load.py [--concurrency 10,50,100] [--requests 200]
+        [--pages 1,10,50] [--mix pdf=1,create=1,wikitext=2,log=2]
+        [--workers 1] [--wiki-latency 0.02] [--wiki-error-rate 0]
+        [--wiki-maxlag-rate 0] [--url http://127.0.0.1:8000]
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import fitz
+import httpx
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from tests.fake_mediawiki import FakeWiki, serve  # noqa: E402
+
+SOURCE_PDF = ROOT / "tests/test_file.pdf"
+FOOTER = "Test document"
+PROBE_INTERVAL = 0.2
+REQUEST_TIMEOUT = 600
+
+
+def build_pdfs(page_counts: list[int], folder: Path) -> dict[int, Path]:
+    """
+    Build PDF files of the given number of pages from the test file
+    """
+    pdfs = {}
+    with fitz.open(SOURCE_PDF) as source:
+        for page_count in page_counts:
+            with fitz.open() as doc:
+                while doc.page_count < page_count:
+                    last = min(source.page_count, page_count - doc.page_count) - 1
+                    doc.insert_pdf(source, to_page=last)
+                pdfs[page_count] = folder / f"load_{page_count}.pdf"
+                doc.save(pdfs[page_count])
+    return pdfs
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name}, one of {list(OPERATIONS)}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+async def convert_pdf(client: httpx.AsyncClient, pdf: Path, page_name: str):
+    with open(pdf, "rb") as f:
+        return await client.post(
+            "/pdf-to-wikitext/",
+            files={"file": (pdf.name, f.read(), "application/pdf")},
+            data={
+                "footer": FOOTER,
+                "ignore_pages": "",
+                "page_name": page_name,
+                "generate_page": "true",
+            },
+        )
+
+
+async def create_page(client: httpx.AsyncClient, pdf: Path, page_name: str):
+    wikitext = f"== {page_name} ==\n\nLoad test page created from {pdf.name}\n"
+    return await client.post(
+        "/create-mediawiki-page/",
+        files={"file": ("page.txt", wikitext.encode(), "text/plain")},
+        data={"page_name": page_name},
+    )
+
+
+async def get_wikitext(client: httpx.AsyncClient, pdf: Path, page_name: str):
+    return await client.post("/get-wikitext-file/", data={"page_name": page_name})
+
+
+async def get_last_log(client: httpx.AsyncClient, pdf: Path, page_name: str):
+    return await client.post("/get-last-log/", data={"page_name": page_name})
+
+
+OPERATIONS = {
+    "pdf": ("pdf-to-wikitext", convert_pdf),
+    "create": ("create-mediawiki-page", create_page),
+    "wikitext": ("get-wikitext-file", get_wikitext),
+    "log": ("get-last-log", get_last_log),
+}
+
+
+def random_jobs(
+    request_count: int,
+    weights: dict[str, int],
+    pdfs: dict[int, Path],
+    page_names: list[str],
+    seed: int,
+) -> list[tuple[str, Path, str]]:
+    """
+    Draw the requests of a level
+
+    Returns:
+        List of (operation, PDF file, page name)
+    """
+    rng = random.Random(seed)
+    operations = rng.choices(list(weights), list(weights.values()), k=request_count)
+    return [
+        (operation, rng.choice(list(pdfs.values())), rng.choice(page_names))
+        for operation in operations
+    ]
+
+
+async def run_level(url: str, concurrency: int, jobs: list[tuple[str, Path, str]]):
+    """
+    Send the requests with concurrency clients
+
+    Returns:
+        Tuple (duration, {operation: [(seconds, ok)]}, probe latencies)
+    """
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    used = {operation for operation, _, _ in jobs}
+    results: dict[str, list[tuple[float, bool]]] = {
+        operation: [] for operation in OPERATIONS if operation in used
+    }
+    probes: list[float] = []
+    done = asyncio.Event()
+
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(
+        base_url=url, timeout=REQUEST_TIMEOUT, limits=limits
+    ) as client:
+
+        async def worker():
+            while not queue.empty():
+                operation, pdf, page_name = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await OPERATIONS[operation][1](client, pdf, page_name)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                results[operation].append((time.perf_counter() - start, ok))
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    await client.get("/openapi.json")
+                    probes.append(time.perf_counter() - start)
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(PROBE_INTERVAL)
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+        done.set()
+        await probe_task
+
+    return duration, results, probes
+
+
+def process_stats(pid: int | None) -> str:
+    """
+    Open files and memory of the server process, Linux only
+    """
+    if pid is None:
+        return "n/a"
+    try:
+        open_files = len(os.listdir(f"/proc/{pid}/fd"))
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(line.split()[1] for line in f if line.startswith("VmRSS"))
+        return f"{open_files} open files, {int(rss) // 1024} MiB RSS"
+    except (OSError, StopIteration):
+        return "n/a"
+
+
+def print_report(concurrency, duration, results, probes):
+    total = sum(len(values) for values in results.values())
+    errors = sum(not ok for values in results.values() for _, ok in values)
+    print(
+        f"\nconcurrency {concurrency}: {total} requests in {duration:.1f}s,"
+        f" {total / duration:.2f} req/s, {100 * errors / max(total, 1):.1f}% errors"
+    )
+    print(
+        f"{'endpoint':24} {'count':>6} {'errors':>7} {'req/s':>7}"
+        f" {'p50':>8} {'p95':>8} {'p99':>8}"
+    )
+    rows = [(OPERATIONS[operation][0], values) for operation, values in results.items()]
+    rows.append(("probe (event loop)", [(latency, True) for latency in probes]))
+    for name, values in rows:
+        latencies = [latency for latency, _ in values]
+        failed = sum(not ok for _, ok in values)
+        print(
+            f"{name:24} {len(values):>6} {100 * failed / max(len(values), 1):>6.1f}%"
+            f" {len(values) / duration:>7.2f}"
+            + "".join(
+                f" {percentile(latencies, percent):>7.3f}s" for percent in (50, 95, 99)
+            )
+        )
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_api(wiki_url: str, work_dir: Path, workers: int):
+    """
+    Start the API with uvicorn against the fake wiki
+
+    Returns:
+        Tuple (process, url)
+    """
+    port = free_port()
+    for folder in ("output", "images"):
+        (work_dir / folder).mkdir()
+    env = {
+        **os.environ,
+        "MEDIAWIKI_URL": wiki_url,
+        "OUTPUT_FOLDER": str(work_dir / "output"),
+        "IMAGES_FOLDER": str(work_dir / "images"),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1"]
+        + ["--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("API server stopped at startup")
+        try:
+            httpx.get(f"{url}/openapi.json", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("API server didn't start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the API")
+    parser.add_argument("--concurrency", default="10,50,100")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--pages", default="1,10,50")
+    parser.add_argument("--mix", default="pdf=1,create=1,wikitext=2,log=2")
+    parser.add_argument("--page-names", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--wiki-latency", type=float, default=0.02)
+    parser.add_argument("--wiki-error-rate", type=float, default=0.0)
+    parser.add_argument("--wiki-maxlag-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="Test a running API instead of starting one")
+    args = parser.parse_args()
+
+    levels = [int(value) for value in args.concurrency.split(",")]
+    weights = parse_mix(args.mix)
+    page_names = [f"load {index}" for index in range(args.page_names)]
+
+    work_dir = Path(tempfile.mkdtemp())
+    pdf_folder = work_dir / "pdf"
+    pdf_folder.mkdir()
+    pdfs = build_pdfs([int(value) for value in args.pages.split(",")], pdf_folder)
+
+    wiki = FakeWiki(
+        args.wiki_latency,
+        args.wiki_error_rate,
+        args.wiki_maxlag_rate,
+        retry_after=0,
+        seed=args.seed,
+    )
+    with serve(wiki) as (wiki_url, _):
+        process = None
+        try:
+            if args.url:
+                url = args.url
+            else:
+                process, url = start_api(wiki_url, work_dir, args.workers)
+            pid = process.pid if process and args.workers == 1 else None
+
+            # Every page name has a wikitext file and a log before the test
+            smallest = pdfs[min(pdfs)]
+            jobs = [("pdf", smallest, page_name) for page_name in page_names]
+            asyncio.run(run_level(url, min(8, len(jobs)), jobs))
+            print(f"server after warm up: {process_stats(pid)}")
+
+            for concurrency in levels:
+                jobs = random_jobs(
+                    args.requests, weights, pdfs, page_names, args.seed + concurrency
+                )
+                duration, results, probes = asyncio.run(
+                    run_level(url, concurrency, jobs)
+                )
+                print_report(concurrency, duration, results, probes)
+                print(f"server: {process_stats(pid)}")
+                print(
+                    f"wiki: {wiki.max_in_flight} max concurrent calls,"
+                    f" {dict(wiki.stats)}"
+                )
+        finally:
+            if process:
+                process.terminate()
+                process.wait(30)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark
+Measure the import time of main with python -X importtime and fail when it
+is above the budget
+
+Usage:
+    python benchmarks/startup.py [--budget 0.75] [--runs 5] [--top 10]
+"""
+
+from pathlib import Path
+import argparse
+import re
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+LINE_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def measure(module: str = "main"):
+    """
+    Import a module in a new interpreter
+
+    Args:
+        module: Module to import
+
+    Returns:
+        Tuple (total seconds, [(cumulative seconds, name)] of the modules
+        imported directly by the module, names of all imported modules)
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    children = []
+    names = set()
+    for line in result.stderr.splitlines():
+        match = LINE_PATTERN.match(line)
+        if not match:
+            continue
+        names.add(match.group(4))
+        cumulative = int(match.group(2)) / 1_000_000
+        depth = (len(match.group(3)) - 1) // 2
+        if depth == 0:
+            total += cumulative
+        elif depth == 1:
+            children.append((cumulative, match.group(4)))
+    return total, children, names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup import time")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget", type=float, default=0.75, help="seconds")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    # Best run, the others include disk cache and scheduler noise
+    total, children, names = min(runs, key=lambda run: run[0])
+    totals = sorted(run[0] for run in runs)
+
+    median = totals[len(totals) // 2]
+    print(f"import {args.module}: best {total:.3f}s, median {median:.3f}s")
+    for cumulative, name in sorted(children, reverse=True)[: args.top]:
+        print(f"  {cumulative:.3f}s  {name}")
+
+    for heavy in ("fitz", "pymupdf4llm"):
+        if heavy in names:
+            print(f"FAIL: {heavy} is imported at startup")
+            sys.exit(1)
+
+    if total > args.budget:
+        print(f"FAIL: above budget of {args.budget:.3f}s")
+        sys.exit(1)
+    print(f"OK: within budget of {args.budget:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,434 @@
-from libs.logger import log
+"""
+Annotation of wikitext with the terms of an ontology
+The labels are compiled once per process in an Aho-Corasick automaton so that
+a section is scanned in a single pass whatever the size of the vocabulary
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+# Wikitext parts never annotated: links, templates, headings
+PROTECTED_PATTERN = re.compile(
+    r"\[\[.*?\]\]|\{\{.*?\}\}|^=+[^\n]*=+[ \t]*$", re.M | re.S
+)
+
+
+class TermHit(NamedTuple):
+    start: int
+    end: int
+    label: str
+    concept: str
+
+
+class SectionTiming(NamedTuple):
+    index: int
+    title: str
+    seconds: float
+    hits: int
+    cached: bool
+
+
+class Automaton:
+    def __init__(self, terms: dict[str, str]):
+        """
+        Compile labels in an Aho-Corasick automaton
+
+        Args:
+            terms: lower case label -> concept
+        """
+        self.labels = list(terms)
+        self.concepts = [terms[label] for label in self.labels]
+        # One dict of transitions per state, state 0 is the root
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail = [0]
+        # Index of the label ending at this state, -1 if none
+        self.match = [-1]
+        # Nearest state reachable by fail links that ends a label
+        self.output_link = [0]
+
+        for index, label in enumerate(self.labels):
+            state = 0
+            for char in label:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.match.append(-1)
+                    self.output_link.append(0)
+                state = next_state
+            self.match[state] = index
+
+        # Breadth first computation of fail links
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output_link[next_state] = (
+                    fail if self.match[fail] != -1 else self.output_link[fail]
+                )
+
+    def iter_matches(self, text: str):
+        """
+        Find all the occurrences of the labels in a lower case text
+
+        Args:
+            text: Lower case text
+
+        Yields:
+            Tuple (start, end, label index)
+        """
+        goto = self.goto
+        fail = self.fail
+        match = self.match
+        output_link = self.output_link
+        labels = self.labels
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            output = state if match[state] != -1 else output_link[state]
+            while output:
+                index = match[output]
+                yield position + 1 - len(labels[index]), position + 1, index
+                output = output_link[output]
+
+
+def load_ontology(ontology_file) -> dict[str, str]:
+    """
+    Read an ontology file
+
+    Args:
+        ontology_file: Tab separated file, one "label<TAB>concept" per line,
+            concept is the label when missing, lines starting with # are ignored
+
+    Returns:
+        lower case label -> concept
+    """
+    terms = {}
+    with open(ontology_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            label, _, concept = line.partition("\t")
+            label = label.strip()
+            if label:
+                terms.setdefault(_lower(label), concept.strip() or label)
+    return terms
+
+
+# Automatons already compiled in this process, by file and modification time
+_automatons: dict[tuple[str, float], Automaton] = {}
+_automatons_lock = threading.Lock()
+
+
+def get_automaton(ontology_file) -> Automaton:
+    """
+    Get the compiled automaton of an ontology file, compiled once per process
+
+    Args:
+        ontology_file: Ontology file path
+
+    Returns:
+        Automaton
+    """
+    path = Path(ontology_file).resolve()
+    key = (str(path), path.stat().st_mtime)
+    automaton = _automatons.get(key)
+    if automaton is None:
+        with _automatons_lock:
+            automaton = _automatons.get(key)
+            if automaton is None:
+                automaton = Automaton(load_ontology(path))
+                _automatons.clear()
+                _automatons[key] = automaton
+    return automaton
+
+
+def _lower(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    # Some characters change length in lower case, keep them to keep offsets
+    return "".join(
+        lower if len(lower) == 1 else char
+        for char, lower in ((char, char.lower()) for char in text)
+    )
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
 
 
 class Annotate:
-    def annotate_section(self, section: str):
-        log("annotate_section:" + section)
+    def __init__(self, ontology_file=None, mode=None, property_name=None):
+        """
+        Initialize annotation
+
+        Env:
+            ONTOLOGY_FILE: Ontology file, annotation is disabled when not set
+            ONTOLOGY_MODE: "property" to annotate terms with a Semantic
+                MediaWiki property, "category" to add categories to the section
+            ONTOLOGY_PROPERTY: Semantic MediaWiki property name
+            ANNOTATION_WORKERS: Number of processes annotating sections
+            ANNOTATION_PARALLEL_MIN: Minimum number of sections to annotate
+                before using the process pool
+        """
+        self.ontology_file = ontology_file or os.getenv("ONTOLOGY_FILE")
+        self.automaton = (
+            get_automaton(self.ontology_file) if self.ontology_file else None
+        )
+        self.mode = mode or os.getenv("ONTOLOGY_MODE") or "property"
+        self.property_name = (
+            property_name or os.getenv("ONTOLOGY_PROPERTY") or "Has concept"
+        )
+
+    def find_terms(self, section: str) -> list[TermHit]:
+        """
+        Find the ontology terms of a section
+
+        Args:
+            section: Wikitext
+
+        Returns:
+            Non overlapping hits, the longest label wins at a same position
+        """
+        if self.automaton is None or not self.automaton.labels:
+            return []
+
+        protected = [match.span() for match in PROTECTED_PATTERN.finditer(section)]
+        text = _lower(section)
+        length = len(text)
+
+        candidates = []
+        for start, end, index in self.automaton.iter_matches(text):
+            if start > 0 and _is_word_char(text[start - 1]):
+                continue
+            if end < length and _is_word_char(text[end]):
+                continue
+            candidates.append((start, -end, index))
+
+        hits = []
+        last_end = 0
+        protected_index = 0
+        for start, end, index in sorted(candidates):
+            end = -end
+            if start < last_end:
+                continue
+            while (
+                protected_index < len(protected)
+                and protected[protected_index][1] <= start
+            ):
+                protected_index += 1
+            if protected_index < len(protected) and protected[protected_index][0] < end:
+                continue
+            hits.append(
+                TermHit(
+                    start,
+                    end,
+                    self.automaton.labels[index],
+                    self.automaton.concepts[index],
+                )
+            )
+            last_end = end
+        return hits
+
+    def inject(self, section: str, hits: list[TermHit]) -> str:
+        """
+        Add annotations of hits in a section
+
+        Args:
+            section: Wikitext
+            hits: Hits found in this section
+
+        Returns:
+            Annotated wikitext
+        """
+        if not hits:
+            return section
+
+        if self.mode == "category":
+            categories = dict.fromkeys(hit.concept for hit in hits)
+            return (
+                section.rstrip("\n")
+                + "\n"
+                + "\n".join(f"[[Category:{concept}]]" for concept in categories)
+            )
+
+        parts = []
+        position = 0
+        for hit in hits:
+            parts.append(section[position : hit.start])
+            parts.append(
+                f"[[{self.property_name}::{hit.concept}|{section[hit.start:hit.end]}]]"
+            )
+            position = hit.end
+        parts.append(section[position:])
+        return "".join(parts)
+
+    def annotate_section(self, section: str) -> str:
+        """
+        Annotate the ontology terms of a section
+
+        Args:
+            section: Wikitext
+
+        Returns:
+            Annotated wikitext
+        """
+        return self.inject(section, self.find_terms(section))
+
+    def annotate_sections(
+        self, sections: list[str], parallel: bool = True
+    ) -> tuple[list[str], list[SectionTiming]]:
+        """
+        Annotate sections, in parallel in the worker pool when there are enough
+        of them. Sections already annotated with the same ontology are taken
+        from the cache.
+
+        Args:
+            sections: Wikitext sections
+            parallel: False to annotate in this process only
+
+        Returns:
+            Tuple (annotated sections, timing of each section)
+        """
+        if self.automaton is None:
+            return sections, []
+
+        key_prefix = "\0".join(
+            (_automaton_key(self.ontology_file), self.mode, self.property_name)
+        )
+        results: list[str] = list(sections)
+        timings: list[SectionTiming | None] = [None] * len(sections)
+        todo = []
+        for index, section in enumerate(sections):
+            key = hashlib.sha256(f"{key_prefix}\0{section}".encode()).digest()
+            cached = _cache_get(key)
+            if cached is None:
+                todo.append((index, key))
+            else:
+                results[index] = cached[0]
+                timings[index] = SectionTiming(
+                    index, _section_title(section), 0.0, cached[1], True
+                )
+
+        args = (self.ontology_file, self.mode, self.property_name)
+        min_parallel = int(os.getenv("ANNOTATION_PARALLEL_MIN") or 16)
+        if parallel and len(todo) >= min_parallel:
+            annotated = _get_pool().map(
+                _annotate_in_worker,
+                *zip(*[(*args, sections[index]) for index, _ in todo]),
+                chunksize=max(1, len(todo) // (4 * _pool_workers())),
+            )
+        else:
+            annotated = (
+                _annotate_in_worker(*args, sections[index]) for index, _ in todo
+            )
+
+        for (index, key), (text, hits, seconds) in zip(todo, annotated):
+            _cache_put(key, (text, hits))
+            results[index] = text
+            timings[index] = SectionTiming(
+                index, _section_title(sections[index]), seconds, hits, False
+            )
+
+        return results, timings  # type: ignore
+
+
+def _section_title(section: str) -> str:
+    first_line = section.lstrip("\n").split("\n", 1)[0]
+    if first_line.startswith("="):
+        return first_line.strip("= \t")
+    return ""
+
+
+def _automaton_key(ontology_file) -> str:
+    path = Path(ontology_file).resolve()
+    return f"{path}:{path.stat().st_mtime}"
+
+
+def _annotate_in_worker(ontology_file, mode, property_name, section: str):
+    """
+    Annotate a section, run in the worker pool
+
+    Returns:
+        Tuple (annotated section, number of hits, seconds)
+    """
+    start = time.perf_counter()
+    annotation = Annotate(ontology_file, mode, property_name)
+    hits = annotation.find_terms(section)
+    text = annotation.inject(section, hits)
+    return text, len(hits), time.perf_counter() - start
+
+
+# Annotated sections by hash of ontology, options and section content
+_cache: OrderedDict[bytes, tuple[str, int]] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(key: bytes):
+    with _cache_lock:
+        value = _cache.get(key)
+        if value is not None:
+            _cache.move_to_end(key)
+        return value
+
+
+def _cache_put(key: bytes, value: tuple[str, int]):
+    max_size = int(os.getenv("ANNOTATION_CACHE_SIZE") or 10000)
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > max_size:
+            _cache.popitem(last=False)
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _pool_workers() -> int:
+    return int(os.getenv("ANNOTATION_WORKERS") or os.cpu_count() or 1)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """
+    Get the worker pool, started at first use. Each worker compiles the
+    ontology once and keeps it for the next sections.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=_pool_workers(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def shutdown_pool():
+    """
+    Stop the worker pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,399 @@
+"""
+Index of the files generated by each run (md, txt, log, timings) and upload
+status of the images uploaded after the run
+It use a SQLite database in the output folder
+"""
+
+from datetime import datetime
+from pathlib import Path
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+DB_NAME = "artifacts.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    page_name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_page_name ON runs (page_name, id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    compressed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, kind)
+);
+CREATE INDEX IF NOT EXISTS artifacts_path ON artifacts (path);
+CREATE TABLE IF NOT EXISTS sources (
+    sha256 TEXT NOT NULL,
+    page_name TEXT NOT NULL,
+    wiki TEXT NOT NULL,
+    published INTEGER NOT NULL,
+    run_id INTEGER REFERENCES runs (id) ON DELETE SET NULL,
+    converted_at TEXT NOT NULL,
+    PRIMARY KEY (sha256, page_name, wiki, published)
+);
+CREATE TABLE IF NOT EXISTS images (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (run_id, name)
+);
+"""
+
+# Artifact kinds compressed when their run is not the last one of the page
+COMPRESSIBLE_KINDS = ("md", "log")
+
+# Databases with an up to date schema in this process
+_initialized: set[str] = set()
+# Held while the schema is checked, concurrent requests wait for the tables
+_schema_lock = threading.Lock()
+
+
+class ArtifactStore:
+    def __init__(self, folder=None):
+        """
+        Initialize the store of an output folder
+
+        Env:
+            OUTPUT_FOLDER: Output folder, used when folder is not given
+            ARTIFACT_KEEP_RUNS: Number of runs kept per page_name, 0 (default)
+                to keep all
+            ARTIFACT_COMPRESS: if true, gzip md and log files of older runs
+        """
+        self.folder = Path(folder or os.getenv("OUTPUT_FOLDER") or "./output")
+        self.db_path = self.folder / DB_NAME
+        self.keep_runs = int(os.getenv("ARTIFACT_KEEP_RUNS") or 0)
+        self.compress = os.getenv("ARTIFACT_COMPRESS") == "true"
+
+    def _connect(self) -> sqlite3.Connection:
+        with _schema_lock:
+            create = not self.db_path.exists()
+            if create:
+                self.folder.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute("PRAGMA foreign_keys = ON")
+            # Tables added after the creation of the database are created too
+            if create or str(self.db_path) not in _initialized:
+                connection.executescript(SCHEMA)
+                _initialized.add(str(self.db_path))
+        return connection
+
+    def start_run(self, page_name: str, kind: str) -> int:
+        """
+        Register a new run
+
+        Args:
+            page_name: Normalized page reference name
+            kind: Run kind (pdf_to_wikitext, create_mediawiki_page...)
+
+        Returns:
+            Run id
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (page_name, kind, started_at) VALUES (?, ?, ?)",
+                (page_name, kind, datetime.now().isoformat(timespec="seconds")),
+            )
+        connection.close()
+        return cursor.lastrowid  # type: ignore
+
+    def add_artifact(self, run_id: int, kind: str, path):
+        """
+        Register a file generated by a run
+
+        Args:
+            run_id: Run id
+            kind: Artifact kind (md, txt, log, timings)
+            path: File path
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO artifacts (run_id, kind, path) VALUES (?, ?, ?)",
+                (run_id, kind, str(path)),
+            )
+        connection.close()
+
+    def add_timings(self, run_id: int, log_file, timings: list[dict]):
+        """
+        Write the step timings of a run next to its log and register them
+
+        Args:
+            run_id: Run id
+            log_file: Log file of the run
+            timings: Step timings
+        """
+        timings_file = Path(log_file).with_suffix(".timings.json")
+        timings_file.write_text(json.dumps(timings, indent=1), encoding="utf-8")
+        self.add_artifact(run_id, "timings", timings_file)
+
+    def get_last_artifact(self, page_name: str, kind: str) -> Path | None:
+        """
+        Get the artifact of the last run of a page_name that generated it
+
+        Args:
+            page_name: Normalized page reference name
+            kind: Artifact kind
+
+        Returns:
+            Artifact path, None if not found
+        """
+        if not self.db_path.exists():
+            return None
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT a.path FROM runs r JOIN artifacts a ON a.run_id = r.id"
+                " WHERE r.page_name = ? AND a.kind = ? ORDER BY r.id DESC LIMIT 1",
+                (page_name, kind),
+            ).fetchone()
+        connection.close()
+        return Path(row[0]) if row else None
+
+    def add_source(
+        self, sha256: str, page_name: str, wiki: str, published: bool, run_id: int
+    ):
+        """
+        Register the content hash of a converted PDF file
+
+        Args:
+            sha256: SHA-256 of the PDF content
+            page_name: Normalized page reference name
+            wiki: Target wiki name of the published page, "" if not published
+            published: if true, the page was created on the wiki
+            run_id: Run id of the conversion
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sources (sha256, page_name, wiki, published,"
+                " run_id, converted_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    sha256,
+                    page_name,
+                    wiki,
+                    int(published),
+                    run_id,
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+        connection.close()
+
+    def get_source(
+        self, sha256: str, page_name: str, wiki: str, published: bool
+    ) -> str | None:
+        """
+        Get when a PDF file was already converted for a page
+        A published conversion also counts as a conversion without publication
+
+        Args:
+            sha256: SHA-256 of the PDF content
+            page_name: Normalized page reference name
+            wiki: Target wiki name, only checked if published
+            published: if true, only conversions published on the wiki count
+
+        Returns:
+            Conversion date, None if not converted
+        """
+        if not self.db_path.exists():
+            return None
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT converted_at FROM sources WHERE sha256 = ? AND page_name = ?"
+                " AND (NOT ? OR (wiki = ? AND published = 1))"
+                " ORDER BY converted_at DESC LIMIT 1",
+                (sha256, page_name, int(published), wiki),
+            ).fetchone()
+        connection.close()
+        return row[0] if row else None
+
+    def add_images(self, run_id: int, names: list[str], status: str = "pending"):
+        """
+        Register the images of a run waiting for their upload
+
+        Args:
+            run_id: Run id of the conversion
+            names: Mediawiki file names
+            status: pending, or failed for images that are not uploaded
+        """
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO images (run_id, name, status)"
+                " VALUES (?, ?, ?)",
+                [(run_id, name, status) for name in names],
+            )
+        connection.close()
+
+    def set_image_status(self, run_id: int, name: str, status: str):
+        """
+        Update the upload status of an image
+
+        Args:
+            run_id: Run id of the conversion
+            name: Mediawiki file name
+            status: pending, uploaded or failed
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE images SET status = ? WHERE run_id = ? AND name = ?",
+                (status, run_id, name),
+            )
+        connection.close()
+
+    def get_image_status(self, page_name: str) -> dict | None:
+        """
+        Get the upload status of the images of the last conversion or
+        reconversion of a page_name
+
+        Args:
+            page_name: Normalized page reference name
+
+        Returns:
+            run_id, total, count by status and status of each image, None if
+            the page_name was never converted
+        """
+        if not self.db_path.exists():
+            return None
+        with self._connect() as connection:
+            # A reconversion defers the images of its document too
+            run = connection.execute(
+                "SELECT id FROM runs WHERE page_name = ?"
+                " AND kind IN ('pdf_to_wikitext', 'reconvert_wikitext')"
+                " ORDER BY id DESC LIMIT 1",
+                (page_name,),
+            ).fetchone()
+            rows = []
+            if run:
+                rows = connection.execute(
+                    "SELECT name, status FROM images WHERE run_id = ? ORDER BY rowid",
+                    (run[0],),
+                ).fetchall()
+        connection.close()
+        if not run:
+            return None
+        statuses = [status for _, status in rows]
+        return {
+            "run_id": run[0],
+            "total": len(rows),
+            "pending": statuses.count("pending"),
+            "uploaded": statuses.count("uploaded"),
+            "failed": statuses.count("failed"),
+            "images": dict(rows),
+        }
+
+    def finish_run(self, run_id: int):
+        """
+        Mark a run as finished and apply retention and compression to the runs
+        of its page_name
+
+        Args:
+            run_id: Run id
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE runs SET finished_at = ? WHERE id = ?",
+                (datetime.now().isoformat(timespec="seconds"), run_id),
+            )
+            row = connection.execute(
+                "SELECT page_name FROM runs WHERE id = ?", (run_id,)
+            ).fetchone()
+        connection.close()
+        if row:
+            self.maintain(row[0])
+
+    def maintain(self, page_name: str | None = None):
+        """
+        Remove finished runs above ARTIFACT_KEEP_RUNS and compress older ones
+
+        Args:
+            page_name: Normalized page reference name, all pages if None
+        """
+        with self._connect() as connection:
+            if page_name is None:
+                page_names = [
+                    row[0]
+                    for row in connection.execute("SELECT DISTINCT page_name FROM runs")
+                ]
+            else:
+                page_names = [page_name]
+
+            for name in page_names:
+                run_ids = [
+                    row[0]
+                    for row in connection.execute(
+                        "SELECT id, finished_at FROM runs WHERE page_name = ?"
+                        " ORDER BY id DESC",
+                        (name,),
+                    )
+                    # Runs still in progress are left untouched
+                    if row[1] is not None
+                ]
+                if self.keep_runs > 0:
+                    for run_id in run_ids[self.keep_runs :]:
+                        self._evict(connection, run_id)
+                    run_ids = run_ids[: self.keep_runs]
+                if self.compress:
+                    for run_id in run_ids[1:]:
+                        self._compress(connection, run_id)
+        connection.close()
+
+    def _evict(self, connection: sqlite3.Connection, run_id: int):
+        artifacts = connection.execute(
+            "SELECT path FROM artifacts WHERE run_id = ?", (run_id,)
+        ).fetchall()
+        connection.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+        for (path,) in artifacts:
+            # md and txt files keep the same name from a run to the next
+            if not connection.execute(
+                "SELECT 1 FROM artifacts WHERE path = ?", (path,)
+            ).fetchone():
+                Path(path).unlink(missing_ok=True)
+
+    def _compress(self, connection: sqlite3.Connection, run_id: int):
+        artifacts = connection.execute(
+            "SELECT kind, path FROM artifacts WHERE run_id = ? AND compressed = 0",
+            (run_id,),
+        ).fetchall()
+        for kind, path in artifacts:
+            if kind not in COMPRESSIBLE_KINDS:
+                continue
+            # Still used by a newer run
+            if connection.execute(
+                "SELECT 1 FROM artifacts WHERE path = ? AND run_id > ?",
+                (path, run_id),
+            ).fetchone():
+                continue
+            source = Path(path)
+            if not source.exists():
+                continue
+            target = source.with_name(source.name + ".gz")
+            with open(source, "rb") as f_in, gzip.open(target, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            source.unlink()
+            connection.execute(
+                "UPDATE artifacts SET path = ?, compressed = 1 WHERE path = ?",
+                (str(target), path),
+            )
+
+
+def read_artifact(path) -> str:
+    """
+    Read an artifact, compressed or not
+
+    Args:
+        path: Artifact path
+
+    Returns:
+        Text content
+    """
+    path = Path(path)
+    if path.suffix == ".gz":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return f.read()
+    return path.read_text(encoding="utf-8")
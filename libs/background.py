@@ -0,0 +1,58 @@
+"""
+Queue of the jobs run after the response, in a worker thread of the process.
+Jobs run one at a time in submission order.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+_queue: queue.Queue = queue.Queue()
+_worker: threading.Thread | None = None
+_lock = threading.Lock()
+
+
+def submit(function, *args):
+    """
+    Run function(*args) in the background worker, started at first use
+    """
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="background-jobs", daemon=True)
+            _worker.start()
+    _queue.put((function, args))
+
+
+def _run():
+    while True:
+        function, args = _queue.get()
+        try:
+            function(*args)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                f"Background job {function.__name__} failed"
+            )
+        finally:
+            _queue.task_done()
+
+
+def join(timeout: float | None = None) -> bool:
+    """
+    Wait for the submitted jobs to finish
+
+    Args:
+        timeout: Seconds to wait at most, no limit if None
+
+    Returns:
+        True if every job finished
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _queue.all_tasks_done:
+        while _queue.unfinished_tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            _queue.all_tasks_done.wait(remaining)
+    return True
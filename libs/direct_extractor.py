@@ -0,0 +1,392 @@
+"""
+Read a PDF file in a document directly from PyMuPDF text spans and tables,
+without the Markdown intermediate of pymupdf4llm
+"""
+
+from collections import Counter
+from collections.abc import Iterator
+from libs.document import (
+    Document,
+    Heading,
+    Image,
+    ListItem,
+    Page,
+    Paragraph,
+    Table,
+    render_wikitext,
+)
+from libs.extraction import (
+    PDF_LOCK,
+    PROFILES,
+    ProfileTimings,
+    detect_margins,
+    open_pdf,
+    page_profile,
+    window_pages,
+)
+from libs.logger import log
+from libs import wiki_registry
+from pathlib import Path
+import re
+import time
+
+# Span flags of PyMuPDF
+FLAG_ITALIC = 2
+FLAG_BOLD = 16
+
+# Lines with a font this much bigger than the body text are headings
+HEADING_SIZE_RATIO = 1.15
+HEADING_MAX_LENGTH = 150
+# Number of pages read to find the body font size
+BODY_SIZE_SAMPLE_PAGES = 20
+# Images smaller than this part of the page width or height are ignored
+IMAGE_SIZE_LIMIT = 0.05
+
+NUMBERED_HEADING_PATTERN = re.compile(r"^(\d+(?:\.\d+){0,3})\.?\s+(\S.*)$")
+BULLET_PATTERN = re.compile(r"^[-•▪●◦–‣]\s*")
+
+
+def iter_pdf_pages(
+    pdf_path,
+    footer: str,
+    ignore_pages: str,
+    page_name: str,
+    image_path: str,
+    memory=None,
+    profile: str = "accurate",
+    upload: bool = True,
+    wiki: str = "",
+) -> Iterator[Page]:
+    """
+    Read a PDF file page by page and create its images on Mediawiki
+    Page seams are not merged.
+
+    Args:
+        pdf_path: PDF file path
+        footer: Reference footer, lines starting with it are removed, used
+            when headers and footers are not found by detect_margins
+        ignore_pages: ignore pages number separate by ,
+        page_name: Page reference name, used to name images
+        image_path: Folder where images are written
+        memory: MemoryGuard sizing the page windows under its RSS ceiling
+        profile: Extraction profile, one of EXTRACTION_PROFILES
+        upload: False to only write the images in image_path
+        wiki: Target wiki of the images, see wiki_registry
+
+    Yields:
+        Document pages
+    """
+    uploader = wiki_registry.get_client(wiki) if upload else None
+    if uploader and uploader.login_error:
+        log("Cant connect to mediawiki")
+
+    ignore_page_list = ignore_pages.split(",")
+    image_index = 0
+
+    with PDF_LOCK, open_pdf(pdf_path) as doc:
+        page_numbers = [
+            number
+            for number in range(doc.page_count)
+            if str(number) not in ignore_page_list
+        ]
+        # Running headers and footers are never read
+        margins = detect_margins(doc[number] for number in page_numbers)
+        heading_levels = _heading_levels(
+            [doc[number] for number in page_numbers[:BODY_SIZE_SAMPLE_PAGES]],
+            margins,
+        )
+
+    # The document is opened again for each window of pages so that the pages
+    # of the previous window and their cached objects are released
+    timings = ProfileTimings(profile)
+    window = window_pages()
+    start = 0
+    while start < len(page_numbers):
+        with open_pdf(pdf_path) as doc:
+            for number in page_numbers[start : start + window]:
+                # The lock is not held during uploads and while the page is
+                # used by the caller
+                with PDF_LOCK:
+                    page = doc[number]
+                    clip = _clip(page, margins)
+                    number_profile = page_profile(page, profile, clip)
+                    page_start = time.perf_counter()
+                    document_page, image_index = _read_page(
+                        doc,
+                        page,
+                        clip,
+                        footer,
+                        page_name,
+                        image_path,
+                        image_index,
+                        heading_levels,
+                        PROFILES[number_profile],
+                    )
+                    del page
+                timings.add(time.perf_counter() - page_start, number, number_profile)
+                for node in document_page.nodes:
+                    if uploader and isinstance(node, Image):
+                        uploader.upload_image(node.source, "")
+                yield document_page
+        start += window
+        if memory is not None and start < len(page_numbers):
+            window = memory.next_window(window)
+    timings.log()
+
+
+def pdf_to_document(
+    pdf_path,
+    footer: str,
+    ignore_pages: str,
+    page_name: str,
+    image_path: str,
+    memory=None,
+    profile: str = "accurate",
+    upload: bool = True,
+    wiki: str = "",
+) -> Document:
+    """
+    Read a PDF file in a document and create its images on Mediawiki
+    Arguments are the ones of iter_pdf_pages.
+
+    Returns:
+        Document
+    """
+    document = Document(
+        list(
+            iter_pdf_pages(
+                pdf_path,
+                footer,
+                ignore_pages,
+                page_name,
+                image_path,
+                memory,
+                profile,
+                upload,
+                wiki,
+            )
+        )
+    )
+    document.merge_page_seams()
+    return document
+
+
+def pdf_to_wikitext(
+    pdf_path,
+    footer: str,
+    ignore_pages: str,
+    page_name: str,
+    image_path: str,
+) -> str:
+    """
+    Transform a PDF file to wikitext and create its images on Mediawiki
+
+    Returns:
+        wikitext
+    """
+    document = pdf_to_document(pdf_path, footer, ignore_pages, page_name, image_path)
+    return render_wikitext(document.nodes())
+
+
+def _clip(page, margins):
+    """
+    Part of the page inside the margins
+    """
+    left, top, right, bottom = margins
+    return page.rect + (left, top, -right, -bottom)
+
+
+def _heading_levels(pages, margins) -> dict[float, int]:
+    """
+    Find body font size and give a heading level to each bigger size
+
+    Returns:
+        font size -> heading level (2 for the biggest)
+    """
+    sizes = Counter()
+    for page in pages:
+        for block in page.get_text("dict", clip=_clip(page, margins))["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    text = span["text"].strip()
+                    if text:
+                        sizes[round(span["size"], 1)] += len(text)
+    if not sizes:
+        return {}
+    body_size = sizes.most_common(1)[0][0]
+    heading_sizes = sorted(
+        (size for size in sizes if size >= body_size * HEADING_SIZE_RATIO),
+        reverse=True,
+    )
+    return {size: min(2 + rank, 6) for rank, size in enumerate(heading_sizes)}
+
+
+def _read_page(
+    doc,
+    page,
+    clip,
+    footer: str,
+    page_name: str,
+    image_path: str,
+    image_index: int,
+    heading_levels: dict[float, int],
+    settings: dict = PROFILES["accurate"],
+) -> tuple[Page, int]:
+    """
+    Read the nodes inside the clip rectangle of a page in reading order
+    Tables and images are read when the settings of the page profile ask for
+    them.
+
+    Returns:
+        Tuple (document page, next image index)
+    """
+    # (top, left, nodes)
+    items = []
+
+    tables = page.find_tables(clip=clip).tables if settings["tables"] else []
+    table_rects = [table.bbox for table in tables]
+    if tables:
+        words = page.get_text("words", clip=clip)
+        for table in tables:
+            node = _table(table, words)
+            if node:
+                items.append((table.bbox[1], table.bbox[0], [node]))
+
+    for block in page.get_text("dict", clip=clip)["blocks"]:
+        if block["type"] != 0 or _inside(block["bbox"], table_rects):
+            continue
+        nodes = _text_block(block, footer, heading_levels)
+        if nodes:
+            items.append((block["bbox"][1], block["bbox"][0], nodes))
+
+    seen_xrefs = set()
+    image_infos = page.get_image_info(xrefs=True) if settings["images"] else []
+    for image in image_infos:
+        xref = image["xref"]
+        x0, y0, x1, y1 = image["bbox"]
+        if not xref or xref in seen_xrefs or not _inside(image["bbox"], [clip]):
+            continue
+        if (
+            x1 - x0 < page.rect.width * IMAGE_SIZE_LIMIT
+            or y1 - y0 < page.rect.height * IMAGE_SIZE_LIMIT
+        ):
+            continue
+        seen_xrefs.add(xref)
+        dest_name = f"{page_name} {image_index}.png"
+        _save_image(doc, xref, image_path + dest_name)
+        image_index += 1
+        items.append((y0, x0, [Image(image_path + dest_name, dest_name)]))
+
+    items.sort(key=lambda item: (round(item[0]), item[1]))
+    page_nodes = [node for _, _, nodes in items for node in nodes]
+    return Page(page.number, page_nodes), image_index
+
+
+def _inside(bbox, rects) -> bool:
+    x0, y0, x1, y1 = bbox
+    center_x, center_y = (x0 + x1) / 2, (y0 + y1) / 2
+    return any(
+        rect[0] <= center_x <= rect[2] and rect[1] <= center_y <= rect[3]
+        for rect in rects
+    )
+
+
+def _text_block(block, footer: str, heading_levels: dict[float, int]) -> list:
+    """
+    Transform a text block to a paragraph, a list item or headings
+
+    Returns:
+        List of nodes, empty if the block is empty or a footer
+    """
+    lines = []
+    nodes = []
+    for line in block["lines"]:
+        spans = [span for span in line["spans"] if span["text"].strip()]
+        if not spans:
+            continue
+        plain = "".join(span["text"] for span in line["spans"]).strip()
+        if footer and plain.startswith(footer):
+            continue
+
+        bold = all(span["flags"] & FLAG_BOLD for span in spans)
+        size = max(round(span["size"], 1) for span in spans)
+        numbered = NUMBERED_HEADING_PATTERN.match(plain)
+        if bold and numbered and len(plain) <= HEADING_MAX_LENGTH:
+            level = min(numbered.group(1).count(".") + 2, 6)
+            nodes.append(Heading(level, f"{numbered.group(1)} {numbered.group(2)}"))
+        elif size in heading_levels and len(plain) <= HEADING_MAX_LENGTH:
+            nodes.append(Heading(heading_levels[size], plain))
+        else:
+            lines.append(_inline(line["spans"]))
+
+    text = " ".join(lines).strip()
+    text = re.sub(r"\s{2,}", " ", text).replace("–", "-")
+    if not text:
+        return nodes
+    if not nodes and BULLET_PATTERN.match(text):
+        nodes.append(ListItem(BULLET_PATTERN.sub("", text, count=1)))
+    else:
+        nodes.append(Paragraph(text))
+    return nodes
+
+
+def _inline(spans) -> str:
+    """
+    Join spans of a line, bold and italic spans become wikitext quotes
+    """
+    parts = []
+    for span in spans:
+        text = span["text"]
+        stripped = text.strip()
+        if not stripped:
+            parts.append(text)
+            continue
+        quotes = ""
+        if span["flags"] & FLAG_BOLD:
+            quotes += "'''"
+        if span["flags"] & FLAG_ITALIC:
+            quotes += "''"
+        if quotes:
+            start = text[: len(text) - len(text.lstrip())]
+            end = text[len(text.rstrip()) :]
+            text = f"{start}{quotes}{stripped}{quotes}{end}"
+        parts.append(text)
+    # Adjacent bold spans
+    return re.sub(r"'''(\s*)'''", r"\1", "".join(parts))
+
+
+def _table(table, words) -> Table | None:
+    """
+    Transform a PyMuPDF table to a table node, cell text is rebuilt from words
+    to keep their spacing
+    """
+    rows = []
+    for row in table.rows:
+        cells = []
+        for cell in row.cells:
+            if cell is None:
+                cells.append("")
+                continue
+            x0, y0, x1, y1 = cell
+            cells.append(
+                " ".join(
+                    word[4]
+                    for word in words
+                    if x0 <= (word[0] + word[2]) / 2 <= x1
+                    and y0 <= (word[1] + word[3]) / 2 <= y1
+                )
+            )
+        rows.append(cells)
+    if not rows:
+        return None
+    return Table(rows[0], rows[1:])
+
+
+def _save_image(doc, xref: int, image_dest: str):
+    import fitz
+
+    Path(image_dest).parent.mkdir(parents=True, exist_ok=True)
+    pixmap = fitz.Pixmap(doc, xref)
+    if pixmap.n - pixmap.alpha > 3:
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    pixmap.save(image_dest)
@@ -0,0 +1,255 @@
+"""
+In memory model of a converted document
+Extractors build it once, wikitext and Markdown are rendered from it and
+annotation and section splitting walk its nodes instead of re-parsing text.
+Inline text of nodes holds wikitext quotes ('''bold''', ''italic'').
+"""
+
+import re
+
+
+class Heading:
+    __slots__ = ("level", "text")
+
+    def __init__(self, level: int, text: str):
+        self.level = level
+        self.text = text
+
+
+class Paragraph:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class ListItem:
+    __slots__ = ("text", "depth")
+
+    def __init__(self, text: str, depth: int = 1):
+        self.text = text
+        self.depth = depth
+
+
+class Table:
+    __slots__ = ("header", "rows")
+
+    def __init__(self, header: list[str], rows: list[list[str]]):
+        self.header = header
+        self.rows = rows
+
+
+class Image:
+    __slots__ = ("source", "name")
+
+    def __init__(self, source: str, name: str = ""):
+        # File written by the extractor
+        self.source = source
+        # File name on Mediawiki, given by Document.name_images
+        self.name = name
+
+
+Node = Heading | Paragraph | ListItem | Table | Image
+
+
+class Page:
+    __slots__ = ("number", "nodes")
+
+    def __init__(self, number: int, nodes: list[Node] | None = None):
+        self.number = number
+        self.nodes = nodes if nodes is not None else []
+
+
+class Document:
+    __slots__ = ("pages",)
+
+    def __init__(self, pages: list[Page] | None = None):
+        self.pages = pages if pages is not None else []
+
+    def nodes(self):
+        """
+        Iterate over the nodes of all pages
+        """
+        for page in self.pages:
+            yield from page.nodes
+
+    def images(self) -> list[Image]:
+        return [node for node in self.nodes() if isinstance(node, Image)]
+
+    def name_images(self, page_name: str, start: int = 0) -> int:
+        """
+        Give each image its Mediawiki file name "<page_name> <index>.png"
+
+        Args:
+            page_name: Page reference name
+            start: Index of the first image
+
+        Returns:
+            Index of the next image
+        """
+        for image in self.images():
+            image.name = f"{page_name} {start}.png"
+            start += 1
+        return start
+
+    def merge_page_seams(self):
+        """
+        Join a paragraph cut by a page break with its end on the next page
+        """
+        merger = SeamMerger()
+        for page in self.pages:
+            merger.add(page)
+
+    def sections(self) -> list[list[Node]]:
+        """
+        Split nodes before each heading
+
+        Returns:
+            List of sections, each a list of nodes
+        """
+        sections: list[list[Node]] = []
+        for node in self.nodes():
+            if isinstance(node, Heading) or not sections:
+                sections.append([])
+            sections[-1].append(node)
+        return sections
+
+
+class SeamMerger:
+    """
+    Merge the page seams of pages read one at a time, in page order.
+    A page is complete once the next page with nodes is read: its last
+    paragraph can't change anymore.
+    """
+
+    __slots__ = ("previous", "pending")
+
+    def __init__(self):
+        # Last page with nodes
+        self.previous: Page | None = None
+        # Pages read since previous, previous included
+        self.pending: list[Page] = []
+
+    def add(self, page: Page) -> list[Page]:
+        """
+        Add the next page
+
+        Returns:
+            Pages completed by this page
+        """
+        previous = self.previous
+        if previous is not None and previous.nodes and page.nodes:
+            last, first = previous.nodes[-1], page.nodes[0]
+            if (
+                isinstance(last, Paragraph)
+                and isinstance(first, Paragraph)
+                and continues(last.text, first.text, seam=True)
+            ):
+                last.text += " " + first.text
+                del page.nodes[0]
+        completed = []
+        if page.nodes:
+            completed, self.pending = self.pending, []
+            self.previous = page
+        self.pending.append(page)
+        return completed
+
+    def flush(self) -> list[Page]:
+        """
+        Pages left at the end of the document
+        """
+        completed, self.pending = self.pending, []
+        return completed
+
+
+def continues(previous: str, text: str, seam: bool = False) -> bool:
+    """
+    Tell if a line is the continuation of the previous paragraph
+
+    Args:
+        previous: Text of the previous paragraph
+        text: Text of the line
+        seam: True when the line starts a new page, only a lower case start
+            continues a sentence there
+    """
+    if not previous or not text:
+        return False
+    if not (previous[-1].isalpha() or previous[-1] == ","):
+        return False
+    return text[0].islower() if seam else text[0].isalpha()
+
+
+def render_wikitext(nodes) -> str:
+    """
+    Render nodes as wikitext
+    Blocks are separated by a blank line, a heading starts on the next line
+    """
+    parts = []
+    for node in nodes:
+        if parts:
+            parts.append("\n" if isinstance(node, Heading) else "\n\n")
+        parts.append(_node_wikitext(node))
+    return "".join(parts)
+
+
+def _node_wikitext(node: Node) -> str:
+    if isinstance(node, Heading):
+        marks = "=" * node.level
+        return f"{marks} {node.text} {marks}"
+    if isinstance(node, Paragraph):
+        return node.text
+    if isinstance(node, ListItem):
+        return "*" * node.depth + " " + node.text
+    if isinstance(node, Table):
+        return rows_to_wikitable(node.header, node.rows)
+    return f"[[File:{node.name}|center|thumb]]"
+
+
+def rows_to_wikitable(header_cells: list[str], rows: list[list[str]]) -> str:
+    """
+    Construct a wikitable from header and lines cells.
+    """
+    result = ['{| class="wikitable"']
+
+    # Add header
+    result.append("! " + " !! ".join(header_cells))
+
+    # Add lines
+    for cells in rows:
+        result.append("|-")
+        result.append(("| " + " || ".join(cells)).rstrip())
+
+    result.append("|}")
+
+    return "\n".join(result)
+
+
+def render_markdown(document: Document) -> str:
+    """
+    Render a document as Markdown with page separators
+    """
+    pages = []
+    for page in document.pages:
+        nodes = "\n\n".join(_node_markdown(node) for node in page.nodes)
+        pages.append(f"{nodes}\n\n--- end of page={page.number} ---\n\n")
+    return "".join(pages)
+
+
+def _node_markdown(node: Node) -> str:
+    if isinstance(node, Heading):
+        return "#" * node.level + " " + _inline_markdown(node.text)
+    if isinstance(node, Paragraph):
+        return _inline_markdown(node.text)
+    if isinstance(node, ListItem):
+        return "  " * (node.depth - 1) + "- " + _inline_markdown(node.text)
+    if isinstance(node, Table):
+        lines = ["|" + "|".join(node.header) + "|"]
+        lines.append("|" + "---|" * len(node.header))
+        lines += ["|" + "|".join(cells) + "|" for cells in node.rows]
+        return "\n".join(lines)
+    return f"![]({node.name or node.source})"
+
+
+def _inline_markdown(text: str) -> str:
+    text = re.sub(r"'''(.+?)'''", r"**\1**", text)
+    return re.sub(r"''(.+?)''", r"_\1_", text)
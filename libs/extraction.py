@@ -0,0 +1,283 @@
+"""
+Extraction of PDF content
+pymupdf4llm and fitz are heavy to import, they are imported at first use so
+that endpoints and tools that never read a PDF don't pay for them
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+from libs.logger import log
+import math
+import os
+import re
+import threading
+import time
+
+# Part of the page height searched for headers (top) and footers (bottom)
+MARGIN_BAND = 0.1
+# A block is a header or footer when it is on this part of the pages
+MARGIN_REPEAT_RATIO = 0.5
+# Number of pages read to find headers and footers
+MARGIN_SAMPLE_PAGES = 50
+# Extra space kept between the margin and the header or footer, in points
+MARGIN_PADDING = 1
+# Default number of pages extracted at a time
+WINDOW_PAGES = 50
+
+# Extraction settings of a page
+# tables: table detection, the most expensive step
+# images: images written and referenced
+# graphics: vector graphics analysis (boxes, lines, text in graphics)
+PROFILES = {
+    "accurate": {"tables": True, "images": True, "graphics": True},
+    "fast": {"tables": False, "images": False, "graphics": False},
+    # Pages of the auto profile without vector paths can't have ruled tables
+    "no_tables": {"tables": False, "images": True, "graphics": True},
+}
+# Profiles of a request, auto selects accurate or no_tables page by page
+EXTRACTION_PROFILES = ("accurate", "fast", "auto")
+# Slowest pages written in the log
+SLOWEST_PAGES = 5
+
+# PyMuPDF is not thread-safe: the conversions running in the threads of the
+# server hold this lock for each call to fitz or pymupdf4llm
+PDF_LOCK = threading.RLock()
+
+
+def preload():
+    """
+    Import PDF libraries in advance, used to warm up a worker at startup
+    """
+    import fitz  # noqa: F401
+    import pymupdf4llm  # noqa: F401
+
+
+def _normalize_block_text(text: str) -> str:
+    # Page numbers and dates change from page to page
+    return re.sub(r"\d+", "#", " ".join(text.split()).lower())
+
+
+def detect_margins(pages) -> tuple[float, float, float, float]:
+    """
+    Find running headers and footers: text blocks repeated at the same
+    position near the top or the bottom of the pages
+
+    Args:
+        pages: PyMuPDF pages
+
+    Returns:
+        Margins (left, top, right, bottom) in points, excluding headers and
+        footers. 0 when nothing repeats.
+
+    Env:
+        MARGIN_DETECTION: "false" to disable detection
+    """
+    pages = list(islice(pages, MARGIN_SAMPLE_PAGES))
+    if os.getenv("MARGIN_DETECTION") == "false" or len(pages) < 2:
+        return (0, 0, 0, 0)
+
+    # (side, margin, text) -> number of pages
+    counts = Counter()
+    for page in pages:
+        height = page.rect.height
+        keys = set()
+        for x0, y0, x1, y1, text, *_ in page.get_text("blocks"):
+            text = _normalize_block_text(text)
+            if not text:
+                continue
+            if y1 - page.rect.y0 <= height * MARGIN_BAND:
+                keys.add(("top", round(y1 - page.rect.y0), text))
+            elif page.rect.y1 - y0 <= height * MARGIN_BAND:
+                keys.add(("bottom", round(page.rect.y1 - y0), text))
+        counts.update(keys)
+
+    min_pages = max(2, math.ceil(len(pages) * MARGIN_REPEAT_RATIO))
+    top = bottom = 0
+    for (side, margin, _), count in counts.items():
+        if count < min_pages:
+            continue
+        if side == "top":
+            top = max(top, margin + MARGIN_PADDING)
+        else:
+            bottom = max(bottom, margin + MARGIN_PADDING)
+
+    if top or bottom:
+        log(f"Header and footer margins: top {top}pt, bottom {bottom}pt")
+    return (0, top, 0, bottom)
+
+
+def page_profile(page, profile: str, clip=None) -> str:
+    """
+    Extraction profile of a page
+
+    Args:
+        page: PyMuPDF page
+        profile: Profile of the request, one of EXTRACTION_PROFILES
+        clip: Part of the page extracted, whole page if None
+
+    Returns:
+        Key of PROFILES
+    """
+    if profile != "auto":
+        return profile
+    clip = clip or page.rect
+    for kind, bbox in page.get_bboxlog():
+        if kind.endswith("path") and clip.intersects(bbox):
+            return "accurate"
+    return "no_tables"
+
+
+class ProfileTimings:
+    """
+    Extraction time of each page, by profile
+    """
+
+    def __init__(self, profile: str):
+        self.profile = profile
+        # (seconds, page number, page profile)
+        self.pages: list[tuple[float, int, str]] = []
+
+    def add(self, seconds: float, number: int, profile: str):
+        self.pages.append((seconds, number, profile))
+
+    def log(self):
+        by_profile: dict[str, list[float]] = {}
+        for seconds, _, profile in self.pages:
+            by_profile.setdefault(profile, []).append(seconds)
+        for profile, seconds in by_profile.items():
+            log(
+                f"Extraction profile {self.profile}: {len(seconds)} pages {profile}"
+                f" in {sum(seconds):.3f}s, {sum(seconds) / len(seconds):.4f}s/page"
+            )
+        for seconds, number, profile in sorted(self.pages, reverse=True)[
+            :SLOWEST_PAGES
+        ]:
+            log(f"Page {number} extracted in {seconds:.4f}s ({profile})")
+
+
+@contextmanager
+def open_pdf(pdf_path):
+    """
+    Open a PDF file under PDF_LOCK. The lock is released while the document
+    is open, each use of the document must hold it.
+
+    Args:
+        pdf_path: PDF file path
+
+    Yields:
+        fitz document, closed at the end of the block
+    """
+    import fitz
+
+    with PDF_LOCK:
+        doc = fitz.open(pdf_path)
+    try:
+        yield doc
+    finally:
+        with PDF_LOCK:
+            doc.close()
+
+
+def _markdown_options(profile: str) -> dict:
+    """
+    pymupdf4llm.to_markdown arguments of a profile
+    """
+    settings = PROFILES[profile]
+    return {
+        "table_strategy": "lines_strict" if settings["tables"] else None,
+        "write_images": settings["images"],
+        "ignore_images": not settings["images"],
+        "ignore_graphics": not settings["graphics"],
+    }
+
+
+def window_pages() -> int:
+    """
+    Number of pages extracted at a time
+
+    Env:
+        EXTRACTION_WINDOW_PAGES: Pages per window, 50 by default
+    """
+    return max(1, int(os.getenv("EXTRACTION_WINDOW_PAGES") or WINDOW_PAGES))
+
+
+def iter_markdown(pdf_path, image_path: str, memory=None, profile="accurate"):
+    """
+    Transform a PDF file to Markdown window by window and store its images
+    The document is opened again for each window so that the pages of the
+    previous window and their cached objects are released.
+    Running headers and footers are left out of the extraction.
+    Pages are extracted one by one with the settings of their profile, the
+    time per page and profile is written in the log at the end.
+
+    Args:
+        pdf_path: PDF file path
+        image_path: Folder where images are written
+        memory: MemoryGuard sizing the windows under its RSS ceiling
+        profile: Extraction profile, one of EXTRACTION_PROFILES
+
+    Yields:
+        Markdown text of a page with its page separator
+    """
+    import pymupdf4llm
+
+    with PDF_LOCK, open_pdf(pdf_path) as doc:
+        page_count = doc.page_count
+        margins = detect_margins(doc)
+        # Heading font sizes of the whole document, read once for all windows
+        headers = pymupdf4llm.IdentifyHeaders(doc)
+
+    timings = ProfileTimings(profile)
+    window = window_pages()
+    start = 0
+    while start < page_count:
+        end = min(start + window, page_count)
+        with open_pdf(pdf_path) as doc:
+            for number in range(start, end):
+                # The lock is not held while the page is used by the caller
+                with PDF_LOCK:
+                    page = doc[number]
+                    left, top, right, bottom = margins
+                    clip = page.rect + (left, top, -right, -bottom)
+                    number_profile = page_profile(page, profile, clip)
+                    page_start = time.perf_counter()
+                    markdown = pymupdf4llm.to_markdown(
+                        doc,
+                        pages=[number],
+                        hdr_info=headers,
+                        image_path=image_path,
+                        page_separators=True,
+                        margins=margins,
+                        **_markdown_options(number_profile),
+                    )
+                    del page
+                timings.add(time.perf_counter() - page_start, number, number_profile)
+                yield markdown
+        start = end
+        if memory is not None and start < page_count:
+            window = memory.next_window(window)
+    timings.log()
+
+
+def page_count(pdf_path) -> int:
+    """
+    Number of pages of a PDF file
+    """
+    with PDF_LOCK, open_pdf(pdf_path) as doc:
+        return doc.page_count
+
+
+def pdf_to_markdown(pdf_path, image_path: str, profile="accurate") -> str:
+    """
+    Transform a PDF file to Markdown and store its images
+
+    Args:
+        pdf_path: PDF file path
+        image_path: Folder where images are written
+        profile: Extraction profile, one of EXTRACTION_PROFILES
+
+    Returns:
+        Markdown text with page separators
+    """
+    return "".join(iter_markdown(pdf_path, image_path, profile=profile))
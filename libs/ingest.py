@@ -0,0 +1,139 @@
+"""
+Ingestion of uploaded PDF files
+The upload is read once by fixed size chunks: it is written to disk while its
+SHA-256 and size are computed, so later stages never read it again to hash or
+measure it. Files above the size limit are rejected as soon as the limit is
+passed, and from their Content-Length before the body is read.
+"""
+
+from fastapi.responses import JSONResponse
+from pathlib import Path
+from typing import NamedTuple
+import hashlib
+import os
+
+CHUNK_SIZE = 1024 * 1024
+PDF_MAGIC = b"%PDF-"
+# PDF readers accept a header anywhere in the first 1024 bytes
+MAGIC_SEARCH_BYTES = 1024
+# Default size limit of an upload in MiB
+MAX_UPLOAD_MB = 200
+# Form fields and multipart boundaries sent with the file
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+
+class IngestError(Exception):
+    """
+    Upload rejected, with the HTTP status to answer
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Upload(NamedTuple):
+    path: Path
+    sha256: str
+    size: int
+    page_count: int
+
+
+def max_upload_bytes() -> int:
+    """
+    Size limit of an upload in bytes, 0 for no limit
+
+    Env:
+        MAX_UPLOAD_MB: Size limit in MiB, 200 by default, 0 for no limit
+    """
+    return int(float(os.getenv("MAX_UPLOAD_MB") or MAX_UPLOAD_MB) * 1024 * 1024)
+
+
+def save_upload(source, dest: Path, max_bytes: int | None = None) -> Upload:
+    """
+    Write an uploaded PDF file to disk, computing its SHA-256 and size in the
+    same pass, then read its page count
+
+    Args:
+        source: Binary file object of the upload
+        dest: File written
+        max_bytes: Size limit in bytes, max_upload_bytes() if None
+
+    Returns:
+        Upload
+
+    Raises:
+        IngestError: 413 above the size limit, 400 when the file is not a PDF
+            file. dest is removed.
+    """
+    if max_bytes is None:
+        max_bytes = max_upload_bytes()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest, "wb") as f:
+            while chunk := source.read(CHUNK_SIZE):
+                if size == 0 and PDF_MAGIC not in chunk[:MAGIC_SEARCH_BYTES]:
+                    raise IngestError(400, "File is not a PDF file")
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise IngestError(413, _too_large(max_bytes))
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise IngestError(400, "File is empty")
+        page_count = _page_count(dest)
+    except BaseException:
+        dest.unlink(missing_ok=True)
+        raise
+    return Upload(dest, digest.hexdigest(), size, page_count)
+
+
+def _too_large(max_bytes: int) -> str:
+    return f"File is larger than {max_bytes / (1024 * 1024):.3g} MiB"
+
+
+def _page_count(path: Path) -> int:
+    # Only the trailer and the page tree are read
+    from libs.extraction import PDF_LOCK, open_pdf
+
+    try:
+        with PDF_LOCK, open_pdf(path) as doc:
+            page_count = doc.page_count
+    except Exception:
+        raise IngestError(400, "File is not a readable PDF file")
+    if not page_count:
+        raise IngestError(400, "PDF file has no page")
+    return page_count
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware answering 413 to uploads whose Content-Length is above
+    the size limit, before their body is read
+
+    Args:
+        app: ASGI application
+        paths: Paths of the upload endpoints
+    """
+
+    def __init__(self, app, paths: tuple[str, ...]):
+        self.app = app
+        self.paths = {path.rstrip("/") for path in paths}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].rstrip("/") in self.paths:
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            max_bytes = max_upload_bytes()
+            if (
+                max_bytes
+                and length.isdigit()
+                and int(length) > max_bytes + FORM_OVERHEAD_BYTES
+            ):
+                response = JSONResponse(
+                    {"detail": _too_large(max_bytes)}, status_code=413
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,96 @@
+"""
+Incremental reading of log files with a byte offset cursor
+"""
+
+from pathlib import Path
+import asyncio
+import mmap
+import re
+
+# Above this amount of unread bytes the file is memory mapped instead of read
+MMAP_THRESHOLD = 1024 * 1024
+# Maximum amount of bytes returned by one read
+MAX_READ_BYTES = 4 * 1024 * 1024
+
+STEP_PATTERN = re.compile(r" - STEP \d+: ")
+
+
+def read_from_offset(file_path, offset: int = 0, max_bytes: int = MAX_READ_BYTES):
+    """
+    Read the complete lines of a file written after a byte offset. A line
+    longer than max_bytes is returned in parts.
+
+    Args:
+        file_path: Log file path
+        offset: Byte offset already read by the client
+        max_bytes: Maximum number of bytes to return
+
+    Returns:
+        Tuple (new content, next offset)
+    """
+    file_path = Path(file_path)
+    size = file_path.stat().st_size
+    if offset < 0 or offset > size:
+        # File has been replaced, restart from the beginning
+        offset = 0
+    end = min(size, offset + max_bytes)
+    if end == offset:
+        return "", offset
+
+    with open(file_path, "rb") as f:
+        if end - offset > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Only return complete lines, the end may still be written
+                last_newline = mapped.rfind(b"\n", offset, end)
+                if last_newline != -1:
+                    end = last_newline + 1
+                elif end - offset < max_bytes:
+                    return "", offset
+                data = mapped[offset:end]
+        else:
+            f.seek(offset)
+            data = f.read(end - offset)
+            last_newline = data.rfind(b"\n")
+            if last_newline != -1:
+                data = data[: last_newline + 1]
+            elif len(data) < max_bytes:
+                return "", offset
+
+    return data.decode("utf-8", errors="replace"), offset + len(data)
+
+
+async def follow(
+    file_path,
+    offset: int = 0,
+    steps_only: bool = True,
+    poll_interval: float = 0.5,
+    idle_timeout: float = 30,
+):
+    """
+    Follow a log file and yield new lines as they are written
+
+    Args:
+        file_path: Log file path
+        offset: Byte offset to start from
+        steps_only: Only yield log_step lines
+        poll_interval: Seconds between two reads of the file
+        idle_timeout: Stop after this many seconds without new line
+
+    Yields:
+        Tuple (line, offset after the line)
+    """
+    idle = 0.0
+    while idle < idle_timeout:
+        content, next_offset = read_from_offset(file_path, offset)
+        if not content:
+            await asyncio.sleep(poll_interval)
+            idle += poll_interval
+            continue
+
+        idle = 0.0
+        for line in content.splitlines(keepends=True):
+            offset += len(line.encode("utf-8"))
+            if steps_only and not STEP_PATTERN.search(line):
+                continue
+            yield line.rstrip("\n"), offset
+        offset = next_offset
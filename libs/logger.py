@@ -1,22 +1,39 @@
 import logging
+from contextvars import ContextVar
 from pathlib import Path
 from datetime import datetime
+import time
 
-# Global variable for logger
-_logger = None
-_step = 1
+# Logger of the current run, one per request context so that concurrent
+# conversions running in the threadpool write to their own file
+_context: ContextVar["_LogContext | None"] = ContextVar("log_context", default=None)
 
 
-def init_logger(log_name: str, log_dir: str = "logs"):
+class _LogContext:
+    __slots__ = ("logger", "handler", "log_file", "step", "timings")
+
+    def __init__(self, logger: logging.Logger, handler: logging.Handler, log_file):
+        self.logger = logger
+        self.handler = handler
+        self.log_file = log_file
+        self.step = 1
+        # (step, message, start time) of each log_step
+        self.timings = []
+
+
+def init_logger(log_name: str, log_dir: str = "logs") -> Path:
     """
     Initialise logger at start
 
     Args:
         log_name: File name
         log_dir: File Folder
+
+    Returns:
+        Path of the log file
     """
-    global _logger
-    global _step
+    # Close logger of a previous run in the same context
+    close_logger()
 
     # Create folder if not exist
     Path(log_dir).mkdir(parents=True, exist_ok=True)
@@ -25,15 +42,36 @@ def init_logger(log_name: str, log_dir: str = "logs"):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     log_file = Path(log_dir) / f"{log_name}_{timestamp}.log"
 
-    # Configuration of logger
-    _logger = logging.getLogger("app")
-    _logger.setLevel(logging.INFO)
-    _step = 1
+    # Configuration of logger, not registered in logging manager so that it is
+    # released with the run
+    logger = logging.Logger(f"app.{log_file.stem}", logging.INFO)
 
     # Handler file
     handler = logging.FileHandler(log_file, encoding="utf-8")
     handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
-    _logger.addHandler(handler)
+    logger.addHandler(handler)
+
+    _context.set(_LogContext(logger, handler, log_file))
+    return log_file
+
+
+def close_logger():
+    """
+    Close the log file of the current run
+    """
+    context = _context.get()
+    if context is None:
+        return
+    context.logger.removeHandler(context.handler)
+    context.handler.close()
+    _context.set(None)
+
+
+def _get_context() -> _LogContext:
+    context = _context.get()
+    if context is None:
+        raise RuntimeError("Logger not initialize. Call init_logger() First.")
+    return context
 
 
 def log(message: str):
@@ -43,9 +81,7 @@ def log(message: str):
     Args:
         message: Message to log
     """
-    if _logger is None:
-        raise RuntimeError("Logger not initialize. Call init_logger() First.")
-    _logger.info(message)
+    _get_context().logger.info(message)
 
 
 def log_step(message):
@@ -55,9 +91,22 @@ def log_step(message):
     Args:
         message: Message to log
     """
-    global _step
+    context = _get_context()
+    context.logger.info(f"STEP {context.step}: {message}")
+    context.timings.append((context.step, message, time.perf_counter()))
+    context.step += 1
 
-    if _logger is None:
-        raise RuntimeError("Logger not initialize. Call init_logger() First.")
-    _logger.info(f"STEP {_step}: {message}")
-    _step += 1
+
+def get_step_timings() -> list[dict]:
+    """
+    Get the duration of each step of the current run
+
+    Returns:
+        List of {step, message, seconds}, the last step is measured until now
+    """
+    timings = _get_context().timings
+    ends = [start for _, _, start in timings[1:]] + [time.perf_counter()]
+    return [
+        {"step": step, "message": message, "seconds": round(end - start, 4)}
+        for (step, message, start), end in zip(timings, ends)
+    ]
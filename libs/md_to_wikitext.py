@@ -1,140 +1,350 @@
+import os
 import re
+from collections.abc import Iterable, Iterator
+from libs.document import (
+    Document,
+    Heading,
+    Image,
+    ListItem,
+    Page,
+    Paragraph,
+    SeamMerger,
+    Table,
+    continues,
+    render_wikitext,
+)
+from libs import wiki_registry
 from libs.logger import log
 from libs.mediawiki_api import MediaWikiApi
 from pathlib import Path
+from typing import NamedTuple
 
+PAGE_SEPARATOR_PATTERN = re.compile(r"^--- end of page=\d+ ---$")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\|[-:\s|]+\|$")
+# **1** **text**, **1.1** **text**, **1.1.1** **text**
+NUMBERED_HEADING_PATTERN = re.compile(
+    r"^\*\*(\d+(?:\.\d+){0,2})\*\*\s+\*\*([^*]+)\*\*$"
+)
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+)$")
+BOLD_PATTERN = re.compile(r"\*\*([^*]+)\*\*")
+IMAGE_PATTERN = re.compile(r"!\[\]\((.*?)\)")
 
-def convert_table_to_wikitable(table_text: str) -> str:
+
+def _table_cells(line: str) -> list[str]:
+    return [cell.strip() for cell in line.split("|") if cell.strip()]
+
+
+def _inline(line: str) -> str:
+    # Rule 1: _Text_ -> ''Text''
+    line = re.sub(r"^_(.+?)_$", r"''\1''", line)
+    # Rule 6: **Text** -> '''Text'''
+    return BOLD_PATTERN.sub(r"'''\1'''", line)
+
+
+def _markdown_heading(marks: str, text: str) -> Heading:
     """
-    Convert a Markdown table to a wikitable.
+    Build the heading of a Markdown # line.
+
+    Env:
+        NORMALIZE_HEADINGS: "true" to shift # headings one level down without
+            bold (# **Text** -> == Text ==), as in the direct extractor, since
+            level 1 is the page title on Mediawiki. Default "false".
     """
-    lines = table_text.strip().split("\n")
-    if len(lines) < 2:
-        return table_text
+    if (os.getenv("NORMALIZE_HEADINGS") or "false") == "true":
+        return Heading(min(len(marks) + 1, 6), BOLD_PATTERN.sub(r"\1", text))
+    return Heading(len(marks), _inline(text))
 
-    # header extraction
-    header = lines[0]
-    # Ignore separate line  (|---|---|)
-    # Datas start at line 2
-    data_lines = lines[2:] if len(lines) > 2 else []
 
-    # Parse header
-    header_cells = [cell.strip() for cell in header.split("|") if cell.strip()]
+def parse_markdown_page(number: int, markdown: str, footer: str) -> Page:
+    """
+    Parse the Markdown of a page.
+    """
+    page = Page(number)
+    nodes = page.nodes
+    footer_pattern = (
+        re.compile(f"{re.escape(footer)} \\*\\*(.+?)\\*\\*") if footer else None
+    )
+    lines = markdown.split("\n")
+    index = 0
+    while index < len(lines):
+        # Remove strat whitespace
+        line = lines[index].lstrip().replace("–", "-")
+        index += 1
+        if not line:
+            continue
 
-    # Construct wikitable
-    result = ['{| class="wikitable"']
+        if footer_pattern and footer_pattern.search(line):
+            continue
 
-    # Add header
-    result.append("! " + " !! ".join(header_cells))
+        # Table: header, separate line (|---|---|) and datas
+        if (
+            line.startswith("|")
+            and index < len(lines)
+            and TABLE_SEPARATOR_PATTERN.match(lines[index].strip())
+        ):
+            rows = []
+            index += 1
+            while index < len(lines) and lines[index].lstrip().startswith("|"):
+                cells = _table_cells(lines[index])
+                if cells:
+                    rows.append(cells)
+                index += 1
+            nodes.append(Table(_table_cells(line), rows))
+            continue
 
-    # Add lines
-    for line in data_lines:
-        cells = [cell.strip() for cell in line.split("|") if cell.strip()]
-        if cells:
-            result.append("|-")
-            result.append("| " + " || ".join(cells))
+        # Rule 7: Image
+        match = IMAGE_PATTERN.search(line)
+        if match:
+            nodes.append(Image(match.group(1)))
+            continue
 
-    result.append("|}")
+        # Rules 3 to 5: **1.1** **text** -> === 1.1 text ===
+        match = NUMBERED_HEADING_PATTERN.match(line)
+        if match:
+            level = match.group(1).count(".") + 2
+            nodes.append(Heading(level, f"{match.group(1)} {match.group(2)}"))
+            continue
 
-    return "\n".join(result)
+        # Rule 8: # Text -> = Text =
+        match = HEADING_PATTERN.match(line)
+        if match:
+            nodes.append(_markdown_heading(match.group(1), match.group(2)))
+            continue
 
+        # Rule 2: - Item -> * Item
+        if line.startswith("- "):
+            nodes.append(ListItem(_inline(line[2:])))
+            continue
 
-def md_to_wikitext(
-    content: str,
-    footer: str,
-    ignore_pages: str,
-    page_name: str,
-    image_path: str,
-) -> str:
+        text = _inline(line)
+        # pymupdf4llm writes each line of a paragraph as a Markdown paragraph
+        previous = nodes[-1] if nodes else None
+        if isinstance(previous, (Paragraph, ListItem)) and continues(
+            previous.text, text
+        ):
+            previous.text += " " + text
+            continue
+
+        nodes.append(Paragraph(text))
+
+    return page
+
+
+class ConvertedPage(NamedTuple):
+    page: Page
+    wikitext: str
+    # Images to move to their Mediawiki file name and upload
+    images: list[Image]
+
+
+def convert_markdown_page(
+    number: int, markdown: str, footer: str, page_name: str, image_offset: int = 0
+) -> ConvertedPage:
     """
-    Transform Markdown content to wikitext.
+    Convert the Markdown of a page to wikitext.
+    The result only depends on the arguments, so pages can be converted in
+    any order, in threads or processes. Images are named from image_offset.
     """
+    page = parse_markdown_page(number, markdown, footer)
+    Document([page]).name_images(page_name, image_offset)
+    return _converted_page(page)
 
-    uploader = MediaWikiApi()
-    if not uploader.login():
-        log("Cant connect to mediawiki")
 
-    # First manage table
-    table_pattern = r"(\|.+\|\n\|[-:\s|]+\|\n(?:\|.+\|\n?)*)"
+def _converted_page(page: Page) -> ConvertedPage:
+    return ConvertedPage(
+        page,
+        render_wikitext(page.nodes),
+        [node for node in page.nodes if isinstance(node, Image)],
+    )
 
-    def replace_table(match):
-        return convert_table_to_wikitable(match.group(1))
 
-    content = re.sub(table_pattern, replace_table, content)
+def merge_converted_pages(
+    pages: Iterable[ConvertedPage], page_name: str
+) -> Iterator[ConvertedPage]:
+    """
+    Merge pages converted independently, in page order.
+    Images are numbered after the images of the previous pages and a
+    paragraph cut by a page break is joined with its end. Only the pages
+    changed at a seam or renumbered are rendered again, the result is the
+    same as a serial conversion.
+    A page is yielded once the next page with nodes is merged.
+    """
+    merger = SeamMerger()
+    image_index = 0
+    # id(page) -> [converted page, changed]
+    merging: dict[int, list] = {}
+    for converted in pages:
+        page = converted.page
+        changed = False
+        if converted.images and (
+            converted.images[0].name != f"{page_name} {image_index}.png"
+        ):
+            Document([page]).name_images(page_name, image_index)
+            changed = True
+        image_index += len(converted.images)
+
+        merging[id(page)] = [converted, changed]
+        previous = merger.previous
+        node_count = len(page.nodes)
+        completed = merger.add(page)
+        if len(page.nodes) != node_count:
+            merging[id(page)][1] = True
+            merging[id(previous)][1] = True
+        for done in completed:
+            yield _merged_page(merging.pop(id(done)))
+
+    for done in merger.flush():
+        yield _merged_page(merging.pop(id(done)))
+
+
+def _merged_page(merging: list) -> ConvertedPage:
+    converted, changed = merging
+    return _converted_page(converted.page) if changed else converted
+
+
+def iter_page_markdown(
+    content: str | Iterable[str], ignore_pages: str
+) -> Iterator[tuple[int, str]]:
+    """
+    Split Markdown with page separators page by page.
+    Content is a text or lines, like an open Markdown file, so that the
+    Markdown of a large document is not loaded at once. A page is yielded as
+    soon as its separator is read.
 
-    lines = content.split("\n")
-    transformed_lines = []
+    Yields:
+        Tuple (page number, Markdown of the page)
+    """
     ignore_page_list = ignore_pages.split(",")
-    image_index = 0
+    page_lines: list[str] = []
     page_number = 0
+    lines = content.split("\n") if isinstance(content, str) else content
     for line in lines:
-        # Remove strat whitespace
-        line = line.lstrip()
-        line = line.replace("\u2013", "-")
-
-        footer_escaped = re.escape(footer)
-        if re.search(f"{footer_escaped} \\*\\*(.+?)\\*\\*", line):
-            continue
-
-        if re.search(f"^--- end of page=\\d+ ---$", line):
+        line = line.rstrip("\n")
+        if PAGE_SEPARATOR_PATTERN.match(line.strip()):
+            if str(page_number) not in ignore_page_list:
+                yield page_number, "\n".join(page_lines)
+            page_lines = []
             page_number += 1
             continue
+        page_lines.append(line)
 
-        if str(page_number) in ignore_page_list:
-            continue
+    if any(line.strip() for line in page_lines):
+        if str(page_number) not in ignore_page_list:
+            yield page_number, "\n".join(page_lines)
 
-        # Rule 1: _Text_ -> ''Text''
-        line = re.sub(r"^_(.+?)_$", r"''\1''", line)
 
-        # Rule 2: - Item -> * Item
-        if line.startswith("- "):
-            line = "* " + line[2:]
+def iter_markdown_pages(
+    content: str | Iterable[str], footer: str, ignore_pages: str
+) -> Iterator[Page]:
+    """
+    Parse Markdown with page separators page by page.
+    """
+    for number, markdown in iter_page_markdown(content, ignore_pages):
+        yield parse_markdown_page(number, markdown, footer)
 
-        # Rule 3: **1** **text** -> == 1 text ==
-        line = re.sub(r"\*\*(\d+)\*\*\s+\*\*([^*]+)\*\*", r"== \1 \2 ==", line)
 
-        # Rule 4: **1.1** **text** -> === 1.1 text ===
-        line = re.sub(r"\*\*(\d+\.\d+)\*\*\s+\*\*([^*]+)\*\*", r"=== \1 \2 ===", line)
+def parse_markdown(
+    content: str | Iterable[str], footer: str, ignore_pages: str
+) -> Document:
+    """
+    Parse Markdown with page separators in a document.
+    """
+    return Document(list(iter_markdown_pages(content, footer, ignore_pages)))
 
-        # Rule 5: **1.1.1** **text** -> ==== 1.1.1 text ====
-        line = re.sub(
-            r"\*\*(\d+\.\d+\.\d+)\*\*\s+\*\*([^*]+)\*\*", r"==== \1 \2 ====", line
-        )
 
-        # Rule 6: **Text** -> '''Text'''
-        line = re.sub(r"\*\*([^*]+)\*\*", r"'''\1'''", line)
+def move_images(images: list[Image], image_path: str):
+    """
+    Move images to their Mediawiki file name.
+    """
+    for image in images:
+        image_dest = image_path + image.name
+        if image.source != image_dest:
+            Path(image.source).rename(image_dest)
+            image.source = image_dest
 
-        # Rule 7: Image
-        match = re.search(r"!\[\]\((.*?)\)", line)
-        if match:
-            image_source = match.group(1)
-            dest_name = f"{page_name} {str(image_index)}.png"
-            image_dest = image_path + dest_name
 
-            Path(image_source).rename(image_dest)
-            uploader.upload_image(image_dest, "")
+def upload_images(images: list[Image], image_path: str, uploader: MediaWikiApi):
+    """
+    Move images to their Mediawiki file name and upload them.
+    """
+    move_images(images, image_path)
+    for image in images:
+        uploader.upload_image(image.source, "")
 
-            image_index += 1
-            line = f"[[File:{dest_name}|center|thumb]]"
 
-        transformed_lines.append(line)
+def create_images(
+    images: list[Image], image_path: str, upload: bool = True, wiki: str = ""
+):
+    """
+    Move images to their Mediawiki file name and upload them to the target
+    wiki, see wiki_registry. Without upload, images are only moved.
+    """
+    if not upload:
+        move_images(images, image_path)
+        return
 
-    result = "\n".join(transformed_lines)
+    uploader = wiki_registry.get_client(wiki)
+    if uploader.login_error:
+        log("Cant connect to mediawiki")
+    upload_images(images, image_path, uploader)
 
-    # Remove empty lines
-    result = re.sub(r"([a-zA-Z])\n{5}([a-zA-Z])", r"\1 \2", result)
-    result = re.sub(r"([a-zA-Z])\n{4}([a-zA-Z])", r"\1 \2", result)
-    result = re.sub(r"([a-zA-Z])\n{3}([a-zA-Z])", r"\1 \2", result)
-    result = re.sub(r"([a-zA-Z])\n{2}([a-zA-Z])", r"\1 \2", result)
-    result = re.sub(r"(.)\n{3}([a-zA-Z])", r"\1\n\n\2", result)
-    result = re.sub(r"(,)\n{2}([a-zA-Z])", r"\1 \2", result)
-    result = re.sub(r"\n{3}(==)", r"\n\1", result)
-    result = re.sub(r"\n{5}", r"\n\n", result)
-    result = re.sub(r"\n{4}", r"\n\n", result)
-    result = re.sub(r"\n{3}", r"\n\n", result)
-    result = re.sub(r"\n{2}", r"\n\n", result)
-    result = re.sub(r"''\n{2}''", r"", result)
 
-    result = result.strip()
+def md_to_document(
+    content: str | Iterable[str],
+    footer: str,
+    ignore_pages: str,
+    page_name: str,
+    image_path: str,
+    upload: bool = True,
+    wiki: str = "",
+) -> Document:
+    """
+    Parse Markdown content and create its images on Mediawiki.
+    Without upload, images are only moved to their Mediawiki file name.
+    Images are uploaded to the target wiki, see wiki_registry.
+    """
+    return pages_to_document(
+        iter_page_markdown(content, ignore_pages),
+        footer,
+        page_name,
+        image_path,
+        upload,
+        wiki,
+    )
+
+
+def pages_to_document(
+    pages: Iterable[tuple[int, str]],
+    footer: str,
+    page_name: str,
+    image_path: str,
+    upload: bool = True,
+    wiki: str = "",
+) -> Document:
+    """
+    Parse the Markdown of each page, given as (page number, Markdown), and
+    create its images on Mediawiki, like md_to_document.
+    """
+    converted = (
+        convert_markdown_page(number, markdown, footer, page_name)
+        for number, markdown in pages
+    )
+    document = Document(
+        [page.page for page in merge_converted_pages(converted, page_name)]
+    )
+    create_images(document.images(), image_path, upload, wiki)
+    return document
+
 
-    return result
+def md_to_wikitext(
+    content: str,
+    footer: str,
+    ignore_pages: str,
+    page_name: str,
+    image_path: str,
+) -> str:
+    """
+    Transform Markdown content to wikitext.
+    """
+    document = md_to_document(content, footer, ignore_pages, page_name, image_path)
+    return render_wikitext(document.nodes())
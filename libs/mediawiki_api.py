@@ -7,22 +7,203 @@ from pathlib import Path
 from libs.logger import log
 import mimetypes
 import os
+import random
 import requests
+import threading
+import time
+
+# Files bigger than this are uploaded in chunks through the upload stash
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+DEFAULT_CHUNK_RETRIES = 3
+
+# Request scheduling
+DEFAULT_TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+DEFAULT_MAXLAG = 5
+DEFAULT_RETRIES = 5
+DEFAULT_MAX_CONCURRENCY = 4
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Answers of a wiki that can't take more calls for now
+OVERLOAD_STATUS = (429, 502, 503, 504)
+OVERLOAD_ERRORS = ("maxlag", "ratelimited", "readonly")
+# Answer of create_page when the wiki refused the edit
+PAGE_NOT_CREATED = "Page not created"
+
+
+class AimdLimiter:
+    """
+    Limit of concurrent calls to a wiki, adapted to what it can take:
+    additive increase after each successful call, multiplicative decrease
+    when the wiki is overloaded
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max(1, max_limit)
+        self.limit = 1.0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def _retry_after(response) -> float | None:
+    value = response.headers.get("Retry-After") if response is not None else None
+    if value is None:
+        return None
+    try:
+        # Longer delays would hold the request, it is tried after BACKOFF_MAX
+        return min(float(BACKOFF_MAX), max(0.0, float(value)))
+    except ValueError:
+        # HTTP date, backoff is used instead
+        return None
+
+
+def _backoff(attempt: int, response) -> float:
+    """
+    Delay before the retry of a call: Retry-After if the wiki gave it, else
+    an exponential backoff with jitter
+    """
+    delay = _retry_after(response)
+    if delay is None:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+        delay *= random.uniform(0.5, 1)
+    return delay
+
+
+def _overload_reason(response) -> str | None:
+    if response.status_code in OVERLOAD_STATUS:
+        return f"HTTP {response.status_code}"
+    try:
+        error = response.json().get("error", {})
+    except ValueError:
+        return None
+    if isinstance(error, dict) and error.get("code") in OVERLOAD_ERRORS:
+        return error["code"]
+    return None
 
 
 class MediaWikiApi:
-    def __init__(self):
+    def __init__(self, url=None, username=None, password=None, *, limiter):
         """
         Initialize MediaWiki API
+
+        Args:
+            url: Url of the wiki, MEDIAWIKI_URL if None
+            username: User of the wiki, MEDIAWIKI_USER if None
+            password: Password of the user, MEDIAWIKI_MDP if None
+            limiter: AimdLimiter of the calls to the wiki, the one of its
+                target for the clients of wiki_registry
+
+        Env:
+            UPLOAD_CHUNK_SIZE: Chunk size of uploads in bytes, 5 MiB by default
+            UPLOAD_CHUNK_RETRIES: Attempts for each chunk, overloads of the
+                wiki included, 3 by default
+            MEDIAWIKI_TIMEOUT: Read timeout of a call in seconds, 60 by default
+            MEDIAWIKI_MAXLAG: maxlag parameter of calls in seconds, 5 by
+                default, 0 to not send it
+            MEDIAWIKI_RETRIES: Retries of a call when the wiki is overloaded
+                or doesn't answer in time, 5 by default
         """
-        self.api_url = (
-            os.getenv("MEDIAWIKI_URL") or "http://wiki.example.com"
-        ) + "/api.php"
-        self.username = os.getenv("MEDIAWIKI_USER") or "adminUser"
-        self.password = os.getenv("MEDIAWIKI_MDP") or "adminPwd"
-        self.session = requests.Session()
+        self.url = url or os.getenv("MEDIAWIKI_URL") or "http://wiki.example.com"
+        self.api_url = self.url + "/api.php"
+        self.username = username or os.getenv("MEDIAWIKI_USER") or "adminUser"
+        self.password = password or os.getenv("MEDIAWIKI_MDP") or "adminPwd"
         self.csrf_token = None
         self.login_error = None
+        self.chunk_size = int(os.getenv("UPLOAD_CHUNK_SIZE") or DEFAULT_CHUNK_SIZE)
+        self.chunk_retries = int(
+            os.getenv("UPLOAD_CHUNK_RETRIES") or DEFAULT_CHUNK_RETRIES
+        )
+        self.timeout = float(os.getenv("MEDIAWIKI_TIMEOUT") or DEFAULT_TIMEOUT)
+        self.maxlag = int(os.getenv("MEDIAWIKI_MAXLAG") or DEFAULT_MAXLAG)
+        self.retries = int(os.getenv("MEDIAWIKI_RETRIES") or DEFAULT_RETRIES)
+        self.limiter = limiter
+        # One pooled connection for each call the limiter lets through
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=max(self.limiter.max_limit, DEFAULT_MAX_CONCURRENCY)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method: str, params=None, data=None, files=None, retries=None):
+        """
+        Call the API under the concurrency limiter of the wiki
+        Calls are retried with an exponential backoff, or after the delay
+        given by Retry-After up to BACKOFF_MAX, when the wiki is lagged, rate
+        limited, overloaded or doesn't answer in time.
+
+        Args:
+            retries: Retries of the call, MEDIAWIKI_RETRIES if None
+
+        Returns:
+            Response of the last attempt
+
+        Raises:
+            requests.RequestException: The wiki can't be reached, or the last
+                attempt timed out
+        """
+        if retries is None:
+            retries = self.retries
+        if self.maxlag:
+            if method == "GET":
+                params = {**(params or {}), "maxlag": self.maxlag}
+            else:
+                data = {**(data or {}), "maxlag": self.maxlag}
+
+        for attempt in range(retries + 1):
+            # Files are sent again from their start
+            for file in (files or {}).values():
+                if hasattr(file[1], "seek"):
+                    file[1].seek(0)
+
+            response = None
+            self.limiter.acquire()
+            try:
+                response = self.session.request(
+                    method,
+                    self.api_url,
+                    params=params,
+                    data=data,
+                    files=files,
+                    timeout=(CONNECT_TIMEOUT, self.timeout),
+                )
+                reason = _overload_reason(response)
+            except requests.Timeout:
+                if attempt == retries:
+                    self.limiter.release(overloaded=True)
+                    raise
+                reason = "timeout"
+            except Exception:
+                self.limiter.release()
+                raise
+            self.limiter.release(overloaded=reason is not None)
+
+            if reason is None or attempt == retries:
+                return response
+
+            delay = _backoff(attempt, response)
+            log(
+                f"Mediawiki overloaded ({reason}), retry {attempt + 1}/"
+                f"{retries} in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+        return response
 
     def login(self):
         log(f"Connection as {self.username}...")
@@ -36,7 +217,7 @@ class MediaWikiApi:
         }
 
         try:
-            response = self.session.get(self.api_url, params=params)
+            response = self._request("GET", params=params)
         except:
             log(f"Mediawiki server {self.api_url} not found")
             self.login_error = True
@@ -54,7 +235,12 @@ class MediaWikiApi:
             "format": "json",
         }
 
-        response = self.session.post(self.api_url, data=login_data)
+        try:
+            response = self._request("POST", data=login_data)
+        except requests.RequestException as e:
+            log(f"Connection error: {e}")
+            self.login_error = True
+            return False
         result = response.json()
 
         if result["login"]["result"] == "Success":
@@ -65,11 +251,26 @@ class MediaWikiApi:
             self.login_error = True
             return False
 
+    def check_login(self) -> bool:
+        """
+        Tell if the session is still logged in, used as health check
+
+        Returns:
+            True if the wiki answers and the user is logged in
+        """
+        params = {"action": "query", "meta": "userinfo", "format": "json"}
+        try:
+            response = self._request("GET", params=params)
+            userinfo = response.json()["query"]["userinfo"]
+        except Exception:
+            return False
+        return "anon" not in userinfo
+
     def get_csrf_token(self):
         """Get CSRF token nedeed to upload"""
         params = {"action": "query", "meta": "tokens", "format": "json"}
 
-        response = self.session.get(self.api_url, params=params)
+        response = self._request("GET", params=params)
         data = response.json()
         self.csrf_token = data["query"]["tokens"]["csrftoken"]
         return self.csrf_token
@@ -77,6 +278,7 @@ class MediaWikiApi:
     def upload_image(self, file_path, description=""):
         """
         Upload image to MediaWiki
+        Files bigger than the chunk size are sent in chunks
 
         Args:
             file_path: image file path
@@ -97,7 +299,11 @@ class MediaWikiApi:
 
         # Get token if not already done
         if not self.csrf_token:
-            self.get_csrf_token()
+            try:
+                self.get_csrf_token()
+            except requests.RequestException as e:
+                log(f"Upload of {file_path.name} failed: {e}")
+                return False
 
         if not self.csrf_token:
             log("No link to Mediawiki. Image files will not be upload ")
@@ -115,12 +321,20 @@ class MediaWikiApi:
             "ignorewarnings": "1",
         }
 
-        # Upload file
-        with open(file_path, "rb") as f:
-            files = {"file": (file_path.name, f, mime_type)}
-            response = self.session.post(self.api_url, data=upload_data, files=files)  # type: ignore
-
         try:
+            if file_path.stat().st_size > self.chunk_size:
+                filekey = self._upload_chunks(file_path)
+                if not filekey:
+                    return False
+                # Publish the file from the stash
+                upload_data["filekey"] = filekey
+                response = self._request("POST", data=upload_data)
+            else:
+                # Upload file
+                with open(file_path, "rb") as f:
+                    files = {"file": (file_path.name, f, mime_type)}
+                    response = self._request("POST", data=upload_data, files=files)
+
             result = response.json()
 
             if "upload" in result and result["upload"]["result"] == "Success":
@@ -138,21 +352,105 @@ class MediaWikiApi:
                 return False
         except ValueError:
             log("Not a valid json response")
+        except requests.RequestException as e:
+            log(f"Upload of {file_path.name} failed: {e}")
+            return False
+
+    def _upload_chunks(self, file_path: Path):
+        """
+        Send a file to the upload stash chunk by chunk
+        Chunks are read from disk one at a time. A failed chunk is sent again
+        from its offset, completed chunks are never sent again.
+
+        Args:
+            file_path: file path
+
+        Returns:
+            File key of the stashed file, None if a chunk failed
+        """
+        file_size = file_path.stat().st_size
+        filekey = None
+        offset = 0
+        chunk_count = 0
+        with open(file_path, "rb") as f:
+            while offset < file_size:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                chunk_data = {
+                    "action": "upload",
+                    "stash": "1",
+                    "filename": file_path.name,
+                    "filesize": str(file_size),
+                    "offset": str(offset),
+                    "token": self.csrf_token,
+                    "format": "json",
+                    "ignorewarnings": "1",
+                }
+                if filekey:
+                    chunk_data["filekey"] = filekey
+
+                upload = self._post_chunk(chunk_data, file_path.name, chunk)
+                if upload is None:
+                    return None
+                filekey = upload["filekey"]
+                offset = int(upload.get("offset") or offset + len(chunk))
+                chunk_count += 1
+
+        log(f"{file_path.name} sent in {chunk_count} chunks")
+        return filekey
+
+    def _post_chunk(self, chunk_data: dict, file_name: str, chunk: bytes):
+        """
+        Send a chunk, with retries
+        The chunk has one budget of attempts for all its failures: each
+        attempt is a single call, followed by a backoff when it failed.
+
+        Returns:
+            upload part of the response, None if all attempts failed
+        """
+        for attempt in range(1, self.chunk_retries + 1):
+            response = None
+            try:
+                response = self._request(
+                    "POST",
+                    data=chunk_data,
+                    files={"chunk": (file_name, chunk, "application/octet-stream")},
+                    retries=0,
+                )
+                result = response.json()
+            except (requests.RequestException, ValueError) as e:
+                error = str(e)
+            else:
+                upload = result.get("upload", {})
+                if upload.get("result") in ("Continue", "Success"):
+                    return upload
+                error = result.get("error", {}).get("info") or str(result)
+            log(
+                f"Chunk at offset {chunk_data['offset']} of {file_name} failed"
+                f" (attempt {attempt}/{self.chunk_retries}): {error}"
+            )
+            if attempt < self.chunk_retries:
+                time.sleep(_backoff(attempt - 1, response))
+        return None
 
     def create_page(self, page_name: str, content: str):
-        if not self.csrf_token:
-            self.get_csrf_token()
+        try:
+            if not self.csrf_token:
+                self.get_csrf_token()
 
-        params = {
-            "action": "edit",
-            "title": page_name,
-            "text": content,
-            "summary": "Create or update page",
-            "token": self.csrf_token,
-            "format": "json",
-        }
+            params = {
+                "action": "edit",
+                "title": page_name,
+                "text": content,
+                "summary": "Create or update page",
+                "token": self.csrf_token,
+                "format": "json",
+            }
 
-        response = self.session.post(self.api_url, data=params)
+            response = self._request("POST", data=params)
+        except requests.RequestException as e:
+            log(f"Page creation fail: {e}")
+            return PAGE_NOT_CREATED
         data = response.json()
 
         if "edit" in data and data["edit"]["result"] == "Success":
@@ -161,9 +459,7 @@ class MediaWikiApi:
                 log("New page created")
             else:
                 log("Page updated")
-            return (
-                os.getenv("MEDIAWIKI_URL") or "http://wiki.example.com"
-            ) + f"/index.php?title={data["edit"]["title"]}"
+            return self.url + f"/index.php?title={data["edit"]["title"]}"
         else:
             log(f"Page creation fail: {data}")
-            return "Page not created"
+            return PAGE_NOT_CREATED
@@ -0,0 +1,106 @@
+"""
+Memory of the worker process, used to keep the conversion of very large PDF
+files under a resident set size (RSS) ceiling
+"""
+
+from libs.extraction import PDF_LOCK
+from libs.logger import log
+import gc
+import os
+import sys
+import time
+
+# Seconds waited once per request for other requests to release memory at the
+# smallest window
+PAUSE_SECONDS = 1
+PAUSE_MAX_TRIES = 5
+
+
+def current_rss() -> int:
+    """
+    Resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # No procfs: peak of the process is the closest value
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryGuard:
+    """
+    Follow the peak memory of a request and enforce the RSS ceiling
+
+    Env:
+        MAX_RSS_MB: RSS ceiling in MiB, 0 or empty for no ceiling
+    """
+
+    def __init__(self, max_rss_mb: int | None = None):
+        if max_rss_mb is None:
+            max_rss_mb = int(os.getenv("MAX_RSS_MB") or 0)
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.peak = 0
+        self.paused = False
+        self.sample()
+
+    def sample(self) -> int:
+        rss = current_rss()
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def over_ceiling(self) -> bool:
+        return bool(self.max_rss) and self.sample() > self.max_rss
+
+    def release(self):
+        """
+        Free Python garbage and the MuPDF object cache
+        """
+        # Objects of other conversions may be freed here
+        with PDF_LOCK:
+            gc.collect()
+            fitz = sys.modules.get("fitz")
+            if fitz is not None:
+                fitz.TOOLS.store_shrink(100)
+
+    def next_window(self, window: int) -> int:
+        """
+        Size of the next page window. Above the ceiling the caches are freed,
+        then the window is halved down to a single page, then the request waits
+        once for other requests to release memory and goes on page by page.
+
+        Args:
+            window: Number of pages of the current window
+
+        Returns:
+            Number of pages of the next window
+        """
+        if not self.over_ceiling():
+            return window
+        self.release()
+        if not self.over_ceiling():
+            return window
+        if window > 1:
+            window //= 2
+            log(f"Memory ceiling reached, page window reduced to {window}")
+            return window
+        if self.paused:
+            return window
+        self.paused = True
+        for _ in range(PAUSE_MAX_TRIES):
+            log("Memory ceiling reached, waiting for memory")
+            time.sleep(PAUSE_SECONDS)
+            if not self.over_ceiling():
+                return window
+        log("Memory ceiling still reached, pages extracted one at a time")
+        return window
+
+    def log_peak(self):
+        self.sample()
+        log(f"Peak memory: {self.peak / (1024 * 1024):.0f} MiB")
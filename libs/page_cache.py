@@ -0,0 +1,204 @@
+"""
+Cache of the last Markdown extraction of each page_name, so that the wikitext
+stage runs again with another footer or ignore_pages without the PDF file.
+A cache is one file: the Markdown of each page and the bytes of its images
+one after the other, then a JSON index of their offsets and the size of the
+index. It is memory-mapped on read, only the pages kept are decoded.
+"""
+
+from libs.md_to_wikitext import IMAGE_PATTERN
+from pathlib import Path
+from collections.abc import Iterator
+import json
+import mmap
+import os
+import struct
+
+CACHE_SUFFIX = ".pages"
+CACHE_VERSION = 1
+# Size of the JSON index, at the end of the file
+INDEX_SIZE = struct.Struct("<Q")
+
+
+def cache_path(page_name_final: str) -> Path:
+    """
+    Cache file of a page_name
+
+    Env:
+        OUTPUT_FOLDER: Output folder of the cache files
+    """
+    output_folder = Path(os.getenv("OUTPUT_FOLDER") or "./output")
+    return output_folder / f"{page_name_final}{CACHE_SUFFIX}"
+
+
+class PageCacheWriter:
+    """
+    Write the cache of an extraction page by page. The file replaces the
+    previous cache of the page_name when the writer is closed, and is removed
+    if the extraction fails.
+
+    Args:
+        path: Cache file
+        run_id: Run id of the extraction
+    """
+
+    def __init__(self, path: Path, run_id: int):
+        self.path = path
+        # One temporary file per run, concurrent extractions of the page_name
+        # replace the cache in turn
+        self.temporary = path.with_name(f"{path.name}.{run_id}.tmp")
+        self.index = {
+            "version": CACHE_VERSION,
+            "run_id": run_id,
+            "pages": [],
+        }
+        self.image_count = 0
+        self.file = open(self.temporary, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            self.temporary.unlink(missing_ok=True)
+
+    def _write(self, data: bytes) -> list[int]:
+        offset = self.file.tell()
+        self.file.write(data)
+        return [offset, len(data)]
+
+    def add(self, number: int, markdown: str):
+        """
+        Add the Markdown of a page and the images it links to
+        """
+        images = []
+        for source in IMAGE_PATTERN.findall(markdown):
+            if os.path.exists(source):
+                images.append([source, *self._write(Path(source).read_bytes())])
+        self.image_count += len(images)
+        self.index["pages"].append(
+            {
+                "number": number,
+                "markdown": self._write(markdown.encode("utf-8")),
+                "images": images,
+            }
+        )
+
+    def close(self):
+        index = json.dumps(self.index).encode("utf-8")
+        self.file.write(index)
+        self.file.write(INDEX_SIZE.pack(len(index)))
+        self.file.close()
+        os.replace(self.temporary, self.path)
+
+    @property
+    def page_count(self) -> int:
+        return len(self.index["pages"])
+
+
+class PageCache:
+    """
+    Cache of an extraction, memory-mapped
+
+    Args:
+        path: Cache file
+
+    Raises:
+        ValueError: The file is not a cache of this version
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = len(self.map) - INDEX_SIZE.size
+            (size,) = INDEX_SIZE.unpack_from(self.map, end)
+            self.index = json.loads(self.map[end - size : end])
+            if self.index.get("version") != CACHE_VERSION:
+                raise ValueError(f"Cache version {self.index.get("version")}")
+        except (struct.error, ValueError) as e:
+            self.map.close()
+            raise ValueError(f"Invalid page cache {path}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.map.close()
+
+    @property
+    def run_id(self) -> int:
+        return self.index["run_id"]
+
+    @property
+    def page_count(self) -> int:
+        return len(self.index["pages"])
+
+    def _kept_pages(self, ignore_pages: str) -> Iterator[dict]:
+        ignore_page_list = ignore_pages.split(",")
+        for page in self.index["pages"]:
+            if str(page["number"]) not in ignore_page_list:
+                yield page
+
+    def pages(self, ignore_pages: str, image_path: str) -> Iterator[tuple[int, str]]:
+        """
+        Markdown of the pages not ignored, like md_to_wikitext.iter_page_markdown
+        Image links point to the images written by restore_images.
+
+        Args:
+            ignore_pages: ignore pages number separate by ,
+            image_path: Image folder given to restore_images
+
+        Yields:
+            Tuple (page number, Markdown of the page)
+        """
+        for page in self._kept_pages(ignore_pages):
+            offset, length = page["markdown"]
+            markdown = self.map[offset : offset + length].decode("utf-8")
+            for source, _, _ in page["images"]:
+                markdown = markdown.replace(
+                    f"]({source})", f"]({image_path}{Path(source).name})"
+                )
+            yield page["number"], markdown
+
+    def restore_images(self, ignore_pages: str, image_path: str) -> int:
+        """
+        Write the images of the pages not ignored in an image folder, the
+        folder of the extraction may still be used by its deferred upload
+
+        Args:
+            ignore_pages: ignore pages number separate by ,
+            image_path: Image folder of the run
+
+        Returns:
+            Number of images written
+        """
+        count = 0
+        Path(image_path).mkdir(parents=True, exist_ok=True)
+        for page in self._kept_pages(ignore_pages):
+            for source, offset, length in page["images"]:
+                with open(f"{image_path}{Path(source).name}", "wb") as f:
+                    f.write(self.map[offset : offset + length])
+                count += 1
+        return count
+
+
+def open_cache(page_name_final: str) -> PageCache | None:
+    """
+    Open the cache of the last extraction of a page_name
+
+    Returns:
+        PageCache, None if the page_name has no cache
+    """
+    path = cache_path(page_name_final)
+    return PageCache(path) if path.exists() else None
+
+
+def remove_cache(page_name_final: str):
+    """
+    Remove the cache of a page_name, older than its last extraction
+    """
+    cache_path(page_name_final).unlink(missing_ok=True)
@@ -0,0 +1,553 @@
+"""
+Conversion of a PDF file to a wikitext page, shared by the API and the batch
+command line. Each conversion is a run: it has its own log and its files are
+registered in the artifact store.
+"""
+
+from libs import (
+    background,
+    direct_extractor,
+    extraction,
+    ingest,
+    page_cache,
+    wiki_registry,
+)
+from libs.annotate import Annotate
+from libs.artifact_store import ArtifactStore
+from collections.abc import Callable, Iterable, Iterator
+from libs.document import (
+    Document,
+    Image,
+    Page,
+    SeamMerger,
+    render_markdown,
+    render_wikitext,
+)
+from libs.logger import init_logger, close_logger, log, log_step, get_step_timings
+from libs.md_to_wikitext import (
+    convert_markdown_page,
+    create_images,
+    iter_page_markdown,
+    merge_converted_pages,
+    pages_to_document,
+)
+from libs.mediawiki_api import PAGE_NOT_CREATED
+from libs.memory import MemoryGuard
+from pathlib import Path
+import os
+import shutil
+
+
+def start_run(page_name_final: str, kind: str):
+    """
+    Register a run in the artifact store and start its log
+
+    Args:
+        page_name_final: Normalized page reference name
+        kind: Run kind, used in the log file name
+
+    Returns:
+        Tuple (artifact store, run id, log file)
+    """
+    output_folder = os.getenv("OUTPUT_FOLDER") or "./output"
+    store = ArtifactStore(output_folder)
+    run_id = store.start_run(page_name_final, kind)
+    log_file = init_logger(f"{page_name_final}_{kind}", output_folder)
+    store.add_artifact(run_id, "log", log_file)
+    return store, run_id, log_file
+
+
+def finish_run(store: ArtifactStore, run_id: int, log_file: Path):
+    """
+    Store the step timings, close the log and apply the retention policy
+
+    Args:
+        store: Artifact store
+        run_id: Run id
+        log_file: Log file of the run
+    """
+    store.add_timings(run_id, log_file, get_step_timings())
+    close_logger()
+    store.finish_run(run_id)
+
+
+def _upload_path(page_name_final: str, run_id: int) -> Path:
+    # One folder per run for concurrent uploads of a page, the file keeps the
+    # page name, used in the names of the extracted images
+    return Path(
+        f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}_{run_id}"
+        f"/{page_name_final}.pdf"
+    )
+
+
+def ingest_upload(source, page_name_final: str, run_id: int) -> ingest.Upload:
+    """
+    Write an uploaded PDF file to a temporary file of the output folder
+
+    Args:
+        source: Binary file object of the upload
+        page_name_final: Normalized page reference name
+        run_id: Run id of the conversion
+
+    Returns:
+        Upload with its SHA-256, size and page count
+
+    Raises:
+        ingest.IngestError: File rejected, logged
+    """
+    log_step("Create temporary file")
+    dest = _upload_path(page_name_final, run_id)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        upload = ingest.save_upload(source, dest)
+    except ingest.IngestError as e:
+        dest.parent.rmdir()
+        log(f"Upload rejected: {e.detail}")
+        raise
+    log(
+        f"Upload of {upload.size} bytes, {upload.page_count} pages,"
+        f" SHA-256 {upload.sha256}"
+    )
+    return upload
+
+
+def remove_upload(upload: ingest.Upload):
+    """
+    Remove the temporary file of an upload and its folder, if not done yet
+
+    Args:
+        upload: Upload of ingest_upload
+    """
+    upload.path.unlink(missing_ok=True)
+    if upload.path.parent.exists():
+        upload.path.parent.rmdir()
+
+
+def _remove_temporary_file(pdf):
+    # Only the copy of an uploaded file is removed
+    if isinstance(pdf, ingest.Upload):
+        log_step("Remove temporary file")
+        remove_upload(pdf)
+
+
+def pdf_to_wikitext(
+    pdf,
+    footer: str,
+    ignore_pages: str,
+    page_name_final: str,
+    generate_page: bool,
+    extractor: str,
+    store: ArtifactStore,
+    run_id: int,
+    memory: MemoryGuard,
+    parallel: bool = True,
+    profile: str = "accurate",
+    defer_images: bool = False,
+    events: Callable[[str, dict], None] | None = None,
+    wiki: str = "",
+) -> str | None:
+    """
+    Transform a PDF file in a wikitext file and generate its Mediawiki page
+
+    Args:
+        pdf: PDF file path, or Upload removed once read
+        footer: Reference footer
+        ignore_pages: ignore pages number separate by ,
+        page_name_final: Normalized page reference name
+        generate_page: if true, generate page on Mediawiki
+        extractor: markdown or direct
+        store: Artifact store of the run
+        run_id: Run id
+        memory: MemoryGuard of the run
+        parallel: False to annotate without the worker pool
+        profile: Extraction profile, one of extraction.EXTRACTION_PROFILES
+        defer_images: if true, the page is created before the images, they
+            are uploaded afterwards by the background queue
+        events: if given, events(name, data) is called with "start" (page
+            count), then "page" (page number and wikitext before annotation)
+            and "progress" for each page once it is converted
+        wiki: Target wiki of the page and images, see wiki_registry
+
+    Returns:
+        wikitext, None if the transformation or the requested page creation
+        failed
+    """
+    log_step("Init application")
+    txt_output_filename = f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}.txt"
+    md_output_filename = f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}.md"
+    if os.path.exists(txt_output_filename):
+        os.unlink(txt_output_filename)
+    if os.path.exists(md_output_filename):
+        os.unlink(md_output_filename)
+    image_path = _image_path(page_name_final, run_id)
+
+    if isinstance(pdf, ingest.Upload):
+        pdf_path = pdf.path
+        page_count = pdf.page_count
+    else:
+        pdf_path = Path(pdf)
+        page_count = None
+
+    if events is not None:
+        if page_count is None:
+            page_count = extraction.page_count(pdf_path)
+        events("start", {"pages": page_count})
+
+        def emit(page: Page, wikitext: str):
+            events("page", {"page": page.number, "wikitext": wikitext})
+            events("progress", {"page": page.number, "pages": page_count})
+
+    if extractor == "direct":
+        log_step("Transform Pdf content to wikitext and create image on Mediawiki")
+        try:
+            pages = direct_extractor.iter_pdf_pages(
+                pdf_path,
+                footer,
+                ignore_pages,
+                page_name_final,
+                image_path,
+                memory,
+                profile,
+                upload=not defer_images,
+                wiki=wiki,
+            )
+            document = Document()
+            for page in _completed_pages(pages):
+                document.pages.append(page)
+                if events is not None:
+                    emit(page, render_wikitext(page.nodes))
+        except Exception as e:
+            log(f"Error in PDF to WIKITEXT transformation: {str(e)}")
+            return None
+        # Only Markdown extractions are cached, an older one would be reused
+        page_cache.remove_cache(page_name_final)
+
+        _remove_temporary_file(pdf)
+
+        log_step("Create md file")
+        with open(md_output_filename, "w", encoding="utf-8") as fichier:
+            fichier.write(render_markdown(document))
+        store.add_artifact(run_id, "md", md_output_filename)
+    else:
+        log_step("Transform Pdf content to md text and store image")
+        try:
+            # Markdown is written window by window and each page is converted
+            # once extracted, the Markdown is never held whole in memory
+            with (
+                open(md_output_filename, "w", encoding="utf-8") as fichier,
+                _cache_writer(page_name_final, run_id) as cache,
+            ):
+                markdown = _written_lines(
+                    extraction.iter_markdown(pdf_path, image_path, memory, profile),
+                    fichier,
+                )
+                converted = (
+                    convert_markdown_page(number, page, footer, page_name_final)
+                    for number, page in _cached_pages(markdown, ignore_pages, cache)
+                )
+                document = Document()
+                for page in merge_converted_pages(converted, page_name_final):
+                    document.pages.append(page.page)
+                    if events is not None:
+                        emit(page.page, page.wikitext)
+        except Exception as e:
+            log(f"Error in PDF to MD transformation: {str(e)}")
+            return None
+        log(f"Extraction cached: {cache.page_count} pages, {cache.image_count} images")
+
+        _remove_temporary_file(pdf)
+
+        log_step("Create md file")
+        store.add_artifact(run_id, "md", md_output_filename)
+
+        log_step("Transform MD to wikitext and create image on Mediawiki")
+        try:
+            create_images(document.images(), image_path, not defer_images, wiki)
+        except Exception as e:
+            log(f"Error in MD to WIKITEXT transformation: {str(e)}")
+            return None
+
+    wikitext = _publish_document(
+        document,
+        image_path,
+        page_name_final,
+        generate_page,
+        store,
+        run_id,
+        memory,
+        parallel,
+        defer_images,
+        wiki,
+    )
+
+    if wikitext is not None and isinstance(pdf, ingest.Upload):
+        # Content already converted, for batch runs and later deduplication
+        store.add_source(
+            pdf.sha256,
+            page_name_final,
+            source_wiki(wiki, generate_page),
+            generate_page,
+            run_id,
+        )
+
+    return wikitext
+
+
+def source_wiki(wiki: str, published: bool) -> str:
+    """
+    Wiki name of a converted source, see ArtifactStore.add_source
+
+    Args:
+        wiki: Target wiki of the page, see wiki_registry
+        published: if true, the page is created on the wiki
+
+    Returns:
+        Target name, "" if not published
+    """
+    return wiki_registry.get_target(wiki).name if published else ""
+
+
+def reconvert_wikitext(
+    page_name_final: str,
+    footer: str,
+    ignore_pages: str,
+    generate_page: bool,
+    store: ArtifactStore,
+    run_id: int,
+    memory: MemoryGuard,
+    parallel: bool = True,
+    defer_images: bool = False,
+    wiki: str = "",
+) -> str | None:
+    """
+    Run the wikitext stage again on the cached Markdown of the last
+    extraction of a page_name, without the PDF file
+
+    Args:
+        page_name_final: Normalized page reference name
+        footer: Reference footer
+        ignore_pages: ignore pages number separate by ,
+        generate_page: if true, generate page on Mediawiki
+        store: Artifact store of the run
+        run_id: Run id
+        memory: MemoryGuard of the run
+        parallel: False to annotate without the worker pool
+        defer_images: if true, the page is created before the images
+        wiki: Target wiki of the page and images, see wiki_registry
+
+    Returns:
+        wikitext, None if the page_name has no cache, the transformation or
+        the requested page creation failed
+    """
+    log_step("Read extraction cache")
+    try:
+        cache = page_cache.open_cache(page_name_final)
+    except ValueError as e:
+        log(str(e))
+        return None
+    if cache is None:
+        log("No extraction cached, convert the PDF file with the markdown extractor")
+        return None
+
+    with cache:
+        log(
+            f"{cache.page_count} pages extracted by run {cache.run_id},"
+            f" ignored pages: {ignore_pages or "none"}"
+        )
+        image_path = _image_path(page_name_final, run_id)
+        log_step("Transform MD to wikitext and create image on Mediawiki")
+        try:
+            log(f"{cache.restore_images(ignore_pages, image_path)} images restored")
+            document = pages_to_document(
+                cache.pages(ignore_pages, image_path),
+                footer,
+                page_name_final,
+                image_path,
+                upload=not defer_images,
+                wiki=wiki,
+            )
+        except Exception as e:
+            log(f"Error in MD to WIKITEXT transformation: {str(e)}")
+            return None
+
+    return _publish_document(
+        document,
+        image_path,
+        page_name_final,
+        generate_page,
+        store,
+        run_id,
+        memory,
+        parallel,
+        defer_images,
+        wiki,
+    )
+
+
+def _publish_document(
+    document: Document,
+    image_path: str,
+    page_name_final: str,
+    generate_page: bool,
+    store: ArtifactStore,
+    run_id: int,
+    memory: MemoryGuard,
+    parallel: bool,
+    defer_images: bool,
+    wiki: str,
+) -> str | None:
+    """
+    Annotate the wikitext of a document, write it and create its Mediawiki
+    page, then queue its deferred images once the page is created
+
+    Returns:
+        wikitext, None if the page was requested and not created
+    """
+    images = document.images() if defer_images else []
+    if not images:
+        log_step("Remove image folder")
+        shutil.rmtree(image_path, ignore_errors=True)
+
+    log_step("Annotate wikitext with ontology")
+    annotation = Annotate()
+    # Worker processes of the pool would add to the memory above the ceiling
+    if parallel and memory.over_ceiling():
+        parallel = False
+        log("Memory ceiling reached, sections annotated serially")
+    sections, timings = annotation.annotate_sections(
+        [render_wikitext(nodes) for nodes in document.sections()], parallel
+    )
+    # Every section after the first starts with its heading
+    wikitext = "\n".join(sections)
+    log(
+        f"{sum(timing.hits for timing in timings)} ontology terms annotated in"
+        f" {len(timings)} sections,"
+        f" {sum(timing.cached for timing in timings)} from cache"
+    )
+    for timing in sorted(timings, key=lambda t: t.seconds, reverse=True)[:5]:
+        if not timing.cached:
+            log(
+                f"Section {timing.index} '{timing.title}' annotated in"
+                f" {timing.seconds:.4f}s ({timing.hits} terms)"
+            )
+
+    log_step("Create wikitext file")
+    txt_output_filename = f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}.txt"
+    with open(txt_output_filename, "w", encoding="utf-8") as fichier:
+        fichier.write(wikitext)
+    store.add_artifact(run_id, "txt", txt_output_filename)
+
+    published = True
+    if generate_page:
+        log_step("Create Mediawiki page")
+        mediawiki_api = wiki_registry.get_client(wiki)
+        if mediawiki_api.login_error:
+            log("Cant connect to mediawiki")
+            published = False
+        else:
+            return_page_url = mediawiki_api.create_page(page_name_final, wikitext)
+            log(f"Page generation result: {return_page_url}")
+            published = return_page_url != PAGE_NOT_CREATED
+
+    if images and published:
+        log_step("Queue image upload")
+        store.add_images(run_id, [image.name for image in images])
+        background.submit(
+            upload_images, run_id, page_name_final, images, image_path, wiki
+        )
+        log(f"{len(images)} images queued for upload")
+    elif images:
+        # Images of a page not created are not uploaded
+        store.add_images(run_id, [image.name for image in images], "failed")
+        log(f"{len(images)} images not uploaded, page not created")
+        log_step("Remove image folder")
+        shutil.rmtree(image_path, ignore_errors=True)
+
+    return wikitext if published else None
+
+
+def _completed_pages(pages: Iterable[Page]) -> Iterator[Page]:
+    """
+    Merge the page seams and yield each page once it is complete
+    """
+    merger = SeamMerger()
+    for page in pages:
+        yield from merger.add(page)
+    yield from merger.flush()
+
+
+def _image_path(page_name_final: str, run_id: int) -> str:
+    """
+    Image folder of a run, of its own so that a conversion of the same page or
+    file never removes the images a deferred upload still has to send
+
+    Env:
+        IMAGES_FOLDER: Folder of the image folders
+    """
+    return f"{os.getenv("IMAGES_FOLDER")}/{page_name_final}_{run_id}/"
+
+
+def _cache_writer(page_name_final: str, run_id: int) -> page_cache.PageCacheWriter:
+    return page_cache.PageCacheWriter(page_cache.cache_path(page_name_final), run_id)
+
+
+def _cached_pages(
+    markdown: Iterable[str], ignore_pages: str, cache: page_cache.PageCacheWriter
+) -> Iterator[tuple[int, str]]:
+    """
+    Add every page to the extraction cache and yield the pages not ignored
+    """
+    ignore_page_list = ignore_pages.split(",")
+    for number, page in iter_page_markdown(markdown, ""):
+        cache.add(number, page)
+        if str(number) not in ignore_page_list:
+            yield number, page
+
+
+def _written_lines(chunks: Iterable[str], fichier) -> Iterator[str]:
+    """
+    Write Markdown chunks to a file and yield their lines
+    """
+    for chunk in chunks:
+        fichier.write(chunk)
+        yield from chunk.split("\n")
+
+
+def upload_images(
+    conversion_run_id: int,
+    page_name_final: str,
+    images: list[Image],
+    image_path: str,
+    wiki: str = "",
+):
+    """
+    Upload the images of a conversion, in a run of its own, and remove their
+    folder. The status of each image is updated in the artifact store.
+
+    Args:
+        conversion_run_id: Run id of the conversion
+        page_name_final: Normalized page reference name
+        images: Images named and written by the conversion
+        image_path: Image folder of the conversion
+        wiki: Target wiki of the images, see wiki_registry
+    """
+    store, run_id, log_file = start_run(page_name_final, "upload_images")
+    try:
+        log_step("Upload images to Mediawiki")
+        uploader = wiki_registry.get_client(wiki)
+        if uploader.login_error:
+            log("Cant connect to mediawiki")
+        uploaded = 0
+        for image in images:
+            if uploader.upload_image(image.source, ""):
+                uploaded += 1
+                status = "uploaded"
+            else:
+                status = "failed"
+            store.set_image_status(conversion_run_id, image.name, status)
+        log(f"{uploaded}/{len(images)} images uploaded")
+
+        log_step("Remove image folder")
+        shutil.rmtree(image_path, ignore_errors=True)
+    finally:
+        finish_run(store, run_id, log_file)
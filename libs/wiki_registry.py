@@ -0,0 +1,217 @@
+"""
+Registry of the Mediawiki targets a conversion can publish to
+Each target has one client in the process, logged in at first use and kept:
+its session pools the connections and keeps the login cookies, so requests
+don't log in again. A client idle for longer than the health check interval
+is checked before use and logs in again when its session expired. A target
+whose configuration changed gets a new client.
+"""
+
+from libs.logger import log
+from libs.mediawiki_api import DEFAULT_MAX_CONCURRENCY, AimdLimiter, MediaWikiApi
+from typing import NamedTuple
+import os
+import threading
+import time
+
+# Target of MEDIAWIKI_URL, MEDIAWIKI_USER and MEDIAWIKI_MDP
+DEFAULT_TARGET = "default"
+DEFAULT_HEALTH_INTERVAL = 300
+
+
+class UnknownWikiError(ValueError):
+    """
+    Target wiki not configured
+    """
+
+
+class WikiTarget(NamedTuple):
+    name: str
+    url: str
+    username: str
+    password: str
+    max_concurrency: int
+
+
+class _Client:
+    __slots__ = ("target", "api", "lock", "logged_in", "checked_at")
+
+    def __init__(self, target: WikiTarget):
+        self.target = target
+        # Own limiter: targets on the same url don't share it, and a target
+        # whose configuration changed starts with a new one
+        self.api = MediaWikiApi(
+            target.url,
+            target.username,
+            target.password,
+            limiter=AimdLimiter(target.max_concurrency),
+        )
+        # Held during login and health checks of the target
+        self.lock = threading.Lock()
+        self.logged_in = False
+        self.checked_at = 0.0
+
+
+_clients: dict[str, _Client] = {}
+_clients_lock = threading.Lock()
+
+
+def target_names() -> list[str]:
+    """
+    Names of the configured targets, the default target first
+
+    Env:
+        MEDIAWIKI_TARGETS: Names of the other wikis separated by ,
+    """
+    names = [DEFAULT_TARGET]
+    for name in (os.getenv("MEDIAWIKI_TARGETS") or "").split(","):
+        name = name.strip().lower()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def get_target(name: str = "") -> WikiTarget:
+    """
+    Configuration of a target
+
+    Args:
+        name: Target name, the default target if empty
+
+    Env:
+        MEDIAWIKI_URL: Url of the default target
+        MEDIAWIKI_USER: User of the default target
+        MEDIAWIKI_MDP: Password of the default target
+        MEDIAWIKI_MAX_CONCURRENCY: Maximum concurrent calls to the default
+            target, 4 by default
+        MEDIAWIKI_<NAME>_URL: Url of the target NAME
+        MEDIAWIKI_<NAME>_USER: User of the target NAME, MEDIAWIKI_USER if not
+            set
+        MEDIAWIKI_<NAME>_MDP: Password of the target NAME, MEDIAWIKI_MDP if
+            not set
+        MEDIAWIKI_<NAME>_MAX_CONCURRENCY: Maximum concurrent calls to the
+            target NAME, MEDIAWIKI_MAX_CONCURRENCY if not set
+
+    Raises:
+        UnknownWikiError: Target not in MEDIAWIKI_TARGETS or without url
+    """
+    name = name.strip().lower() or DEFAULT_TARGET
+    if name not in target_names():
+        raise UnknownWikiError(f"wiki must be one of {target_names()}")
+    max_concurrency = int(
+        os.getenv("MEDIAWIKI_MAX_CONCURRENCY") or DEFAULT_MAX_CONCURRENCY
+    )
+    if name == DEFAULT_TARGET:
+        return WikiTarget(
+            name,
+            os.getenv("MEDIAWIKI_URL") or "http://wiki.example.com",
+            os.getenv("MEDIAWIKI_USER") or "adminUser",
+            os.getenv("MEDIAWIKI_MDP") or "adminPwd",
+            max_concurrency,
+        )
+
+    prefix = f"MEDIAWIKI_{name.upper()}"
+    url = os.getenv(f"{prefix}_URL")
+    if not url:
+        raise UnknownWikiError(f"{prefix}_URL is not set for wiki {name}")
+    return WikiTarget(
+        name,
+        url,
+        os.getenv(f"{prefix}_USER") or os.getenv("MEDIAWIKI_USER") or "adminUser",
+        os.getenv(f"{prefix}_MDP") or os.getenv("MEDIAWIKI_MDP") or "adminPwd",
+        int(os.getenv(f"{prefix}_MAX_CONCURRENCY") or max_concurrency),
+    )
+
+
+def _health_interval() -> float:
+    """
+    Env:
+        MEDIAWIKI_HEALTH_INTERVAL: Seconds a client stays idle before its
+            session is checked, 300 by default
+    """
+    return float(os.getenv("MEDIAWIKI_HEALTH_INTERVAL") or DEFAULT_HEALTH_INTERVAL)
+
+
+def _client(target: WikiTarget) -> _Client:
+    with _clients_lock:
+        client = _clients.get(target.name)
+        if client is None or client.target != target:
+            if client is not None:
+                client.api.session.close()
+            client = _clients[target.name] = _Client(target)
+        return client
+
+
+def get_client(name: str = "") -> MediaWikiApi:
+    """
+    Logged in client of a target, shared by the requests of the process.
+    Check login_error of the client to know if the login failed, it is
+    tried again at the next call.
+
+    Args:
+        name: Target name, the default target if empty
+
+    Raises:
+        UnknownWikiError: Target not configured
+    """
+    client = _client(get_target(name))
+    api = client.api
+    with client.lock:
+        now = time.monotonic()
+        if client.logged_in and now - client.checked_at > _health_interval():
+            client.logged_in = api.check_login()
+            if not client.logged_in:
+                log(f"Session on wiki {client.target.name} expired")
+        if client.logged_in:
+            log(f"Connection to wiki {client.target.name} reused")
+        else:
+            api.login_error = None
+            api.csrf_token = None
+            client.logged_in = api.login()
+        client.checked_at = now
+    return api
+
+
+def health() -> dict[str, dict]:
+    """
+    Check the session of each target with a logged in client. Targets not
+    used yet are not logged in here, they are at their first request.
+
+    Returns:
+        {target name: {url, healthy, concurrency limit, calls in flight}},
+        healthy is None for a target not used yet and False with an error
+        for a target not configured
+    """
+    status = {}
+    for name in target_names():
+        try:
+            client = _client(get_target(name))
+        except UnknownWikiError as e:
+            status[name] = {"healthy": False, "error": str(e)}
+            continue
+        api = client.api
+        with client.lock:
+            healthy = None
+            if client.logged_in:
+                healthy = client.logged_in = api.check_login()
+                client.checked_at = time.monotonic()
+            elif api.login_error:
+                healthy = False
+        status[name] = {
+            "url": api.url,
+            "healthy": healthy,
+            "limit": int(api.limiter.limit),
+            "max_limit": api.limiter.max_limit,
+            "in_flight": api.limiter.in_flight,
+        }
+    return status
+
+
+def close():
+    """
+    Close the sessions of all clients
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.api.session.close()
+        _clients.clear()
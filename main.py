@@ -1,28 +1,68 @@
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from libs.md_to_wikitext import md_to_wikitext
-from libs.mediawiki_api import MediaWikiApi
-from libs.logger import init_logger, log, log_step
-from libs.annotate import Annotate
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import StreamingResponse
+from libs.logger import log, log_step
+from libs.artifact_store import ArtifactStore, read_artifact
+from libs import log_tail
+from libs.annotate import shutdown_pool
+from libs.memory import MemoryGuard
+from libs import background, extraction, ingest, page_cache, pipeline, wiki_registry
 from pathlib import Path
-import pymupdf4llm
-import fitz
+import contextvars
+import json
 import os
-import shutil
+import queue
+import threading
 
-load_dotenv()
 
-
-app = FastAPI(title="PDF Text Extractor to wikitext page API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Load .env at startup. PDF libraries are imported at first conversion, or in
+    background right after startup when PRELOAD_PDF_LIBS is true, so that the
+    worker is ready without waiting for them.
+    """
+    load_dotenv()
+    if os.getenv("PRELOAD_PDF_LIBS") == "true":
+        threading.Thread(target=extraction.preload, daemon=True).start()
+    yield
+    # Deferred image uploads still queued are given some time to finish
+    background.join(SHUTDOWN_TIMEOUT)
+    shutdown_pool()
+    wiki_registry.close()
+
+
+app = FastAPI(title="PDF Text Extractor to wikitext page API", lifespan=lifespan)
+# Uploads above MAX_UPLOAD_MB are refused before their body is read
+app.add_middleware(ingest.UploadSizeLimit, paths=("/pdf-to-wikitext/",))
+
+# Run kinds, used in log file names
+RUN_KINDS = (
+    "pdf_to_wikitext",
+    "reconvert_wikitext",
+    "create_mediawiki_page",
+    "upload_images",
+)
+# Seconds given to the background jobs at shutdown
+SHUTDOWN_TIMEOUT = 60
+# markdown: pymupdf4llm Markdown then md_to_wikitext
+# direct: wikitext built from PyMuPDF spans and tables
+EXTRACTORS = ("markdown", "direct")
 
 
 @app.post("/pdf-to-wikitext/")
-async def extract_text_from_pdf(
+def extract_text_from_pdf(
     file: UploadFile = File(...),
     footer: str = Form(...),
     ignore_pages: str = Form(...),
     page_name: str = Form(...),
     generate_page: str = Form(...),
+    extractor: str = Form("markdown"),
+    profile: str = Form("accurate"),
+    defer_images: str = Form("false"),
+    stream: str = Form("false"),
+    wiki: str = Form(""),
 ):
     """
     Endpoint to transform a pdf file in a wikitext and generate a Mediawiki page
@@ -33,6 +73,19 @@ async def extract_text_from_pdf(
         ignore_pages: ignore pages number separate by ,
         page_name: Page reference name
         generate_page: if true, generate page on Mediawiki
+        extractor: markdown (default) or direct to build wikitext from PDF
+            spans without Markdown
+        profile: accurate (default) with tables and images, fast without
+            tables, images and graphics analysis, or auto to skip table
+            detection on pages without vector lines
+        defer_images: if true, create the page as soon as the wikitext is
+            ready and upload the images afterwards in background, see
+            /get-image-status/
+        stream: if true, answer with server-sent events while pages convert:
+            start (page count), page (page number and wikitext of the page
+            before ontology annotation), progress, then done (result)
+        wiki: Target wiki of the page and images, one of MEDIAWIKI_TARGETS,
+            MEDIAWIKI_URL if empty
 
     Generate:
         Log file and wikipage file
@@ -42,82 +95,159 @@ async def extract_text_from_pdf(
         MEDIAWIKI_USER: User for Mediawiki connexion
         MEDIAWIKI_MDP: Password for Mediawiki connexion
         OUTPUT_FOLDER: Output folder for log and Mediawiki page file
+        ONTOLOGY_FILE: Ontology used to annotate wikitext (optional)
+        EXTRACTION_WINDOW_PAGES: Number of pages extracted at a time
+        MAX_RSS_MB: Memory ceiling of the worker in MiB (optional)
+        MAX_UPLOAD_MB: Size limit of the PDF file in MiB, 413 above
 
     Returns:
-        Nothing
+        Nothing, or text/event-stream when stream is true
     """
     if not page_name:
         raise HTTPException(status_code=400, detail="page_name must be fill")
+    if extractor not in EXTRACTORS:
+        raise HTTPException(
+            status_code=400, detail=f"extractor must be one of {EXTRACTORS}"
+        )
+    if profile not in extraction.EXTRACTION_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"profile must be one of {extraction.EXTRACTION_PROFILES}",
+        )
+    _check_wiki(wiki)
 
     page_name_final = page_name.lower().replace(" ", "_")
 
-    init_logger(
-        f"{page_name_final}_pdf_to_wikitext", os.getenv("OUTPUT_FOLDER") or "./output"
-    )
-
-    log_step("Init application")
-    txt_output_filename = f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}.txt"
-    md_output_filename = f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}.md"
-    if os.path.exists(txt_output_filename):
-        os.unlink(txt_output_filename)
-    if os.path.exists(md_output_filename):
-        os.unlink(md_output_filename)
-    image_path = f"{os.getenv("IMAGES_FOLDER")}/{file.filename[:-4]}/"  # type: ignore
-
-    log_step("Create temporary file")
-    temp_file = Path(f"{os.getenv("OUTPUT_FOLDER")}/{page_name_final}.pdf")
-    with temp_file.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    log_step("Transform Pdf content to md text and store image")
+    store, run_id, log_file = pipeline.start_run(page_name_final, "pdf_to_wikitext")
+    memory = MemoryGuard()
     try:
-        doc = fitz.open(temp_file)
-        md_text = pymupdf4llm.to_markdown(
-            doc,
-            write_images=True,
-            image_path=image_path,
-            page_separators=True,
-        )
-        doc.close()
-    except Exception as e:
-        log(f"Error in PDF to MD transformation: {str(e)}")
+        upload = pipeline.ingest_upload(file.file, page_name_final, run_id)
+    except ingest.IngestError as e:
+        pipeline.finish_run(store, run_id, log_file)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    events: queue.Queue = queue.Queue()
+
+    def convert():
+        wikitext = None
+        try:
+            wikitext = pipeline.pdf_to_wikitext(
+                upload,
+                footer,
+                ignore_pages,
+                page_name_final,
+                generate_page == "true",
+                extractor,
+                store,
+                run_id,
+                memory,
+                profile=profile,
+                defer_images=defer_images == "true",
+                events=(
+                    (lambda event, data: events.put((event, data)))
+                    if stream == "true"
+                    else None
+                ),
+                wiki=wiki,
+            )
+        finally:
+            # Also removed when the conversion failed
+            pipeline.remove_upload(upload)
+            memory.log_peak()
+            pipeline.finish_run(store, run_id, log_file)
+            if stream == "true":
+                result = "success" if wikitext is not None else "error"
+                events.put(("done", {"result": result, "log_file": log_file.name}))
+                events.put(None)
+
+    if stream != "true":
+        convert()
         return
 
-    log_step("Remove temporary file")
-    os.unlink(temp_file)
+    # Conversion runs in its own thread with the logger of the run, the
+    # response sends its events as they come
+    threading.Thread(
+        target=contextvars.copy_context().run, args=(convert,), daemon=True
+    ).start()
+
+    def stream_events():
+        while (item := events.get()) is not None:
+            event, data = item
+            event_id = f"id: {data['page']}\n" if event == "page" else ""
+            yield f"event: {event}\n{event_id}data: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Log-File": log_file.name},
+    )
 
-    log_step("Create md file")
-    with open(md_output_filename, "w", encoding="utf-8") as fichier:
-        fichier.write(md_text)
 
-    log_step("Transform MD to wikitext and create image on Mediawiki")
-    try:
-        wikitext = md_to_wikitext(
-            md_text, footer, ignore_pages, page_name_final, image_path
-        )
-    except Exception as e:
-        log(f"Error in MD to WIKITEXT transformation: {str(e)}")
-        return
+@app.post("/reconvert-wikitext/")
+def reconvert_wikitext(
+    footer: str = Form(...),
+    ignore_pages: str = Form(...),
+    page_name: str = Form(...),
+    generate_page: str = Form(...),
+    defer_images: str = Form("false"),
+    wiki: str = Form(""),
+):
+    """
+    Endpoint to transform again the last extraction of a page_name with
+    another footer or ignore_pages, without uploading the PDF file
 
-    log_step("Remove image folder")
-    shutil.rmtree(image_path)
+    Args:
+        footer: Reference footer
+        ignore_pages: ignore pages number separate by ,
+        page_name: Page reference name
+        generate_page: if true, generate page on Mediawiki
+        defer_images: if true, create the page before uploading the images
+        wiki: Target wiki of the page and images, one of MEDIAWIKI_TARGETS,
+            MEDIAWIKI_URL if empty
 
-    log_step("Create wikitext file")
-    with open(txt_output_filename, "w", encoding="utf-8") as fichier:
-        fichier.write(wikitext)
+    Generate:
+        Log file and wikipage file
 
-    log_step("Annotate wikitext with ontology")
-    annotation = Annotate()
-    annotation.annotate_section(wikitext)
+    Env:
+        MEDIAWIKI_URL: Url of Mediawiki to generate images and page
+        MEDIAWIKI_USER: User for Mediawiki connexion
+        MEDIAWIKI_MDP: Password for Mediawiki connexion
+        OUTPUT_FOLDER: Output folder for log, Mediawiki page and cache files
+        ONTOLOGY_FILE: Ontology used to annotate wikitext (optional)
 
-    if generate_page == "true":
-        log_step("Create Mediawiki page")
-        mediawiki_api = MediaWikiApi()
-        if not mediawiki_api.login():
-            log("Cant connect to mediawiki")
-        else:
-            return_page_url = mediawiki_api.create_page(page_name_final, wikitext)
-            log(f"Page generation result: {return_page_url}")
+    Returns:
+        Nothing
+    """
+    if not page_name:
+        raise HTTPException(status_code=400, detail="page_name must be fill")
+
+    _check_wiki(wiki)
+    page_name_final = page_name.lower().replace(" ", "_")
+    if not page_cache.cache_path(page_name_final).exists():
+        raise HTTPException(
+            status_code=404, detail=f"No extraction cached for '{page_name_final}'"
+        )
+
+    store, run_id, log_file = pipeline.start_run(page_name_final, "reconvert_wikitext")
+    memory = MemoryGuard()
+    try:
+        wikitext = pipeline.reconvert_wikitext(
+            page_name_final,
+            footer,
+            ignore_pages,
+            generate_page == "true",
+            store,
+            run_id,
+            memory,
+            defer_images=defer_images == "true",
+            wiki=wiki,
+        )
+    finally:
+        memory.log_peak()
+        pipeline.finish_run(store, run_id, log_file)
+    if wikitext is None:
+        raise HTTPException(
+            status_code=500, detail=f"Conversion failed, see {log_file.name}"
+        )
 
 
 @app.post("/get-wikitext-file/")
@@ -150,6 +280,34 @@ async def get_wikitext_file(
     return content
 
 
+@app.post("/get-image-status/")
+async def get_image_status(
+    page_name: str = Form(...),
+):
+    """
+    Endpoint to get the upload status of the images deferred by the last
+    conversion or reconversion of a page_name
+
+    Args:
+        page_name: Page reference name
+
+    Env:
+        OUTPUT_FOLDER: Output folder for log and Mediawiki page file
+
+    Returns:
+        run_id, total, pending, uploaded, failed and status of each image
+    """
+    if not page_name:
+        raise HTTPException(status_code=400, detail="page_name must be fill")
+
+    page_name_final = page_name.lower().replace(" ", "_")
+
+    status = ArtifactStore().get_image_status(page_name_final)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Conversion not found")
+    return status
+
+
 @app.post("/get-last-log/")
 async def get_last_log(
     page_name: str = Form(...),
@@ -171,24 +329,152 @@ async def get_last_log(
 
     page_name_final = page_name.lower().replace(" ", "_")
 
-    dir_path = Path(os.getenv("OUTPUT_FOLDER") or ".")
+    latest_file = _get_last_log_file(page_name_final)
+
+    return read_artifact(latest_file)
 
-    pattern = f"{page_name_final}*.log"
-    log_files = list(dir_path.glob(pattern))
+
+@app.post("/get-log-tail/")
+async def get_log_tail(
+    page_name: str = Form(...),
+    offset: int = Form(0),
+    log_file: str = Form(""),
+):
+    """
+    Endpoint to get the lines added to the last log of a page_name since a cursor
+
+    Args:
+        page_name: Page reference name
+        offset: Byte offset returned by the previous call (0 for the first call)
+        log_file: Log file name returned by the previous call
+
+    Env:
+        OUTPUT_FOLDER: Output folder for log and Mediawiki page file
+
+    Returns:
+        log_file: Name of the last log file
+        offset: Cursor to send on the next call
+        content: New complete lines since offset
+    """
+    if not page_name:
+        raise HTTPException(status_code=400, detail="page_name must be fill")
+
+    page_name_final = page_name.lower().replace(" ", "_")
+
+    latest_file = _get_last_log_file(page_name_final)
+    if log_file != latest_file.name:
+        # A new run started since the previous call
+        offset = 0
+
+    content, next_offset = log_tail.read_from_offset(latest_file, offset)
+    return {"log_file": latest_file.name, "offset": next_offset, "content": content}
+
+
+@app.get("/stream-log/")
+async def stream_log(
+    request: Request,
+    page_name: str,
+    offset: int = 0,
+    steps_only: bool = True,
+    idle_timeout: float = 30,
+):
+    """
+    Endpoint to follow the last log of a page_name as server-sent events
+
+    Args:
+        page_name: Page reference name
+        offset: Byte offset to start from, overridden by Last-Event-ID header
+        steps_only: if true, only push log_step lines
+        idle_timeout: Seconds without new line before closing the stream
+
+    Env:
+        OUTPUT_FOLDER: Output folder for log and Mediawiki page file
+
+    Returns:
+        text/event-stream of log lines, event id is the byte offset after the line
+    """
+    if not page_name:
+        raise HTTPException(status_code=400, detail="page_name must be fill")
+
+    page_name_final = page_name.lower().replace(" ", "_")
+
+    latest_file = _get_last_log_file(page_name_final)
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id)
+
+    async def events():
+        async for line, line_offset in log_tail.follow(
+            latest_file, offset, steps_only, idle_timeout=idle_timeout
+        ):
+            if await request.is_disconnected():
+                break
+            yield f"id: {line_offset}\ndata: {line}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Log-File": latest_file.name},
+    )
+
+
+@app.get("/wiki-health/")
+def wiki_health():
+    """
+    Endpoint to check the clients of the target wikis
+
+    Env:
+        MEDIAWIKI_TARGETS: Names of the other wikis separated by ,
+
+    Returns:
+        For each target: url, healthy (None until its first use), concurrency
+        limit and calls in flight
+    """
+    return wiki_registry.health()
+
+
+def _check_wiki(wiki: str):
+    """
+    Raise a 400 if the target wiki is not configured
+    """
+    try:
+        wiki_registry.get_target(wiki)
+    except wiki_registry.UnknownWikiError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _get_last_log_file(page_name_final: str) -> Path:
+    """
+    Get the last log file of a page_name
+
+    Args:
+        page_name_final: Normalized page reference name
+
+    Returns:
+        Path of the last log file, raise a 404 if there is none
+    """
+    latest_file = ArtifactStore().get_last_artifact(page_name_final, "log")
+    if latest_file is not None and latest_file.exists():
+        return latest_file
+
+    # Logs written before the artifact index
+    dir_path = Path(os.getenv("OUTPUT_FOLDER") or ".")
+    log_files = [
+        log_file
+        for kind in RUN_KINDS
+        for log_file in dir_path.glob(f"{page_name_final}_{kind}_*.log")
+    ]
     if not log_files:
         raise HTTPException(status_code=404, detail=f"Log file not found")
 
-    latest_file = max(log_files, key=lambda f: f.stat().st_mtime)
-
-    with open(latest_file, "r", encoding="utf-8") as f:
-        content = f.read()
-    return content
+    return max(log_files, key=lambda f: f.stat().st_mtime)
 
 
 @app.post("/create-mediawiki-page/")
-async def create_mediawiki_page(
+def create_mediawiki_page(
     file: UploadFile = File(...),
     page_name: str = Form(...),
+    wiki: str = Form(""),
 ):
     """
     Endpoint to create a Mediawiki page
@@ -196,6 +482,8 @@ async def create_mediawiki_page(
     Args:
         file: TXT file with wikitext data
         page_name: Page reference name
+        wiki: Target wiki of the page, one of MEDIAWIKI_TARGETS,
+            MEDIAWIKI_URL if empty
 
     Generate:
         Log file and wikipage file
@@ -212,23 +500,25 @@ async def create_mediawiki_page(
     if not page_name:
         raise HTTPException(status_code=400, detail="page_name must be fill")
 
+    _check_wiki(wiki)
     page_name_final = page_name.lower().replace(" ", "_")
     return_page_url = ""
 
-    init_logger(
-        f"{page_name_final}_create_mediawiki_page",
-        os.getenv("OUTPUT_FOLDER") or "./output",
+    store, run_id, log_file = pipeline.start_run(
+        page_name_final, "create_mediawiki_page"
     )
+    try:
+        log_step("Get file content")
+        content = file.file.read()
+        text_content = content.decode("utf-8")
 
-    log_step("Get file content")
-    content = await file.read()
-    text_content = content.decode("utf-8")
-
-    log_step("Create Mediawiki page")
-    mediawiki_api = MediaWikiApi()
-    if not mediawiki_api.login():
-        log("Cant connect to mediawiki")
-    else:
-        return_page_url = mediawiki_api.create_page(page_name_final, text_content)
+        log_step("Create Mediawiki page")
+        mediawiki_api = wiki_registry.get_client(wiki)
+        if mediawiki_api.login_error:
+            log("Cant connect to mediawiki")
+        else:
+            return_page_url = mediawiki_api.create_page(page_name_final, text_content)
+    finally:
+        pipeline.finish_run(store, run_id, log_file)
 
     return return_page_url
@@ -1,11 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
 from pathlib import Path
+from libs.annotate import Annotate, shutdown_pool
+from libs.artifact_store import ArtifactStore, read_artifact
+from libs.document import render_markdown, render_wikitext
+from libs.logger import init_logger, close_logger
+from libs.md_to_wikitext import (
+    convert_markdown_page,
+    iter_page_markdown,
+    merge_converted_pages,
+    parse_markdown,
+)
+from libs.mediawiki_api import AimdLimiter, MediaWikiApi
+from libs import wiki_registry
+from tests.fake_mediawiki import FakeWiki, serve
+import json
 import logging
 import os
 import pytest
+import re
 import requests_mock
 import shutil
+import subprocess
+import sys
+import threading
 
 load_dotenv("tests/.env.test")
 
@@ -27,6 +46,11 @@ def txt_test_file_path():
     return Path(__file__).parent / "tests/test_file.txt"
 
 
+@pytest.fixture
+def ontology_file_path():
+    return Path(__file__).parent / "tests/ontology.tsv"
+
+
 def remove_output_files():
     dir_path = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
     files = list(dir_path.glob("*"))
@@ -50,6 +74,9 @@ def setup_teardown():
 
     yield
 
+    # Each test has its own wiki, clients are not kept between tests
+    wiki_registry.close()
+
     loggers = [logging.getLogger()] + [
         logging.getLogger(name) for name in logging.root.manager.loggerDict
     ]
@@ -105,7 +132,9 @@ def test_pdf_to_wikitext_workflow_success(client, pdf_test_file_path):
     assert "Test document **0**" in content
     assert "|Test1|Description 1||" in content
     assert "**1.2** **Menu for table**" in content
-    assert "![](./tests/images/test_file/test_page.pdf-1-0.png)" in content
+    assert re.search(
+        r"!\[\]\(\./tests/images/test_page_\d+/test_page\.pdf-1-0\.png", content
+    )
 
     file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
     content = file.read_text()
@@ -194,7 +223,9 @@ def test_pdf_to_wikitext_workflow_success_without_create_page(
     assert "Test document **0**" in content
     assert "|Test1|Description 1||" in content
     assert "**1.2** **Menu for table**" in content
-    assert "![](./tests/images/test_file/test_page.pdf-1-0.png)" in content
+    assert re.search(
+        r"!\[\]\(\./tests/images/test_page_\d+/test_page\.pdf-1-0\.png", content
+    )
 
     file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
     content = file.read_text()
@@ -281,7 +312,9 @@ def test_pdf_to_wikitext_workflow_success_without_page_0(client, pdf_test_file_p
     assert "Test document **0**" in content
     assert "|Test1|Description 1||" in content
     assert "**1.2** **Menu for table**" in content
-    assert "![](./tests/images/test_file/test_page.pdf-1-0.png)" in content
+    assert re.search(
+        r"!\[\]\(\./tests/images/test_page_\d+/test_page\.pdf-1-0\.png", content
+    )
 
     file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
     content = file.read_text()
@@ -509,6 +542,981 @@ def test_get_last_log_without_page_name(client, pdf_test_file_path):
     assert response.status_code == 400
 
 
+def mock_mediawiki(m):
+    m.get(
+        "http://localhost/api.php",
+        json={
+            "batchcomplete": "",
+            "query": {
+                "tokens": {
+                    "logintoken": "1a033b71d2973e4110448f69d65591ef691d95c8+\\",
+                    "csrftoken": "1a033b71d2973e4",
+                }
+            },
+        },
+    )
+    m.post(
+        "http://localhost/api.php",
+        json={
+            "login": {"result": "Success"},
+            "upload": {"result": "Success"},
+            "edit": {"result": "Success", "new": "", "title": "Test page"},
+        },
+        status_code=200,
+    )
+
+
+def convert_test_file(client, pdf_test_file_path, **data):
+    with open(pdf_test_file_path, "rb") as f:
+        return client.post(
+            "/pdf-to-wikitext",
+            files={"file": ("test_file.pdf", f, "application/pdf")},
+            data={
+                "footer": "Test document",
+                "ignore_pages": "",
+                "page_name": "Test page",
+                "generate_page": "false",
+                **data,
+            },
+        )
+
+
+def test_pdf_to_wikitext_direct_extractor(client, pdf_test_file_path):
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        response = convert_test_file(
+            client, pdf_test_file_path, ignore_pages="2", extractor="direct"
+        )
+        assert response.status_code == 200
+
+    # Markdown rendered from the document
+    file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.md"
+    content = file.read_text()
+    assert "## 1 Menu level 1" in content
+    assert "Test paragraf with **bold text** inside" in content
+    assert "|Test1|Description 1|" in content
+    assert "![](test_page 0.png)" in content
+    assert "--- end of page=0 ---" in content
+
+    file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    content = file.read_text()
+    assert "Test document" not in content
+    assert "== First page title ==" in content
+    assert "== 1 Menu level 1 ==" in content
+    assert "=== 1.1 Menu level 2 ===" in content
+    assert "Test paragraf with '''bold text''' inside" in content
+    assert "| Test1 || Description 1" in content
+    assert "| Test2 || Description 2 || Comment" in content
+    assert "[[File:test_page 0.png|center|thumb]]" in content
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    content = response.text
+    assert ": Transform Pdf content to wikitext and create image on Mediawiki" in (
+        content
+    )
+    assert "test_page 0.png uploaded with success" in content
+
+
+@pytest.mark.parametrize("extractor", ["markdown", "direct"])
+def test_pdf_to_wikitext_header_footer_detection(client, tmp_path, extractor):
+    import fitz
+
+    pdf_path = tmp_path / "header_footer.pdf"
+    doc = fitz.open()
+    for number, body in enumerate(["Sales grew", "Costs fell", "Profit rose"]):
+        page = doc.new_page()
+        page.insert_text((72, 40), "ACME quarterly report", fontsize=9)
+        page.insert_text((72, 200), body, fontsize=11)
+        page.insert_text((280, 820), f"Page {number + 1} of 3", fontsize=9)
+    doc.save(pdf_path)
+    doc.close()
+
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        response = convert_test_file(client, pdf_path, footer="", extractor=extractor)
+        assert response.status_code == 200
+
+    file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    content = file.read_text()
+    assert "Sales grew" in content
+    assert "Profit rose" in content
+    assert "ACME" not in content
+    assert "of 3" not in content
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert "Header and footer margins: top" in response.text
+
+
+@pytest.mark.parametrize("extractor", ["markdown", "direct"])
+def test_pdf_to_wikitext_page_windows(
+    client, pdf_test_file_path, monkeypatch, extractor
+):
+    output_file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path, extractor=extractor)
+        expected = output_file.read_text()
+
+        # Ceiling always reached: window of 2 pages, then 1 page, serial
+        monkeypatch.setenv("EXTRACTION_WINDOW_PAGES", "2")
+        monkeypatch.setenv("MAX_RSS_MB", "1")
+        response = convert_test_file(client, pdf_test_file_path, extractor=extractor)
+        assert response.status_code == 200
+
+    assert output_file.read_text() == expected
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    content = response.text
+    assert "Memory ceiling reached, page window reduced to 1" in content
+    assert "Memory ceiling reached, sections annotated serially" in content
+    assert "Peak memory: " in content
+
+
+def test_memory_guard_pauses_once(tmp_path, monkeypatch):
+    from libs import memory
+
+    monkeypatch.setattr(memory, "PAUSE_SECONDS", 0)
+    log_file = init_logger("memory", tmp_path)
+    try:
+        guard = memory.MemoryGuard(max_rss_mb=1)
+        assert [guard.next_window(window) for window in (2, 1, 1, 1)] == [1] * 4
+    finally:
+        close_logger()
+
+    # Only the first page window of 1 waits, the next ones go on serially
+    content = log_file.read_text()
+    assert content.count("waiting for memory") == memory.PAUSE_MAX_TRIES
+    assert "Memory ceiling still reached, pages extracted one at a time" in content
+
+
+@pytest.mark.parametrize("extractor", ["markdown", "direct"])
+def test_pdf_to_wikitext_concurrent_conversions(
+    client, pdf_test_file_path, tmp_path, extractor
+):
+    import fitz
+
+    pdf_path = tmp_path / "concurrent.pdf"
+    with fitz.open(pdf_test_file_path) as source, fitz.open() as doc:
+        for _ in range(5):
+            doc.insert_pdf(source)
+        doc.save(pdf_path)
+
+    def convert(number):
+        with open(pdf_path, "rb") as f:
+            return client.post(
+                "/pdf-to-wikitext",
+                files={"file": (f"file_{number}.pdf", f, "application/pdf")},
+                data={
+                    "footer": "Test document",
+                    "ignore_pages": "",
+                    "page_name": f"Concurrent {number}",
+                    "generate_page": "false",
+                    "extractor": extractor,
+                },
+            ).status_code
+
+    # PyMuPDF calls of the requests running in the threadpool are serialized
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        with ThreadPoolExecutor(4) as executor:
+            assert list(executor.map(convert, range(4))) == [200] * 4
+
+    output_folder = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
+    contents = [
+        (output_folder / f"concurrent_{number}.txt").read_text() for number in range(4)
+    ]
+    assert "| Test2 || Description 2 || Comment" in contents[0]
+    for number, content in enumerate(contents):
+        assert content == contents[0].replace("concurrent_0", f"concurrent_{number}")
+
+
+@pytest.mark.parametrize("extractor", ["markdown", "direct"])
+def test_pdf_to_wikitext_extraction_profiles(client, pdf_test_file_path, extractor):
+    output_file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path, extractor=extractor)
+        expected = output_file.read_text()
+
+        # Only the table page has vector lines, same result as accurate
+        response = convert_test_file(
+            client, pdf_test_file_path, extractor=extractor, profile="auto"
+        )
+        assert response.status_code == 200
+        assert output_file.read_text() == expected
+        response = client.post("/get-last-log", data={"page_name": "Test page"})
+        assert "Extraction profile auto: 2 pages accurate in " in response.text
+        assert "Extraction profile auto: 1 pages no_tables in " in response.text
+        assert re.search(r"Page \d extracted in [\d.]+s \(accurate\)", response.text)
+
+        response = convert_test_file(
+            client, pdf_test_file_path, extractor=extractor, profile="fast"
+        )
+        assert response.status_code == 200
+
+    content = output_file.read_text()
+    assert "=== 1.1 Menu level 2 ===" in content
+    assert "Test2" in content
+    assert "| Test2 ||" not in content
+    assert "[[File:" not in content
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert "Extraction profile fast: 3 pages fast in " in response.text
+
+
+def test_pdf_to_wikitext_unknown_profile(client, pdf_test_file_path):
+    response = convert_test_file(client, pdf_test_file_path, profile="other")
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("extractor", ["markdown", "direct"])
+def test_pdf_to_wikitext_stream(client, pdf_test_file_path, extractor):
+    output_file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path, extractor=extractor)
+        expected = output_file.read_text()
+
+        response = convert_test_file(
+            client, pdf_test_file_path, extractor=extractor, stream="true"
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = [
+        (
+            re.search(r"^event: (\w+)$", block, re.M).group(1),
+            json.loads(re.search(r"^data: (.*)$", block, re.M).group(1)),
+        )
+        for block in response.text.split("\n\n")
+        if block
+    ]
+    assert events[0] == ("start", {"pages": 3})
+    pages = [data for event, data in events if event == "page"]
+    assert [page["page"] for page in pages] == [0, 1, 2]
+    assert "=== 1.1 Menu level 2 ===" in pages[0]["wikitext"] + pages[1]["wikitext"]
+    assert [data for event, data in events if event == "progress"][-1] == {
+        "page": 2,
+        "pages": 3,
+    }
+    assert events[-1][0] == "done"
+    assert events[-1][1]["result"] == "success"
+
+    # Same page as without stream
+    assert output_file.read_text() == expected
+
+
+def test_pdf_to_wikitext_upload_ingestion(
+    client, pdf_test_file_path, txt_test_file_path, monkeypatch
+):
+    import hashlib
+
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        response = convert_test_file(client, pdf_test_file_path)
+        assert response.status_code == 200
+
+    sha256 = hashlib.sha256(pdf_test_file_path.read_bytes()).hexdigest()
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert f"Upload of 73813 bytes, 3 pages, SHA-256 {sha256}" in response.text
+    store = ArtifactStore()
+    assert store.get_source(sha256, "test_page", "", False) is not None
+    assert store.get_source(sha256, "test_page", "default", True) is None
+    assert store.get_source(sha256, "other_page", "", False) is None
+
+    response = convert_test_file(client, txt_test_file_path)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "File is not a PDF file"
+
+    # Refused while read, then from its Content-Length before reading
+    monkeypatch.setenv("MAX_UPLOAD_MB", "0.05")
+    response = convert_test_file(client, pdf_test_file_path)
+    assert response.status_code == 413
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert "Upload rejected: File is larger than 0.05 MiB" in response.text
+    output_folder = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
+    # Temporary files of the runs and their folders are removed
+    assert not [path for path in output_folder.iterdir() if path.is_dir()]
+
+    monkeypatch.setenv("MAX_UPLOAD_MB", "0.001")
+    response = convert_test_file(client, pdf_test_file_path, page_name="Other page")
+    assert response.status_code == 413
+    response = client.post("/get-last-log", data={"page_name": "Other page"})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("stream", ["false", "true"])
+def test_reconvert_wikitext_from_cache(client, pdf_test_file_path, stream):
+    output_folder = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
+    wikitext_file = output_folder / "test_page.txt"
+    md_file = output_folder / "test_page.md"
+    reconvert_data = {
+        "footer": "",
+        "ignore_pages": "0",
+        "page_name": "Test page",
+        "generate_page": "true",
+    }
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        response = convert_test_file(client, pdf_test_file_path, **reconvert_data)
+        assert response.status_code == 200
+        expected = wikitext_file.read_text()
+        assert "Test document '''1'''" in expected
+        assert "[[File:test_page 0.png|center|thumb]]" in expected
+
+        response = convert_test_file(client, pdf_test_file_path, stream=stream)
+        assert response.status_code == 200
+        assert (output_folder / "test_page.pages").exists()
+        assert "Test document '''1'''" not in wikitext_file.read_text()
+        markdown = md_file.read_text()
+
+        # Same wikitext as a conversion of the PDF file with these values
+        response = client.post("/reconvert-wikitext", data=reconvert_data)
+        assert response.status_code == 200
+        assert wikitext_file.read_text() == expected
+        assert md_file.read_text() == markdown
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert "Read extraction cache" in response.text
+    assert "1 images restored" in response.text
+    assert "test_page 0.png uploaded with success" in response.text
+    images_folder = Path(__file__).parent / f"{os.getenv("IMAGES_FOLDER")}"
+    assert not [folder for folder in images_folder.iterdir() if folder.is_dir()]
+
+    reconvert_data["page_name"] = "Other page"
+    response = client.post("/reconvert-wikitext", data=reconvert_data)
+    assert response.status_code == 404
+
+
+def test_page_cache_concurrent_writers(tmp_path):
+    from libs.page_cache import PageCache, PageCacheWriter
+
+    path = tmp_path / "test_page.pages"
+    with PageCacheWriter(path, 1) as first, PageCacheWriter(path, 2) as second:
+        first.add(0, "First run")
+        second.add(0, "Second run")
+
+    # Each run wrote its own file, the last closed is the cache
+    with PageCache(path) as cache:
+        assert cache.run_id == 1
+        assert list(cache.pages("", "")) == [(0, "First run")]
+    assert [file.name for file in tmp_path.iterdir()] == ["test_page.pages"]
+
+
+def test_pdf_to_wikitext_unknown_extractor(client, pdf_test_file_path):
+    response = convert_test_file(client, pdf_test_file_path, extractor="other")
+
+    assert response.status_code == 400
+
+
+def test_get_log_tail_success(client, pdf_test_file_path):
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path)
+
+    response = client.post("/get-log-tail", data={"page_name": "Test page"})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["log_file"].startswith("test_page_pdf_to_wikitext")
+    assert ": Init application" in result["content"]
+    assert ": Annotate wikitext with ontology" in result["content"]
+    assert result["offset"] == len(result["content"].encode("utf-8"))
+
+    response = client.post(
+        "/get-log-tail",
+        data={
+            "page_name": "Test page",
+            "offset": result["offset"],
+            "log_file": result["log_file"],
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["content"] == ""
+    assert response.json()["offset"] == result["offset"]
+
+    response = client.post(
+        "/get-log-tail",
+        data={"page_name": "Test page", "offset": 10, "log_file": "other.log"},
+    )
+    assert response.json()["content"] == result["content"]
+
+
+def test_read_from_offset_long_line(tmp_path, monkeypatch):
+    from libs import log_tail
+
+    log_file = tmp_path / "long.log"
+    log_file.write_text("a" * 10 + "\nend")
+
+    # A line longer than the read is returned in parts
+    assert log_tail.read_from_offset(log_file, 0, 4) == ("aaaa", 4)
+    assert log_tail.read_from_offset(log_file, 8, 4) == ("aa\n", 11)
+    # The last line may still be written
+    assert log_tail.read_from_offset(log_file, 11, 4) == ("", 11)
+
+    monkeypatch.setattr(log_tail, "MMAP_THRESHOLD", 2)
+    assert log_tail.read_from_offset(log_file, 0, 4) == ("aaaa", 4)
+    assert log_tail.read_from_offset(log_file, 11, 4) == ("", 11)
+
+
+def test_get_log_tail_not_found(client):
+    response = client.post("/get-log-tail", data={"page_name": "Test page1"})
+
+    assert response.status_code == 404
+
+
+def test_stream_log_success(client, pdf_test_file_path):
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path)
+
+    response = client.get(
+        "/stream-log", params={"page_name": "Test page", "idle_timeout": 0.1}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    content = response.text
+    assert ": Init application" in content
+    assert ": Create wikitext file" in content
+    assert "Connection done" not in content
+
+    events = [event for event in content.split("\n\n") if event]
+    last_offset = events[-1].split("\n")[0][len("id: ") :]
+    response = client.get(
+        "/stream-log",
+        params={"page_name": "Test page", "idle_timeout": 0.1},
+        headers={"Last-Event-ID": last_offset},
+    )
+    assert response.text == ""
+
+
+def test_get_last_log_exact_page_name(client, pdf_test_file_path):
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path)
+
+    response = client.post("/get-last-log", data={"page_name": "Test"})
+
+    assert response.status_code == 404
+
+    file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
+    log_file = ArtifactStore(file).get_last_artifact("test_page", "log")
+    assert log_file is not None
+    timings = ArtifactStore(file).get_last_artifact("test_page", "timings")
+    assert timings is not None
+    assert '"message": "Init application"' in timings.read_text()
+    assert ArtifactStore(file).get_last_artifact("test_page", "txt") is not None
+
+
+def test_artifact_store_retention_and_compression(tmp_path, monkeypatch):
+    # Runs are kept unless a retention is set
+    monkeypatch.delenv("ARTIFACT_KEEP_RUNS", raising=False)
+    assert ArtifactStore(tmp_path).keep_runs == 0
+
+    monkeypatch.setenv("ARTIFACT_KEEP_RUNS", "2")
+    monkeypatch.setenv("ARTIFACT_COMPRESS", "true")
+    store = ArtifactStore(tmp_path)
+    md_file = tmp_path / "page.md"
+    log_files = []
+    for index in range(3):
+        run_id = store.start_run("page", "pdf_to_wikitext")
+        log_file = tmp_path / f"page_pdf_to_wikitext_{index}.log"
+        log_file.write_text(f"log {index}\n")
+        md_file.write_text(f"md {index}\n")
+        log_files.append(log_file)
+        store.add_artifact(run_id, "log", log_file)
+        store.add_artifact(run_id, "md", md_file)
+        store.finish_run(run_id)
+
+    assert not log_files[0].exists()
+    assert not log_files[1].exists()
+    assert read_artifact(log_files[1].with_name(log_files[1].name + ".gz")) == (
+        "log 1\n"
+    )
+    assert store.get_last_artifact("page", "log") == log_files[2]
+    assert md_file.read_text() == "md 2\n"
+
+
+def test_document_parse_and_render(monkeypatch):
+    md_text = (
+        "# **Title**\n\nA paragraph cut\n\nby the line and\n\n"
+        "Test document **1**\n\n--- end of page=0 ---\n\n"
+        "the page.\n\n**1.1** **Menu**\n\n- Item\n\n"
+        "|A|B|\n|---|---|\n|a||\n\n![](/tmp/image.png)\n\n"
+        "--- end of page=1 ---\n\n"
+    )
+    document = parse_markdown(md_text, "Test document", "")
+    document.merge_page_seams()
+    document.name_images("Test")
+
+    assert [len(page.nodes) for page in document.pages] == [2, 4]
+    assert render_wikitext(document.nodes()) == (
+        "= '''Title''' =\n\n"
+        "A paragraph cut by the line and the page.\n"
+        "=== 1.1 Menu ===\n\n"
+        "* Item\n\n"
+        '{| class="wikitable"\n! A !! B\n|-\n| a\n|}\n\n'
+        "[[File:Test 0.png|center|thumb]]"
+    )
+    assert [len(section) for section in document.sections()] == [2, 4]
+    assert "# **Title**" in render_markdown(document)
+    assert "![](Test 0.png)" in render_markdown(document)
+
+    document = parse_markdown(md_text, "", "1")
+    assert [page.number for page in document.pages] == [0]
+    assert "Test document '''1'''" in render_wikitext(document.nodes())
+
+    monkeypatch.setenv("NORMALIZE_HEADINGS", "true")
+    document = parse_markdown(md_text, "Test document", "")
+    assert render_wikitext(document.nodes()).startswith("== Title ==\n\n")
+
+
+def test_convert_pages_independently():
+    md_text = "".join(
+        f"the end, a cut\n\n![](/tmp/{page}a.png)\n\n![](/tmp/{page}b.png)\n\n"
+        f"by the page {page} and\n\n--- end of page={page} ---\n\n"
+        + ("# Title\n\n" if page % 3 == 0 else "")
+        for page in range(12)
+    )
+    document = parse_markdown(md_text, "", "4")
+    document.merge_page_seams()
+    document.name_images("Test")
+    expected = [render_wikitext(page.nodes) for page in document.pages]
+
+    # Pages converted in any order with a wrong image offset
+    pages = list(iter_page_markdown(md_text, "4"))
+    with ThreadPoolExecutor(4) as executor:
+        converted = list(
+            executor.map(
+                lambda page: convert_markdown_page(*page, "", "Test"),
+                reversed(pages),
+            )
+        )
+    merged = list(merge_converted_pages(reversed(converted), "Test"))
+
+    assert [page.page.number for page in merged] == [
+        page.number for page in document.pages
+    ]
+    assert [page.wikitext for page in merged] == expected
+    assert [image.name for page in merged for image in page.images] == [
+        image.name for image in document.images()
+    ]
+    assert converted[-1].images[0].name == "Test 0.png"
+
+
+def test_upload_image_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_CHUNK_SIZE", "1000")
+    image = tmp_path / "big image.png"
+    image.write_bytes(bytes(range(256)) * 10)
+    offsets = []
+    failures = [1000]
+
+    def api_post(request, context):
+        body = request.body
+        if isinstance(body, str):
+            # Publication of the stashed file, without file content
+            assert "filekey=key.1" in body
+            return {"upload": {"result": "Success"}}
+        offset = int(re.search(rb'name="offset"\r\n\r\n(\d+)', body).group(1))
+        if offset in failures:
+            failures.remove(offset)
+            return {"error": {"code": "stashfailed", "info": "Chunk lost"}}
+        offsets.append(offset)
+        if offset + 1000 < 2560:
+            return {
+                "upload": {
+                    "result": "Continue",
+                    "offset": offset + 1000,
+                    "filekey": "key.1",
+                }
+            }
+        return {"upload": {"result": "Success", "filekey": "key.1"}}
+
+    log_file = init_logger("upload", tmp_path)
+    try:
+        with requests_mock.Mocker() as m:
+            mock_mediawiki(m)
+            m.post("http://localhost/api.php", json=api_post)
+            api = MediaWikiApi(limiter=AimdLimiter(4))
+            api.csrf_token = "token"
+            assert api.upload_image(image)
+    finally:
+        close_logger()
+
+    # The failed chunk is sent again, completed chunks are not
+    assert offsets == [0, 1000, 2000]
+    content = log_file.read_text()
+    assert "Chunk at offset 1000 of big image.png failed (attempt 1/3)" in content
+    assert "big image.png sent in 3 chunks" in content
+    assert "big image.png uploaded with success" in content
+
+
+def test_mediawiki_api_rate_control(tmp_path, monkeypatch):
+    answers = [
+        ({"error": {"code": "maxlag", "info": "Waiting for db"}}, 200),
+        ({"error": {"code": "ratelimited", "info": "Too many edits"}}, 200),
+        ({}, 503),
+        ({"edit": {"result": "Success", "title": "Test page"}}, 200),
+    ]
+
+    def api_post(request, context):
+        assert "maxlag=5" in request.body
+        answer, context.status_code = answers.pop(0)
+        context.headers["Retry-After"] = "0"
+        return answer
+
+    log_file = init_logger("rate", tmp_path)
+    try:
+        with requests_mock.Mocker() as m:
+            m.post("http://rate.test/api.php", json=api_post)
+            monkeypatch.setenv("MEDIAWIKI_URL", "http://rate.test")
+            api = MediaWikiApi(limiter=AimdLimiter(8))
+            api.csrf_token = "token"
+            for _ in range(4):
+                api.limiter.acquire()
+                api.limiter.release()
+            assert api.limiter.limit > 3
+
+            result = api.create_page("Test page", "content")
+            assert result == "http://rate.test/index.php?title=Test page"
+
+            # Halved at each overload down to 1, then increased by the success
+            assert api.limiter.limit == 2
+    finally:
+        close_logger()
+
+    content = log_file.read_text()
+    assert "Mediawiki overloaded (maxlag), retry 1/5 in 0.0s" in content
+    assert "Mediawiki overloaded (ratelimited), retry 2/5 in 0.0s" in content
+    assert "Mediawiki overloaded (HTTP 503), retry 3/5 in 0.0s" in content
+
+
+def test_mediawiki_api_timeout(tmp_path, monkeypatch):
+    from libs.mediawiki_api import PAGE_NOT_CREATED
+    import requests
+
+    monkeypatch.setenv("MEDIAWIKI_RETRIES", "0")
+    image = tmp_path / "image.png"
+    image.write_bytes(b"image")
+    log_file = init_logger("timeout", tmp_path)
+    try:
+        with requests_mock.Mocker() as m:
+            m.post("http://localhost/api.php", exc=requests.Timeout)
+            api = MediaWikiApi(limiter=AimdLimiter(4))
+            api.csrf_token = "token"
+            # Last attempt timed out: same results as an error of the wiki
+            assert api.create_page("Test page", "content") == PAGE_NOT_CREATED
+            assert api.upload_image(image) is False
+    finally:
+        close_logger()
+
+    content = log_file.read_text()
+    assert "Page creation fail: " in content
+    assert "Upload of image.png failed: " in content
+
+
+def test_mediawiki_api_retry_after_capped():
+    from libs.mediawiki_api import BACKOFF_MAX, _retry_after
+    from types import SimpleNamespace
+
+    def retry_after(value):
+        return _retry_after(SimpleNamespace(headers={"Retry-After": value}))
+
+    assert retry_after("2") == 2
+    assert retry_after("86400") == BACKOFF_MAX
+    assert retry_after("Wed, 21 Oct 2026 07:28:00 GMT") is None
+
+
+def test_pdf_to_wikitext_with_fake_mediawiki(client, pdf_test_file_path, monkeypatch):
+    wiki = FakeWiki(error_rate=0.1, maxlag_rate=0.3, retry_after=0, seed=1)
+    with serve(wiki) as (wiki_url, _):
+        monkeypatch.setenv("MEDIAWIKI_URL", wiki_url)
+        monkeypatch.setenv("UPLOAD_CHUNK_SIZE", "2000")
+        # One budget per chunk, for its errors and the overloads of the wiki
+        monkeypatch.setenv("UPLOAD_CHUNK_RETRIES", "8")
+        response = convert_test_file(client, pdf_test_file_path, generate_page="true")
+        assert response.status_code == 200
+
+    file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    assert "[[File:test_page 0.png|center|thumb]]" in file.read_text()
+    assert "=== 1.1 Menu level 2 ===" in wiki.pages["test_page"]
+    # Image sent in chunks through the stash
+    assert len(wiki.files["test_page 0.png"]) > 2000
+    assert wiki.stats["chunks"] > 1
+    assert wiki.stats["maxlag"] + wiki.stats["errors"] > 0
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    content = response.text
+    assert "Mediawiki overloaded" in content
+    assert "test_page 0.png uploaded with success" in content
+    assert "Page 'test_page' created/modified successfully" in content
+
+
+def test_create_mediawiki_page_on_wiki_targets(client, txt_test_file_path, monkeypatch):
+    def create_page(wiki):
+        with open(txt_test_file_path, "rb") as f:
+            return client.post(
+                "/create-mediawiki-page",
+                files={"file": ("test_file.txt", f, "text/plain")},
+                data={"page_name": "Test page", "wiki": wiki},
+            )
+
+    with serve() as (public_url, public), serve() as (staging_url, staging):
+        monkeypatch.setenv("MEDIAWIKI_URL", public_url)
+        monkeypatch.setenv("MEDIAWIKI_TARGETS", "staging")
+        monkeypatch.setenv("MEDIAWIKI_STAGING_URL", staging_url)
+        monkeypatch.setenv("MEDIAWIKI_STAGING_MAX_CONCURRENCY", "2")
+
+        response = client.get("/wiki-health")
+        assert response.json()["staging"]["healthy"] is None
+
+        for wiki in ("staging", "Staging", ""):
+            response = create_page(wiki)
+            assert response.status_code == 200
+        assert response.json() == f"{public_url}/index.php?title=test_page"
+        assert "test_page" in public.pages and "test_page" in staging.pages
+        # One login per target, the session is reused by the next requests
+        assert staging.stats["edit"] == 2
+        assert staging.stats["login"] == public.stats["login"] == 1
+
+        health = client.get("/wiki-health").json()
+        assert health["staging"]["healthy"] is True
+        assert health["staging"]["max_limit"] == 2
+        assert health["default"]["url"] == public_url
+
+        # Expired session: checked when idle and logged in again
+        staging.user = None
+        monkeypatch.setenv("MEDIAWIKI_HEALTH_INTERVAL", "0")
+        assert client.get("/wiki-health").json()["staging"]["healthy"] is False
+        assert create_page("staging").status_code == 200
+        assert staging.stats["login"] == 2
+
+        # Each target has its own limiter, replaced when its settings change
+        monkeypatch.setenv("MEDIAWIKI_TARGETS", "staging,mirror")
+        monkeypatch.setenv("MEDIAWIKI_MIRROR_URL", staging_url)
+        monkeypatch.setenv("MEDIAWIKI_STAGING_MAX_CONCURRENCY", "3")
+        health = client.get("/wiki-health").json()
+        assert health["staging"]["max_limit"] == 3
+        assert health["mirror"]["max_limit"] == 4
+        monkeypatch.setenv("MEDIAWIKI_TARGETS", "staging")
+
+    response = create_page("partner")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "wiki must be one of ['default', 'staging']"
+
+
+def test_batch_convert_directory(pdf_test_file_path, tmp_path, monkeypatch, capsys):
+    import batch
+
+    source = tmp_path / "pdf"
+    source.mkdir()
+    shutil.copy(pdf_test_file_path, source / "Batch page.pdf")
+    shutil.copy(pdf_test_file_path, source / "copy.pdf")
+    report = tmp_path / "report.json"
+    args = [str(source), "--footer", "Test document", "--workers", "2"]
+    output_folder = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
+
+    # Converted without publication: converted again to be published
+    assert batch.main(args + ["--report", str(report)]) == 0
+    results = json.loads(report.read_text())["results"]
+    assert [result["status"] for result in results] == ["ok", "skipped"]
+
+    # Page not created: the document is converted again at the next run
+    with serve() as (wiki_url, _):
+        pass
+    monkeypatch.setenv("MEDIAWIKI_URL", wiki_url)
+    monkeypatch.setenv("MEDIAWIKI_RETRIES", "0")
+    assert batch.main(args + ["--publish", "--report", str(report)]) == 1
+    results = json.loads(report.read_text())["results"]
+    assert [result["status"] for result in results] == ["failed", "skipped"]
+
+    with serve() as (wiki_url, wiki):
+        monkeypatch.setenv("MEDIAWIKI_URL", wiki_url)
+        assert batch.main(args + ["--publish", "--report", str(report)]) == 0
+        assert "=== 1.1 Menu level 2 ===" in wiki.pages["batch_page"]
+
+        results = json.loads(report.read_text())["results"]
+        assert [result["status"] for result in results] == ["ok", "skipped"]
+        assert results[1]["error"] == f"Same content as {source / "Batch page.pdf"}"
+        assert "[1/1]" in capsys.readouterr().out
+        wikitext = (output_folder / "batch_page.txt").read_text()
+        assert "[[File:batch_page 0.png|center|thumb]]" in wikitext
+
+        # Converted documents are skipped at the next run
+        assert batch.main(args + ["--report", str(report)]) == 0
+        results = json.loads(report.read_text())["results"]
+        assert [result["status"] for result in results] == ["skipped", "skipped"]
+        assert results[0]["error"].startswith("Already converted as batch_page on")
+        assert wiki.stats["edit"] == 1
+
+
+def test_pdf_to_wikitext_defer_images(client, pdf_test_file_path, monkeypatch):
+    from libs import background
+
+    output_folder = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}"
+    release = threading.Event()
+    with serve(FakeWiki(latency=0.2)) as (wiki_url, wiki):
+        monkeypatch.setenv("MEDIAWIKI_URL", wiki_url)
+        # Upload held until another conversion of the same file is done
+        background.submit(release.wait, 30)
+        response = convert_test_file(
+            client, pdf_test_file_path, generate_page="true", defer_images="true"
+        )
+        assert response.status_code == 200
+        # Page published with its links before the upload
+        assert "[[File:test_page 0.png|center|thumb]]" in wiki.pages["test_page"]
+        response = convert_test_file(
+            client, pdf_test_file_path, page_name="Same file", profile="fast"
+        )
+        assert response.status_code == 200
+        release.set()
+        assert background.join(30)
+        assert "test_page 0.png" in wiki.files
+
+    response = client.post("/get-image-status", data={"page_name": "Test page"})
+    assert response.status_code == 200
+    status = response.json()
+    assert status["total"] == status["uploaded"] == 1
+    assert status["images"] == {"test_page 0.png": "uploaded"}
+
+    (conversion_log,) = output_folder.glob("test_page_pdf_to_wikitext_*.log")
+    content = conversion_log.read_text()
+    assert "1 images queued for upload" in content
+    assert "uploaded with success" not in content
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert "test_page 0.png uploaded with success" in response.text
+    assert "1/1 images uploaded" in response.text
+    images_folder = Path(__file__).parent / f"{os.getenv("IMAGES_FOLDER")}"
+    assert not [folder for folder in images_folder.iterdir() if folder.is_dir()]
+
+    # Images deferred by a reconversion are reported too
+    with serve() as (wiki_url, wiki):
+        monkeypatch.setenv("MEDIAWIKI_URL", wiki_url)
+        response = client.post(
+            "/reconvert-wikitext",
+            data={
+                "footer": "Test document",
+                "ignore_pages": "",
+                "page_name": "Test page",
+                "generate_page": "true",
+                "defer_images": "true",
+            },
+        )
+        assert response.status_code == 200
+        assert background.join(30)
+        assert "test_page 0.png" in wiki.files
+
+    response = client.post("/get-image-status", data={"page_name": "Test page"})
+    reconverted = response.json()
+    assert reconverted["run_id"] > status["run_id"]
+    assert reconverted["images"] == {"test_page 0.png": "uploaded"}
+
+    # Page not created: its images are not queued
+    with serve() as (wiki_url, _):
+        pass
+    monkeypatch.setenv("MEDIAWIKI_URL", wiki_url)
+    monkeypatch.setenv("MEDIAWIKI_RETRIES", "0")
+    response = client.post(
+        "/reconvert-wikitext",
+        data={
+            "footer": "Test document",
+            "ignore_pages": "",
+            "page_name": "Test page",
+            "generate_page": "true",
+            "defer_images": "true",
+        },
+    )
+    assert response.status_code == 500
+    response = client.post("/get-image-status", data={"page_name": "Test page"})
+    assert response.json()["images"] == {"test_page 0.png": "failed"}
+    assert not [folder for folder in images_folder.iterdir() if folder.is_dir()]
+
+    response = client.post("/get-image-status", data={"page_name": "Other page"})
+    assert response.status_code == 404
+
+
+def test_annotate_find_terms(ontology_file_path):
+    annotation = Annotate(ontology_file_path)
+    section = (
+        "== 1 Menu level 1 ==\nA Menu level, a menus and a TABLE"
+        " [[File:table.png|center|thumb]] with '''bold text'''"
+    )
+
+    hits = annotation.find_terms(section)
+
+    assert [(hit.concept, section[hit.start : hit.end]) for hit in hits] == [
+        ("Menu level", "Menu level"),
+        ("Table", "TABLE"),
+        ("Bold", "bold text"),
+    ]
+    assert annotation.inject(section, hits).endswith(
+        "[[Has concept::Table|TABLE]] [[File:table.png|center|thumb]]"
+        " with '''[[Has concept::Bold|bold text]]'''"
+    )
+    content = Annotate(ontology_file_path, mode="category").annotate_section(section)
+    assert content.endswith(
+        "'''bold text'''\n[[Category:Menu level]]\n[[Category:Table]]\n[[Category:Bold]]"
+    )
+
+
+def test_annotate_sections_parallel_and_cached(ontology_file_path, monkeypatch):
+    wikitext = Path(__file__).parent.joinpath("tests/test_file.txt").read_text()
+    # Wikitext cut before each heading line
+    sections = [section for section in re.split(r"(?m)^(?==)", wikitext) if section]
+    assert sections[1].startswith("== 1 Menu level 1 ==")
+
+    monkeypatch.setenv("ANNOTATION_PARALLEL_MIN", "1")
+    monkeypatch.setenv("ANNOTATION_WORKERS", "2")
+    annotation = Annotate(ontology_file_path)
+    annotated, timings = annotation.annotate_sections(sections)
+    shutdown_pool()
+
+    assert annotated == [annotation.annotate_section(s) for s in sections]
+    assert [timing.cached for timing in timings] == [False] * len(sections)
+    assert timings[2].title == "1.1 Menu level 2"
+
+    sections[-1] += "\nA new table"
+    annotated, timings = annotation.annotate_sections(sections)
+    assert annotated[-1].endswith("A new [[Has concept::Table|table]]")
+    assert [timing.cached for timing in timings] == [True] * (len(sections) - 1) + [
+        False
+    ]
+
+
+def test_pdf_to_wikitext_with_ontology(
+    client, pdf_test_file_path, ontology_file_path, monkeypatch
+):
+    monkeypatch.setenv("ONTOLOGY_FILE", str(ontology_file_path))
+    with requests_mock.Mocker() as m:
+        mock_mediawiki(m)
+        convert_test_file(client, pdf_test_file_path)
+
+    file = Path(__file__).parent / f"{os.getenv("OUTPUT_FOLDER")}/test_page.txt"
+    content = file.read_text()
+    assert "=== 1.1 Menu level 2 ===" in content
+    assert "'''[[Has concept::Bold|bold text]]'''" in content
+    assert "explain [[Has concept::Table|table]]" in content
+
+    response = client.post("/get-last-log", data={"page_name": "Test page"})
+    assert "ontology terms annotated" in response.text
+
+
+def test_startup_does_not_import_pdf_libraries():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import main, sys; print('fitz' in sys.modules, 'pymupdf4llm' in sys.modules)",
+        ],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "False False"
+
+
 def test_create_mediawiki_page_workflow_success(client, txt_test_file_path):
     with requests_mock.Mocker() as m:
         m.get(
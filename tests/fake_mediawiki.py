@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Local stand-in of the MediaWiki action API, for end-to-end and load tests
+over real sockets without a wiki.
+It implements login and tokens, upload (single and chunked through the
+stash), edit and a minimal query with userinfo, with configurable latency, error rate and
+maxlag answers. GET /stats returns call counters and the peak concurrency.
+
+Usage:
+    python tests/fake_mediawiki.py [--port 8089] [--latency 0.05]
+        [--error-rate 0.01] [--maxlag-rate 0.05] [--retry-after 1]
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import argparse
+import asyncio
+import random
+import threading
+import time
+import uuid
+import uvicorn
+
+LOGIN_TOKEN = "fakelogintoken+\\"
+CSRF_TOKEN = "fakecsrftoken+\\"
+
+
+class FakeWiki:
+    """
+    Content and behavior of the fake wiki
+
+    Args:
+        latency: Seconds added to each call
+        error_rate: Part of the calls answered with HTTP 503
+        maxlag_rate: Part of the calls with maxlag answered with a maxlag error
+        retry_after: Retry-After header of 503 and maxlag answers, in seconds
+        seed: Seed of the random draws, for repeatable runs
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        maxlag_rate: float = 0.0,
+        retry_after: int = 1,
+        seed: int | None = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.maxlag_rate = maxlag_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.pages: dict[str, str] = {}
+        self.files: dict[str, bytes] = {}
+        self.stash: dict[str, bytearray] = {}
+        self.stats: Counter = Counter()
+        # User of the last login, None once the session expired
+        self.user: str | None = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": dict(self.stats),
+            "max_in_flight": self.max_in_flight,
+            "pages": len(self.pages),
+            "files": len(self.files),
+        }
+
+    def handle(self, params: dict, files: dict) -> JSONResponse:
+        action = params.get("action", "")
+        self.stats["calls"] += 1
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return JSONResponse(
+                {}, status_code=503, headers={"Retry-After": str(self.retry_after)}
+            )
+        if (
+            "maxlag" in params
+            and self.maxlag_rate
+            and self.random.random() < self.maxlag_rate
+        ):
+            self.stats["maxlag"] += 1
+            return JSONResponse(
+                {
+                    "error": {
+                        "code": "maxlag",
+                        "info": "Waiting for a database server: 3 seconds lagged.",
+                        "lag": 3,
+                    }
+                },
+                headers={"Retry-After": str(self.retry_after), "X-Database-Lag": "3"},
+            )
+
+        self.stats[action] += 1
+        if action == "query":
+            return JSONResponse(self._query(params))
+        if action == "login":
+            result = "Success" if params.get("lgtoken") == LOGIN_TOKEN else "Failed"
+            if result == "Success":
+                self.user = params.get("lgname")
+            return JSONResponse(
+                {"login": {"result": result, "lgusername": params.get("lgname")}}
+            )
+        if params.get("token") != CSRF_TOKEN:
+            return JSONResponse(_error("badtoken", "Invalid CSRF token."))
+        if action == "upload":
+            return JSONResponse(self._upload(params, files))
+        if action == "edit":
+            title = params.get("title", "")
+            edit = {"result": "Success", "title": title}
+            if title not in self.pages:
+                edit["new"] = ""
+            self.pages[title] = params.get("text", "")
+            return JSONResponse({"edit": edit})
+        return JSONResponse(_error("badvalue", f"Unrecognized action: {action}"))
+
+    def _query(self, params: dict) -> dict:
+        if params.get("meta") == "tokens":
+            if params.get("type") == "login":
+                return {"query": {"tokens": {"logintoken": LOGIN_TOKEN}}}
+            return {"query": {"tokens": {"csrftoken": CSRF_TOKEN}}}
+        if params.get("meta") == "userinfo":
+            if self.user is None:
+                return {"query": {"userinfo": {"id": 0, "anon": ""}}}
+            return {"query": {"userinfo": {"id": 1, "name": self.user}}}
+        pages = []
+        for title in filter(None, params.get("titles", "").split("|")):
+            if title in self.pages:
+                pages.append({"title": title, "length": len(self.pages[title])})
+            else:
+                pages.append({"title": title, "missing": True})
+        return {"batchcomplete": True, "query": {"pages": pages}}
+
+    def _upload(self, params: dict, files: dict) -> dict:
+        filename = params.get("filename", "")
+        if "chunk" in files:
+            self.stats["chunks"] += 1
+            filekey = params.get("filekey") or uuid.uuid4().hex
+            stashed = self.stash.setdefault(filekey, bytearray())
+            if int(params.get("offset", -1)) != len(stashed):
+                return _error("stashfailed", "Invalid chunk offset")
+            stashed += files["chunk"]
+            if len(stashed) < int(params.get("filesize", 0)):
+                return {
+                    "upload": {
+                        "result": "Continue",
+                        "offset": len(stashed),
+                        "filekey": filekey,
+                    }
+                }
+            return {"upload": {"result": "Success", "filekey": filekey}}
+        if "filekey" in params:
+            if params["filekey"] not in self.stash:
+                return _error("missingresult", "No such filekey")
+            self.files[filename] = bytes(self.stash.pop(params["filekey"]))
+        elif "file" in files:
+            self.files[filename] = files["file"]
+        else:
+            return _error("missingparam", "One of file, filekey, chunk is required")
+        return {"upload": {"result": "Success", "filename": filename}}
+
+
+def _error(code: str, info: str) -> dict:
+    return {"error": {"code": code, "info": info}}
+
+
+def create_app(wiki: FakeWiki | None = None) -> FastAPI:
+    wiki = wiki or FakeWiki()
+    app = FastAPI(title="Fake Mediawiki API")
+    app.state.wiki = wiki
+
+    @app.api_route("/api.php", methods=["GET", "POST"])
+    async def api(request: Request):
+        params = dict(request.query_params)
+        files = {}
+        if request.method == "POST":
+            form = await request.form()
+            for key, value in form.multi_items():
+                if isinstance(value, str):
+                    params[key] = value
+                else:
+                    files[key] = await value.read()
+
+        wiki.in_flight += 1
+        wiki.max_in_flight = max(wiki.max_in_flight, wiki.in_flight)
+        try:
+            if wiki.latency:
+                await asyncio.sleep(wiki.latency)
+            return wiki.handle(params, files)
+        finally:
+            wiki.in_flight -= 1
+
+    @app.get("/stats")
+    async def stats():
+        return wiki.snapshot()
+
+    return app
+
+
+@contextmanager
+def serve(wiki: FakeWiki | None = None, port: int = 0):
+    """
+    Run a fake wiki on a local port in a background thread
+
+    Yields:
+        Tuple (wiki url to use as MEDIAWIKI_URL, FakeWiki)
+    """
+    wiki = wiki or FakeWiki()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_app(wiki),
+            host="127.0.0.1",
+            port=port,
+            log_level="warning",
+            lifespan="off",
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError("Fake Mediawiki server didn't start")
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}", wiki
+    finally:
+        server.should_exit = True
+        thread.join(10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Mediawiki API server")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--maxlag-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    wiki = FakeWiki(
+        args.latency, args.error_rate, args.maxlag_rate, args.retry_after, args.seed
+    )
+    print(f"Fake Mediawiki: MEDIAWIKI_URL=http://127.0.0.1:{args.port}")
+    uvicorn.run(create_app(wiki), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()